@@ -0,0 +1,87 @@
+import queue
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop, starting its thread on first use.
+
+    Async clients (AsyncOpenAI and friends) are bound to the loop they first
+    run on, so every coroutine that uses them is scheduled here.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='aio-loop', daemon=True)
+            thread.start()
+            _loop = loop
+            logger.info("Started background event loop")
+        return _loop
+
+
+def run(coro, timeout: float = None):
+    """Run a coroutine on the background loop and block until it finishes"""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except Exception:
+        future.cancel()
+        raise
+
+
+async def _pump(agen, put):
+    # Runs on the background loop; a cancelled pump closes the generator where it is waiting
+    try:
+        async for item in agen:
+            put(('item', item))
+    except Exception as e:
+        put(('error', e))
+        return
+    put(('end', None))
+
+
+def iterate(agen):
+    """Drive an async generator on the background loop and yield its items here.
+
+    Closing the returned generator cancels ``agen``. Items are buffered
+    without limit, so this suits event streams rather than bulk data.
+    """
+    items = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(_pump(agen, items.put), get_loop())
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == 'item':
+                yield value
+            elif kind == 'end':
+                return
+            else:
+                raise value
+    finally:
+        future.cancel()
+
+
+async def aiterate(agen):
+    """``iterate`` for a consumer running on another event loop"""
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _pump(agen, lambda entry: loop.call_soon_threadsafe(items.put_nowait, entry)), get_loop())
+    try:
+        while True:
+            kind, value = await items.get()
+            if kind == 'item':
+                yield value
+            elif kind == 'end':
+                return
+            else:
+                raise value
+    finally:
+        future.cancel()
@@ -1,47 +1,121 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, make_response, redirect, url_for, flash, session
-from openai import OpenAI
+from flask import Flask, render_template, request, jsonify, make_response, redirect, url_for, flash, session, g, Response, stream_with_context, send_file, send_from_directory
 from functools import wraps
-from auth import SupabaseAuth, User
+from werkzeug.local import LocalProxy
+from auth import User, TokenError, TokenExpiredError
+from transport import transport, stripe_http_client
+import services
+from subscriptions import EntitlementStore
+from generation_cache import GenerationCache, cache_key, KEY_FIELDS
+from json_stream import TopLevelJSONStream
+from prompts import lesson_messages, outline_messages, section_messages
+from lesson_schemas import (
+    response_format as plan_response_format, outline_response_format, section_response_format,
+    pending_sections,
+)
+from jobs import JobQueue, QueueFullError
+from singleflight import SingleFlight
+from limiter import AdaptiveLimiter, LimiterBusyError
+from router import ModelRouter, Route
+import metrics
+import tracing
+import logging_config
+from suggestions import SuggestionIndex
+from models import db, database_url, LessonPlan, history_page
+from search import init_search, index_plan, search_plans
+from exporter import ExportService, FORMATS as EXPORT_FORMATS, stream_zip
+from sqlalchemy.orm import undefer
+from werkzeug.utils import secure_filename
+import aio
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 import stripe
 import logging
 import json
+import csv
+import io
+import asyncio
+import threading
+import uuid
+import time
+import click
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging: JSON lines written by a background thread (see logging_config.py)
+logging_config.configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
 if not app.secret_key:
     raise ValueError("SESSION_SECRET environment variable is required")
+# Prometheus metrics at /metrics (aggregated across gunicorn workers, see gunicorn.conf.py)
+metrics.init_app(app)
+# Span timeline per request: Server-Timing header, sampled traces in DATA_DIR/traces.jsonl
+tracing.init_app(app)
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 600))
 
 # Initialize Stripe
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
+stripe.api_base = os.environ.get("STRIPE_API_BASE", stripe.api_base)
+stripe.default_http_client = stripe_http_client()
 STRIPE_PRICE_ID = os.environ.get("STRIPE_PRICE_ID")  # Updated to use environment variable
+STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
 YOUR_DOMAIN = os.environ.get('REPLIT_DEV_DOMAIN', 'localhost:5000')
 
+LESSON_MODEL = "gpt-4o"
+# Bump whenever the lesson prompt changes so cached plans are not reused
+PROMPT_VERSION = 4
+
+# Saved plan history (Postgres via DATABASE_URL, SQLite locally)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_pre_ping": True, "pool_recycle": 300}
+db.init_app(app)
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 20))
+
+# Run generation jobs as coroutines on the event loop instead of worker threads (set by asgi.py)
+ASYNC_JOBS = os.environ.get('ASYNC_JOBS') == '1'
+
+# Bulk generation limits
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 100))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))
+
 if not STRIPE_PRICE_ID:
     logger.error("STRIPE_PRICE_ID environment variable is missing")
     raise ValueError("STRIPE_PRICE_ID environment variable is required")
 
-try:
-    # Verify if it's a valid price ID by making a test API call
-    stripe.Price.retrieve(STRIPE_PRICE_ID)
-    logger.info(f"Successfully validated Stripe Price ID: {STRIPE_PRICE_ID}")
-except stripe.error.InvalidRequestError as e:
-    logger.error(f"Invalid Stripe Price ID: {STRIPE_PRICE_ID}")
-    raise ValueError(f"Invalid Stripe Price ID: {str(e)}")
+# Clients are built lazily (and warmed in the background) so a new instance
+# can accept traffic before Stripe, Supabase and OpenAI have been contacted
+auth = LocalProxy(services.supabase_auth.get)
+services.start_warm_up()
+# Adaptive cap on concurrent OpenAI calls in this worker; backs off on 429s
+openai_limiter = AdaptiveLimiter('openai')
+# Latency budget (seconds) and model ladder per kind of call; slow calls are hedged down the ladder.
+# Calls go through the async client on the background event loop so losing hedges can be cancelled
+router = ModelRouter(services.async_openai_client.get, openai_limiter, [
+    Route('plan', (LESSON_MODEL, 'gpt-4o-mini'), 60),
+    Route('outline', (LESSON_MODEL, 'gpt-4o-mini'), 20),
+    Route('section', (LESSON_MODEL, 'gpt-4o-mini'), 20),
+    Route('resources', (LESSON_MODEL, 'gpt-4o-mini'), 20),
+])
 
 try:
-    # Initialize authentication
-    auth = SupabaseAuth()
-    # Initialize OpenAI client
-    openai = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    # Local subscription state, kept current by Stripe webhooks
+    entitlements = EntitlementStore()
+    entitlements.start_reconciler()
+    # Cache of generated plans keyed on normalized parameters
+    generation_cache = GenerationCache()
+    # Bounded worker pool for OpenAI calls so web workers stay free
+    job_queue = JobQueue()
+    # Identical generations in flight at the same time share one OpenAI call
+    single_flight = SingleFlight()
+    # Past plans, searchable by similarity before paying for a new generation
+    suggestion_index = SuggestionIndex()
+    # PDF/DOCX rendering in a process pool, artifacts cached on disk by content hash
+    export_service = ExportService()
 except Exception as e:
-    logger.error(f"Failed to initialize services: {str(e)}")
+    logger.error("Failed to initialize services: %s", e)
     raise
 
 # Setup Flask-Login
@@ -52,35 +126,35 @@ login_manager.login_message_category = 'warning'
 
 def check_subscription():
     """Check if the current user has an active subscription or is admin"""
-    if not current_user.is_authenticated:
-        return False
+    with tracing.span('check_subscription'):
+        if not current_user.is_authenticated:
+            return False
 
-    # Admin users have access to all features
-    if current_user.is_admin:
-        return True
+        # Admin users have access to all features
+        if current_user.is_admin:
+            return True
 
-    try:
-        # Get customer ID from session or query Stripe
-        customer_id = session.get('stripe_customer_id')
-        if not customer_id:
-            # Search for customer by email
-            customers = stripe.Customer.list(email=current_user.email, limit=1)
-            if customers.data:
-                customer_id = customers.data[0].id
-                session['stripe_customer_id'] = customer_id
-            else:
-                return False
+        # Answer at most once per request
+        if 'is_subscribed' in g:
+            return g.is_subscribed
 
-        # Check for active subscription
-        subscriptions = stripe.Subscription.list(
-            customer=customer_id,
-            status='active',
-            limit=1
-        )
-        return len(subscriptions.data) > 0
-    except Exception as e:
-        logger.error(f"Error checking subscription: {str(e)}")
-        return False
+        try:
+            # Get customer ID from the session, then the local customer index
+            customer_id = session.get('stripe_customer_id')
+            if not customer_id:
+                customer_id = entitlements.customer_id_for(current_user.id, current_user.email)
+                if customer_id:
+                    session['stripe_customer_id'] = customer_id
+                else:
+                    g.is_subscribed = False
+                    return False
+
+            # Check for active subscription in the local entitlement store
+            g.is_subscribed = entitlements.is_active(customer_id)
+            return g.is_subscribed
+        except Exception as e:
+            logger.error("Error checking subscription: %s", e)
+            return False
 
 def subscription_required(f):
     @wraps(f)
@@ -93,11 +167,52 @@ def subscription_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_admin:
+            return jsonify({"error": "Admin access required"}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 @login_manager.user_loader
-def load_user(user_id):
-    if not session.get('user'):
-        return None
-    return User(session['user'])
+def load_user(user_id, refresh=True):
+    """The signed-in user, once their Supabase access token checks out locally.
+
+    With ``refresh`` false an expired access token is not refreshed, for
+    callers that can't send the refreshed session back (see asgi.py).
+    """
+    with tracing.span('load_user'):
+        user_data = session.get('user')
+        if not user_data:
+            return None
+        # The demo admin has no Supabase session
+        if user_data.get('is_admin'):
+            return User(user_data)
+
+        tokens = session.get('auth')
+        if not tokens:
+            # Signed in before sessions kept their tokens
+            return None
+        try:
+            claims = auth.verify(tokens['access_token'])
+        except TokenExpiredError:
+            if not refresh:
+                return None
+            try:
+                tokens = auth.refresh(tokens['refresh_token'])
+                claims = auth.verify(tokens['access_token'])
+            except Exception as e:
+                logger.info("Could not refresh the session of %s: %s", user_id, e)
+                return None
+            session['auth'] = tokens
+        except TokenError as e:
+            logger.warning("Rejected the access token of %s: %s", user_id, e)
+            return None
+
+        if claims.get('sub') != user_id:
+            return None
+        return User(user_data)
 
 @app.route('/create-checkout-session', methods=['POST'])
 @login_required
@@ -105,60 +220,139 @@ def create_checkout_session():
     try:
         # Get or create customer
         customer_email = current_user.email
-        logger.info(f"Creating checkout session for email: {customer_email}")
+        logger.debug("Creating checkout session for email: %s", customer_email)
 
-        customers = stripe.Customer.list(email=customer_email, limit=1)
-        if customers.data:
-            customer = customers.data[0]
-            logger.info(f"Found existing customer with ID: {customer.id}")
+        # A cached "no customer" is not trusted here: a duplicate customer is worse than one search
+        customer_id = entitlements.customer_id_for(current_user.id, customer_email, trust_misses=False)
+        if customer_id:
+            logger.debug("Found existing customer with ID: %s", customer_id)
         else:
-            customer = stripe.Customer.create(email=customer_email)
-            logger.info(f"Created new customer with ID: {customer.id}")
-
-        session['stripe_customer_id'] = customer.id
+            with metrics.track('stripe', 'customer_create'):
+                customer = stripe.Customer.create(email=customer_email)
+            entitlements.remember_customer(customer, user_id=current_user.id)
+            customer_id = customer.id
+            logger.debug("Created new customer with ID: %s", customer_id)
 
-        # Log the price ID we're using
-        logger.info(f"Using Stripe Price ID: {STRIPE_PRICE_ID}")
+        session['stripe_customer_id'] = customer_id
 
         # Create checkout session with subscription
-        checkout_session = stripe.checkout.Session.create(
-            customer=customer.id,
-            line_items=[{
-                'price': STRIPE_PRICE_ID,
-                'quantity': 1,
-            }],
-            mode='subscription',
-            success_url=f'https://{YOUR_DOMAIN}/subscription-success',
-            cancel_url=f'https://{YOUR_DOMAIN}/pricing',
-            allow_promotion_codes=True,
-            billing_address_collection='required',
-        )
+        with metrics.track('stripe', 'checkout_session'):
+            checkout_session = stripe.checkout.Session.create(
+                customer=customer_id,
+                line_items=[{
+                    'price': STRIPE_PRICE_ID,
+                    'quantity': 1,
+                }],
+                mode='subscription',
+                success_url=f'https://{YOUR_DOMAIN}/subscription-success',
+                cancel_url=f'https://{YOUR_DOMAIN}/pricing',
+                allow_promotion_codes=True,
+                billing_address_collection='required',
+            )
 
-        logger.info(f"Created checkout session: {checkout_session.id}")
+        logger.info("Created checkout session %s for customer %s", checkout_session.id, customer_id)
         return redirect(checkout_session.url, code=303)
     except stripe.error.InvalidRequestError as e:
-        logger.error(f"Stripe invalid request error: {str(e)}")
+        logger.error("Stripe invalid request error: %s", e)
         flash('Unable to process subscription. Please try again later.', 'danger')
         return redirect(url_for('pricing'))
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe error: {str(e)}")
+        logger.error("Stripe error: %s", e)
         flash('An error occurred with the payment processor. Please try again later.', 'danger')
         return redirect(url_for('pricing'))
     except Exception as e:
-        logger.error(f"Error creating checkout session: {str(e)}")
+        logger.error("Error creating checkout session: %s", e)
         flash('An unexpected error occurred. Please try again later.', 'danger')
         return redirect(url_for('pricing'))
 
+def init_db():
+    """Create the tables and the search index, indexing any plans it is missing"""
+    with app.app_context():
+        db.create_all()
+        init_search()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or update the database schema; run once per deploy, before the workers start"""
+    started = time.monotonic()
+    init_db()
+    click.echo(f"Database ready in {time.monotonic() - started:.1f}s")
+
+@app.cli.command('backfill-customers')
+def backfill_customers():
+    """Index every Stripe customer by email so logins don't need Stripe's email search"""
+    started = time.monotonic()
+    count = entitlements.import_customers()
+    click.echo(f"Indexed {count} Stripe customers in {time.monotonic() - started:.1f}s")
+
+@app.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    if not STRIPE_WEBHOOK_SECRET:
+        logger.error("STRIPE_WEBHOOK_SECRET is not configured")
+        return jsonify({"error": "Webhook not configured"}), 500
+
+    payload = request.get_data()
+    sig_header = request.headers.get('Stripe-Signature', '')
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+    except ValueError:
+        return jsonify({"error": "Invalid payload"}), 400
+    except stripe.error.SignatureVerificationError:
+        logger.warning("Stripe webhook signature verification failed")
+        return jsonify({"error": "Invalid signature"}), 400
+
+    try:
+        entitlements.apply_event(event)
+    except Exception as e:
+        logger.error("Error applying Stripe event %s: %s", event['id'], e)
+        return jsonify({"error": "Failed to process event"}), 500
+    return jsonify({"received": True})
+
 @app.route('/subscription-success')
 @login_required
 def subscription_success():
+    # Don't wait for the webhook to unlock the app
+    customer_id = session.get('stripe_customer_id')
+    if customer_id:
+        try:
+            entitlements.sync_customer(customer_id)
+        except Exception as e:
+            logger.error("Error syncing subscription for %s: %s", customer_id, e)
     flash('Thank you for subscribing!', 'success')
     return redirect(url_for('app_index'))
 
+def display_price():
+    """Amount and interval of the subscription price, from the cached Stripe lookup"""
+    if not services.stripe_price.ready:
+        return None
+    try:
+        price = services.stripe_price.get()
+    except Exception:
+        return None
+    if price.get('unit_amount') is None:
+        return None
+    amount = price['unit_amount'] / 100
+    recurring = price.get('recurring') or {}
+    return {
+        'amount': f"{amount:.0f}" if amount == int(amount) else f"{amount:.2f}",
+        'currency': price.get('currency', 'usd').upper(),
+        'interval': recurring.get('interval', 'month'),
+    }
+
 @app.route('/pricing')
 def pricing():
     is_subscribed = check_subscription() if current_user.is_authenticated else False
-    return render_template('pricing.html', is_subscribed=is_subscribed)
+    return render_template('pricing.html', is_subscribed=is_subscribed, price=display_price())
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    checks = services.readiness()
+    ready = all(check['ready'] for check in checks.values())
+    return jsonify({"ready": ready, "services": checks}), 200 if ready else 503
 
 @app.route('/')
 def landing():
@@ -199,7 +393,7 @@ def login():
                 return render_template('login.html')
 
             if email == demo_email and password == demo_password:
-                logger.info(f"Admin login successful for: {email}")
+                logger.info("Admin login successful for: %s", email)
                 # Create admin user session
                 user_data = {
                     'id': 'admin',
@@ -222,15 +416,17 @@ def login():
                     'email': user.email,
                     'is_admin': False
                 }
+                # Checked locally on every request (see load_user), refreshed when it expires
+                session['auth'] = result['session']
                 flash('Successfully logged in!', 'success')
                 return redirect(url_for('landing'))
             else:
                 error_msg = result.get('error', 'Invalid credentials')
                 flash(error_msg, 'danger')
-                logger.warning(f"Failed login attempt for user: {email}")
+                logger.warning("Failed login attempt for user: %s", email)
 
         except Exception as e:
-            logger.error(f"Login error: {str(e)}")
+            logger.error("Login error: %s", e)
             flash('An error occurred during login. Please try again.', 'danger')
 
     return render_template('login.html')
@@ -260,7 +456,7 @@ def signup():
                 return redirect(url_for('login'))
             else:
                 error_msg = result.get('error', 'Error creating account.')
-                logger.warning(f"Signup failed: {error_msg}")
+                logger.warning("Signup failed: %s", error_msg)
 
                 # Provide more user-friendly error messages
                 if 'rate_limit' in error_msg.lower():
@@ -270,7 +466,7 @@ def signup():
                 else:
                     flash(error_msg, 'danger')
         except Exception as e:
-            logger.error(f"Signup error: {str(e)}")
+            logger.error("Signup error: %s", e)
             flash('An error occurred during signup. Please try again.', 'danger')
 
     return render_template('signup.html')
@@ -279,82 +475,767 @@ def signup():
 @login_required
 def logout():
     try:
-        auth.sign_out()
+        auth.sign_out((session.get('auth') or {}).get('access_token'))
     except Exception as e:
-        logger.error(f"Logout error: {str(e)}")
+        logger.error("Logout error: %s", e)
     logout_user()
     session.clear()
     flash('You have been logged out.', 'info')
     return redirect(url_for('landing'))
 
 
+@app.route('/history')
+@login_required
+def list_history():
+    """Newest-first page of the teacher's saved plans; pass next_cursor back for the next page"""
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), 100)
+        plans, next_cursor = history_page(current_user.id, limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": [plan.summary() for plan in plans], "next_cursor": next_cursor})
+
+def history_text(value, default=''):
+    """A title or parameter from a saved plan as column text; ValueError if it isn't a scalar"""
+    if isinstance(value, (dict, list)):
+        raise ValueError("Plan titles and parameters must be text")
+    return str(value) if value not in (None, '') else default
+
+@app.route('/history', methods=['POST'])
+@login_required
+def save_history():
+    data = request.get_json(silent=True) or {}
+    plan = data.get('plan')
+    params = data.get('params') or {}
+    if not isinstance(plan, dict) or not isinstance(params, dict):
+        return jsonify({"error": "A plan object is required"}), 400
+
+    try:
+        entry = LessonPlan(
+            user_id=current_user.id,
+            title=history_text(plan.get('title'), 'Untitled Plan')[:200],
+            subject=history_text(params.get('subject'))[:500],
+            template=history_text(params.get('template'))[:100],
+            subtemplate=history_text(params.get('subtemplate'))[:100],
+            params=params,
+            plan=plan,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    db.session.add(entry)
+    index_plan(entry)
+    db.session.commit()
+    return jsonify(entry.summary()), 201
+
+def owned_plan(plan_id):
+    return LessonPlan.query.filter_by(id=plan_id, user_id=current_user.id).first()
+
+@app.route('/history/<int:plan_id>')
+@login_required
+def get_history_plan(plan_id):
+    entry = owned_plan(plan_id)
+    if entry is None:
+        return jsonify({"error": "Plan not found"}), 404
+    return jsonify(entry.to_dict())
+
+@app.route('/history/<int:plan_id>', methods=['PATCH'])
+@login_required
+def update_history_plan(plan_id):
+    """Replace a saved plan's body, e.g. once more of its sections have been generated"""
+    plan = (request.get_json(silent=True) or {}).get('plan')
+    if not isinstance(plan, dict):
+        return jsonify({"error": "A plan object is required"}), 400
+    try:
+        title = history_text(plan.get('title'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    entry = owned_plan(plan_id)
+    if entry is None:
+        return jsonify({"error": "Plan not found"}), 404
+    entry.plan = plan
+    entry.title = (title or entry.title)[:200]
+    index_plan(entry)
+    db.session.commit()
+    return jsonify(entry.summary())
+
+@app.route('/search')
+@login_required
+def search_history():
+    """Full-text search over the teacher's saved plans, best match first, with highlighted snippets"""
+    query = request.args.get('q', '')
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), 50)
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    return jsonify({"results": search_plans(current_user.id, query, limit)})
+
+@app.route('/export', methods=['POST'])
+@login_required
+def export_plan():
+    """Render a plan to PDF or DOCX and return the URL to download it from"""
+    data = request.get_json(silent=True) or {}
+    plan = data.get('plan')
+    fmt = data.get('format')
+    if not isinstance(plan, dict) or fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "A plan and a format (pdf or docx) are required"}), 400
+    try:
+        digest = export_service.export(plan, fmt)
+    except Exception as e:
+        logger.error("Export error: %s", e)
+        return jsonify({"error": "Could not export this plan. Please try again."}), 500
+    return jsonify({"url": url_for('download_export', digest=digest, fmt=fmt, name=plan.get('title') or 'lesson-plan')})
+
+@app.route('/exports/<digest>.<fmt>')
+@login_required
+def download_export(digest, fmt):
+    """Serve a rendered artifact from disk; its content hash is the ETag"""
+    path = export_service.cached(digest, fmt) if fmt in EXPORT_FORMATS and digest.isalnum() else None
+    if path is None:
+        return jsonify({"error": "Export not found. Please export the plan again."}), 404
+    name = secure_filename(request.args.get('name') or '') or 'lesson-plan'
+    response = send_file(path, mimetype=EXPORT_FORMATS[fmt], as_attachment=True,
+                         download_name=f"{name}.{fmt}", etag=digest, conditional=True, max_age=86400)
+    # Content never changes for a digest, but it belongs to a signed-in teacher
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+BULK_EXPORT_MAX_IDS = 1000
+
+def bulk_export_plans(user_id, ids):
+    """The teacher's saved plans, newest first, or just ``ids`` in that order"""
+    if ids:
+        for start in range(0, len(ids), 50):
+            chunk = ids[start:start + 50]
+            plans = {plan.id: plan for plan in LessonPlan.query.options(undefer(LessonPlan.plan)).filter(
+                LessonPlan.id.in_(chunk), LessonPlan.user_id == user_id)}
+            yield from (plans[plan_id] for plan_id in chunk if plan_id in plans)
+        return
+
+    cursor = None
+    while True:
+        plans, cursor = history_page(user_id, 50, cursor, with_plan=True)
+        yield from plans
+        if not cursor:
+            return
+
+def bulk_export_entries(user_id, ids, fmt):
+    """(archive name, artifact path) per plan, rendering a few plans ahead of the one being sent"""
+    lookahead = export_service.workers * 2
+    with ThreadPoolExecutor(max_workers=export_service.workers, thread_name_prefix='bulk-export') as pool:
+        window = deque()
+        plans = bulk_export_plans(user_id, ids)
+        while True:
+            # Keep the window full; plan bodies are dropped from the session once handed off
+            while len(window) < lookahead:
+                entry = next(plans, None)
+                if entry is None:
+                    break
+                name = secure_filename(entry.title) or 'lesson-plan'
+                window.append((entry.id, name, pool.submit(export_service.export, entry.plan, fmt)))
+                db.session.expunge(entry)
+            if not window:
+                return
+            plan_id, name, future = window.popleft()
+            try:
+                digest = future.result()
+            except Exception as e:
+                logger.error("Bulk export of plan %s failed: %s", plan_id, e)
+                continue
+            yield f"{plan_id}-{name}.{fmt}", export_service.path(digest, fmt)
+
+@app.route('/export/bulk')
+@login_required
+def export_bulk():
+    """Stream a ZIP of the teacher's saved plans (all, or ?ids=1,2,3) as PDF or DOCX"""
+    fmt = request.args.get('format', 'pdf')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "Format must be pdf or docx"}), 400
+    try:
+        ids = [int(plan_id) for plan_id in request.args.get('ids', '').split(',') if plan_id.strip()]
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of plan ids"}), 400
+    if len(ids) > BULK_EXPORT_MAX_IDS:
+        return jsonify({"error": f"At most {BULK_EXPORT_MAX_IDS} plans can be exported at once"}), 400
+
+    user_id = current_user.id
+    response = Response(stream_with_context(stream_zip(bulk_export_entries(user_id, ids, fmt))),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="lesson-plans-{fmt}.zip"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+usage_lock = threading.Lock()
+usage_totals = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+def record_usage(usage, data, model=None):
+    """Log token usage for one OpenAI call, including prefix-cached prompt tokens"""
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    summary = {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": (getattr(details, 'cached_tokens', None) or 0),
+        "completion_tokens": usage.completion_tokens,
+    }
+    with usage_lock:
+        usage_totals["requests"] += 1
+        for name, value in summary.items():
+            usage_totals[name] += value
+    metrics.record_tokens(summary, model, *usage_labels(data))
+    logger.info(
+        "OpenAI usage model=%s template=%s subtemplate=%s prompt_tokens=%s cached_tokens=%s completion_tokens=%s",
+        model or '-', data.get('template'), data.get('subtemplate') or '-',
+        summary['prompt_tokens'], summary['cached_tokens'], summary['completion_tokens'],
+    )
+    return summary
+
+def usage_labels(data):
+    """(template, subtemplate) metric labels; anything unrecognised is folded into 'other'"""
+    template = data.get('template')
+    if template not in LESSON_TEMPLATES:
+        return 'other', 'other'
+    subtemplate = data.get('subtemplate') or 'none'
+    return template, (subtemplate if subtemplate in SUBTEMPLATES[template] or subtemplate == 'none' else 'other')
+
+def template_error(data):
+    """Why ``data`` doesn't name a known template and subtemplate, or None if it does"""
+    template = data.get('template')
+    if not isinstance(template, str) or template not in LESSON_TEMPLATES:
+        return "Unknown template"
+    subtemplate = data.get('subtemplate')
+    if subtemplate and (not isinstance(subtemplate, str) or subtemplate not in SUBTEMPLATES[template]):
+        return "Unknown subtemplate"
+    return None
+
+def with_owner(data):
+    """``data`` stamped with the signed-in user, the only one its plan is suggested to"""
+    return {**data, "owner": current_user.id if current_user.is_authenticated else None}
+
+def is_outline(data):
+    """Two-phase mode: generate the outline now and each section when it is opened"""
+    return data.get('mode') == 'outline'
+
+def generation_key(data, model=LESSON_MODEL):
+    version = f"{PROMPT_VERSION}:outline" if is_outline(data) else PROMPT_VERSION
+    return cache_key(data, model, version)
+
+def generation_call(data):
+    """Messages and response format for a /generate request"""
+    description = LESSON_TEMPLATES[data.get('template')]['description']
+    if is_outline(data):
+        return outline_messages(data, description), outline_response_format(data.get('subtemplate'))
+    return lesson_messages(data, description), plan_response_format(data.get('subtemplate'))
+
+def outline_payload(plan_id, entry):
+    return {
+        "plan_id": plan_id,
+        **entry['outline'],
+        "pending_sections": pending_sections(entry['params'].get('subtemplate')),
+    }
+
+def store_generation(data, result, model=LESSON_MODEL):
+    """Cache a generated plan or outline and return what the client receives.
+
+    An outline is stored under its cache key, which doubles as the plan id for
+    /generate/section; the revision keeps sections of a regenerated outline apart.
+    Only the primary model's work is served from the cache: a fallback model's
+    plan isn't cached, and its outline is kept under that model's key, where
+    only its sections look it up.
+    """
+    key = generation_key(data, model)
+    if model == LESSON_MODEL and data.get('owner'):
+        index_generation(key, data, result)
+    if not is_outline(data):
+        if model == LESSON_MODEL:
+            generation_cache.set(key, result)
+        return result
+
+    entry = {
+        "revision": uuid.uuid4().hex,
+        "params": {field: data.get(field) or '' for field in KEY_FIELDS},
+        "outline": result,
+    }
+    generation_cache.set(key, entry)
+    return outline_payload(key, entry)
+
+def index_generation(key, data, plan):
+    try:
+        suggestion_index.add(key, data, plan, data['owner'])
+    except Exception as e:
+        # Suggestions are best effort; never fail a generation over them
+        logger.warning("Failed to index generated plan: %s", e)
+
+def cached_generation(data):
+    """The cached response for a plan or outline request, or None on a miss"""
+    key = generation_key(data)
+    cached = generation_cache.get(key, kind='outline' if is_outline(data) else 'plan')
+    if cached is None or not is_outline(data):
+        return cached
+    return outline_payload(key, cached)
+
+def generate_plan(data):
+    """Generate a lesson plan (or outline), sharing the call with identical requests in flight"""
+    if not data.get('regenerate'):
+        # An identical job may have finished while this one was queued
+        cached = cached_generation(data)
+        if cached is not None:
+            return cached
+    plan, coalesced = single_flight.do(generation_key(data), run_generation, data)
+    if coalesced:
+        job_queue.report_progress({"coalesced": True})
+    return plan
+
+async def generate_plan_async(data):
+    """``generate_plan`` as a coroutine, for jobs on the event loop.
+
+    Cache and job-store reads and writes are SQLite calls, so they go to a
+    thread rather than stall every other coroutine on the loop.
+    """
+    if not data.get('regenerate'):
+        cached = await asyncio.to_thread(cached_generation, data)
+        if cached is not None:
+            return cached
+    plan, coalesced = await single_flight.do_async(generation_key(data), run_generation_async, data)
+    if coalesced:
+        await asyncio.to_thread(job_queue.report_progress, {"coalesced": True})
+    return plan
+
+def run_generation(data):
+    """Call OpenAI for a lesson plan (or outline) and store it in the generation cache"""
+    messages, response_format = generation_call(data)
+    response, model = router.complete(
+        'outline' if is_outline(data) else 'plan',
+        messages=messages,
+        response_format=response_format
+    )
+    return finish_generation(data, response, model)
+
+async def run_generation_async(data):
+    messages, response_format = generation_call(data)
+    response, model = await router.complete_async(
+        'outline' if is_outline(data) else 'plan',
+        messages=messages,
+        response_format=response_format
+    )
+    return await asyncio.to_thread(finish_generation, data, response, model)
+
+def finish_generation(data, response, model):
+    plan = json.loads(response.choices[0].message.content)
+    usage = record_usage(response.usage, data, model)
+    job_queue.report_progress({"usage": usage, "model": model})
+    return store_generation(data, plan, model)
+
+def section_key(plan_id, revision, section):
+    return f"{plan_id}:{revision}:{section}"
+
+def generate_section(plan_id, entry, section):
+    """Write one section of an outlined plan, sharing the call with identical requests in flight"""
+    result, _ = single_flight.do(
+        section_key(plan_id, entry['revision'], section), run_section, plan_id, entry, section)
+    return result
+
+async def generate_section_async(plan_id, entry, section):
+    result, _ = await single_flight.do_async(
+        section_key(plan_id, entry['revision'], section), run_section_async, plan_id, entry, section)
+    return result
+
+def run_section(plan_id, entry, section):
+    """Call OpenAI for one section of an outlined plan and cache it against the plan id"""
+    messages, response_format = section_call(entry, section)
+    response, model = router.complete('section', messages=messages, response_format=response_format)
+    return finish_section(plan_id, entry, section, response, model)
+
+async def run_section_async(plan_id, entry, section):
+    messages, response_format = section_call(entry, section)
+    response, model = await router.complete_async('section', messages=messages, response_format=response_format)
+    return await asyncio.to_thread(finish_section, plan_id, entry, section, response, model)
+
+def section_call(entry, section):
+    params = entry['params']
+    description = LESSON_TEMPLATES[params['template']]['description']
+    return section_messages(params, description, entry['outline'], section), section_response_format(section)
+
+def finish_section(plan_id, entry, section, response, model):
+    value = json.loads(response.choices[0].message.content)[section]
+    usage = record_usage(response.usage, entry['params'], model)
+    job_queue.report_progress({"usage": usage, "model": model})
+    if model == LESSON_MODEL:
+        generation_cache.set(section_key(plan_id, entry['revision'], section), value)
+    return {"plan_id": plan_id, "section": section, "value": value}
+
+def submit_generation(kind, fn, async_fn, *args):
+    """Queue a generation job for the signed-in user.
+
+    It runs as a coroutine on the event loop when ASYNC_JOBS is set, else on a worker thread.
+    """
+    if ASYNC_JOBS:
+        return job_queue.submit_async(async_fn, *args, kind=kind, owner=current_user.id)
+    return job_queue.submit(fn, *args, kind=kind, owner=current_user.id)
+
+def job_accepted(job_id):
+    status_url = url_for('job_status', job_id=job_id)
+    response = jsonify({"job_id": job_id, "status": "queued", "status_url": status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+def queue_full_response(message, retry_after=5):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 @app.route('/generate', methods=['POST', 'OPTIONS'])
+@login_required
 def generate_lesson():
     if request.method == 'OPTIONS':
         return add_cors_headers(make_response())
     try:
         data = request.json
-        template_type = data.get('template')
-        subject = data.get('subject')
-        grade = data.get('grade', '')
-        duration = data.get('duration', '')
-        objectives = data.get('objectives', '')
-        subtemplate = data.get('subtemplate', '')
-
-        prompt = f"""
-        Create a detailed educational plan using the following parameters:
-        Template Type: {LESSON_TEMPLATES[template_type]['description']}
-        {"Subtemplate: " + subtemplate if subtemplate else ""}
-        Subject: {subject}
-        {"Grade Level: " + grade if grade else ""}
-        {"Duration: " + duration if duration else ""}
-        {"Objectives: " + objectives if objectives else ""}
-
-        Please provide the plan in JSON format with the following structure:
-        {{
-            "title": "Title",
-            "overview": "Brief overview",
-            "overview_summary": ["Summary sentence 1", "Summary sentence 2"],
-            "objectives": ["objective1", "objective2"],
-            "objectives_summary": ["Summary sentence 1", "Summary sentence 2"],
-            "materials": ["material1", "material2"],
-            "materials_summary": ["Summary sentence 1", "Summary sentence 2"],
-            "procedure": ["step1", "step2"],
-            "procedure_summary": ["Summary sentence 1", "Summary sentence 2"],
-            "assessment": "Assessment details",
-            "assessment_summary": ["Summary sentence 1", "Summary sentence 2"],
-            "extensions": ["extension1", "extension2"],
-            "extensions_summary": ["Summary sentence 1", "Summary sentence 2"]
-        }}
-        """
-
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}
-        )
+        error = template_error(data)
+        if error:
+            return jsonify({"error": error}), 400
 
-        return jsonify(json.loads(response.choices[0].message.content))
+        if not data.get('regenerate'):
+            cached = cached_generation(data)
+            if cached is not None:
+                response = jsonify(cached)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+        if openai_limiter.saturated():
+            return queue_full_response("Too many plans are being generated. Please try again shortly.", openai_limiter.retry_after())
+        job_id = submit_generation('generate', generate_plan, generate_plan_async, with_owner(data))
+        return job_accepted(job_id)
+    except QueueFullError:
+        return queue_full_response("Too many plans are being generated. Please try again shortly.")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = job_queue.get(job_id, current_user.id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/generate/section', methods=['POST'])
+@login_required
+def generate_lesson_section():
+    """Generate one section of an outlined plan when the user expands it"""
+    data = request.get_json(silent=True) or {}
+    plan_id = data.get('plan_id')
+    section = data.get('section')
+
+    entry = generation_cache.get(plan_id, kind=None) if plan_id else None
+    if not isinstance(entry, dict) or 'revision' not in entry:
+        return jsonify({"error": "Plan not found or expired. Please generate it again."}), 404
+    if section not in pending_sections(entry['params'].get('subtemplate')):
+        return jsonify({"error": "Unknown section"}), 400
+
+    if not data.get('regenerate'):
+        cached = generation_cache.get(section_key(plan_id, entry['revision'], section), kind='section')
+        if cached is not None:
+            response = jsonify({"plan_id": plan_id, "section": section, "value": cached})
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+    if openai_limiter.saturated():
+        return queue_full_response("Too many plans are being generated. Please try again shortly.", openai_limiter.retry_after())
+    try:
+        job_id = submit_generation('section', generate_section, generate_section_async, plan_id, entry, section)
+        return job_accepted(job_id)
+    except QueueFullError:
+        return queue_full_response("Too many plans are being generated. Please try again shortly.")
+
+SUGGEST_MIN_SCORE = float(os.environ.get('SUGGEST_MIN_SCORE', 0.35))
+
+@app.route('/suggest', methods=['POST'])
+@login_required
+def suggest_plans():
+    """The teacher's earlier plans close to the parameters being filled in, best match first"""
+    data = request.get_json(silent=True) or {}
+    if not (data.get('subject') or '').strip():
+        return jsonify({"suggestions": []})
+    try:
+        k = min(max(int(data.get('k', 5)), 1), 20)
+    except (TypeError, ValueError):
+        k = 5
+    return jsonify({"suggestions": suggestion_index.suggest(data, current_user.id, k=k, min_score=SUGGEST_MIN_SCORE)})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def split_meta(payload):
+    # Outline bookkeeping travels in the 'done' event rather than as sections
+    return {name: payload.pop(name) for name in ('plan_id', 'pending_sections') if name in payload}
+
+async def generation_events(data):
+    """SSE events for /generate/stream: a cached plan, one coalesced with an identical stream, or a fresh one.
+
+    Runs on the background event loop, so a stream waiting on OpenAI holds no
+    thread; the Flask view drives it with aio.iterate, asgi.py without a thread.
+    """
+    try:
+        if not data.get('regenerate'):
+            cached = await asyncio.to_thread(cached_generation, data)
+            if cached is not None:
+                meta = split_meta(cached)
+                for name, value in cached.items():
+                    yield sse_event('section', {"key": name, "value": value})
+                yield sse_event('done', {"cache": "HIT", **meta})
+                return
+
+        flight = await single_flight.begin_async(generation_key(data))
+        try:
+            if not flight.leader:
+                # Same plan is already being generated: replay its result when it lands
+                shared = dict(await flight.wait_async())
+                meta = split_meta(shared)
+                for name, value in shared.items():
+                    yield sse_event('section', {"key": name, "value": value})
+                yield sse_event('done', {"cache": "COALESCED", **meta})
+                return
+            async for event in stream_generation(data, flight):
+                yield event
+        finally:
+            if flight.leader:
+                await asyncio.to_thread(flight.close)
+    except LimiterBusyError as e:
+        yield sse_event('error', {"error": "Too many plans are being generated. Please try again shortly.",
+                                  "retry_after": e.retry_after})
+    except Exception as e:
+        logger.error("Streaming generation error: %s", e)
+        yield sse_event('error', {"error": str(e)})
+
+async def stream_generation(data, flight):
+    """Stream a fresh generation and hand its result to any coalesced followers"""
+    messages, response_format = generation_call(data)
+    parser = TopLevelJSONStream()
+    plan = {}
+    usage = None
+    # The router holds a limiter slot until the last chunk has arrived
+    model, stream = await router.stream_async(
+        'outline' if is_outline(data) else 'plan',
+        messages=messages,
+        response_format=response_format,
+        stream_options={"include_usage": True}
+    )
+
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage = record_usage(chunk.usage, data, model)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            for name, value in parser.feed(delta):
+                plan[name] = value
+                yield sse_event('section', {"key": name, "value": value})
+    finally:
+        await stream.aclose()
+
+    if not parser.done:
+        raise ValueError("Incomplete response from model")
+    payload = await asyncio.to_thread(store_generation, data, plan, model)
+    await asyncio.to_thread(flight.finish, payload)
+    meta = split_meta(dict(payload))
+    yield sse_event('done', {"cache": "MISS", "usage": usage, "model": model, **meta})
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_lesson_stream():
+    """Stream the plan as Server-Sent Events, one event per completed top-level key"""
+    data = request.json or {}
+    error = template_error(data)
+    if error:
+        return jsonify({"error": error}), 400
+    if openai_limiter.saturated():
+        return queue_full_response("Too many plans are being generated. Please try again shortly.", openai_limiter.retry_after())
+
+    response = Response(stream_with_context(aio.iterate(generation_events(with_owner(data)))),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.errorhandler(LimiterBusyError)
+def limiter_busy(e):
+    return queue_full_response("Too many plans are being generated. Please try again shortly.", e.retry_after)
+
+@app.route('/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+@login_required
+@admin_required
+def profiler_control():
+    """Start (POST {"route", "seconds", "interval_ms"}), stop (DELETE) or inspect the sampling profiler"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        route = data.get('route')
+        if route not in {rule.rule for rule in app.url_map.iter_rules()}:
+            return jsonify({"error": "Unknown route; use the URL rule, e.g. /history/<int:plan_id>"}), 400
+        try:
+            seconds = min(float(data.get('seconds', 60)), PROFILE_MAX_SECONDS)
+            interval = max(float(data.get('interval_ms', 10)), 1.0) / 1000
+        except (TypeError, ValueError):
+            return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+        return jsonify(tracing.profiler.enable(route, seconds, interval))
+    if request.method == 'DELETE':
+        tracing.profiler.disable()
+    return jsonify({
+        "active": tracing.profiler.config(),
+        "files": [url_for('profiler_file', name=name) for name in tracing.profiler.files()],
+    })
+
+@app.route('/admin/profiler/<name>')
+@login_required
+@admin_required
+def profiler_file(name):
+    """A collapsed-stack file, for flamegraph.pl or speedscope"""
+    return send_from_directory(tracing.profiler.output_dir, name, mimetype='text/plain')
+
+@app.route('/upstreams/stats')
+@login_required
+def upstream_stats():
+    return jsonify(transport.stats())
+
+@app.route('/generate/stats')
+@login_required
+def generation_stats():
+    with usage_lock:
+        usage = dict(usage_totals)
+    return jsonify({
+        "cache": generation_cache.stats(),
+        "jobs": job_queue.stats(),
+        "coalescing": single_flight.stats(),
+        "limiter": openai_limiter.stats(),
+        "routing": router.stats(),
+        "suggestions": suggestion_index.stats(),
+        "logging": {"dropped": logging_config.dropped_records()},
+        "usage": usage,
+    })
+
+BATCH_FIELDS = ('template', 'subtemplate', 'subject', 'grade', 'duration', 'objectives')
+
+def read_batch_rows():
+    """Rows from a JSON {"rows": [...]} body or an uploaded CSV with a header line"""
+    upload = request.files.get('file')
+    if upload:
+        text = upload.read().decode('utf-8-sig')
+        return [
+            {field: (row.get(field) or '').strip() for field in BATCH_FIELDS}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+    data = request.get_json(silent=True) or {}
+    rows = data.get('rows')
+    if not isinstance(rows, list):
+        raise ValueError("Expected a 'rows' list or a CSV file upload")
+    return [
+        {field: str(row.get(field) or '') for field in BATCH_FIELDS}
+        for row in rows if isinstance(row, dict)
+    ]
+
+async def generate_batch_async(rows, regenerate, owner=None, job_id=None):
+    job_id = job_id or job_queue.current_job_id()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    statuses = ['queued'] * len(rows)
+    results = [None] * len(rows)
+
+    def report():
+        job_queue.report_progress({
+            "total": len(rows),
+            "completed": sum(status in ('succeeded', 'failed') for status in statuses),
+            "failed": statuses.count('failed'),
+            "rows": statuses,
+        }, job_id=job_id)
+
+    async def run_row(index, row):
+        # Each row runs in its own task; its usage reports must not replace the batch's progress
+        job_queue.detach()
+        async with semaphore:
+            statuses[index] = 'running'
+            try:
+                error = template_error(row)
+                if error:
+                    raise ValueError(error)
+                plan = await generate_plan_async({**row, "regenerate": regenerate, "owner": owner})
+                statuses[index] = 'succeeded'
+                results[index] = {"row": index, "status": "succeeded", "params": row, "plan": plan}
+            except Exception as e:
+                logger.warning("Batch row %s failed: %s", index, e)
+                statuses[index] = 'failed'
+                results[index] = {"row": index, "status": "failed", "params": row, "error": str(e)}
+        await asyncio.to_thread(report)
+
+    await asyncio.to_thread(report)
+    await asyncio.gather(*(run_row(index, row) for index, row in enumerate(rows)))
+    return {
+        "total": len(rows),
+        "succeeded": statuses.count('succeeded'),
+        "failed": statuses.count('failed'),
+        "results": results,
+    }
+
+def generate_batch(rows, regenerate=False, owner=None):
+    """Generate many plans concurrently; one row failing doesn't affect the others"""
+    return aio.run(generate_batch_async(rows, regenerate, owner, job_queue.current_job_id()))
+
+@app.route('/generate/batch', methods=['POST'])
+@login_required
+def generate_lesson_batch():
+    try:
+        rows = read_batch_rows()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not rows:
+        return jsonify({"error": "No rows to generate"}), 400
+    if len(rows) > BATCH_MAX_ROWS:
+        return jsonify({"error": f"A batch can contain at most {BATCH_MAX_ROWS} rows"}), 400
+
+    regenerate = bool((request.get_json(silent=True) or {}).get('regenerate') or request.form.get('regenerate'))
+    if openai_limiter.saturated():
+        return queue_full_response("Too many plans are being generated. Please try again shortly.", openai_limiter.retry_after())
+    try:
+        job_id = submit_generation('batch', generate_batch, generate_batch_async, rows, regenerate, current_user.id)
+        return job_accepted(job_id)
+    except QueueFullError:
+        return queue_full_response("Too many plans are being generated. Please try again shortly.")
+
+def resources_messages(prompt):
+    return [{
+        "role": "user",
+        "content": f"{prompt}\nRespond in JSON format with two arrays: 'videos' and 'worksheets'"
+    }]
+
+def find_resources(prompt):
+    """Ask OpenAI for videos and worksheets matching the prompt"""
+    response, _ = router.complete(
+        'resources', messages=resources_messages(prompt), response_format={"type": "json_object"})
+    return json.loads(response.choices[0].message.content)
+
+async def find_resources_async(prompt):
+    response, _ = await router.complete_async(
+        'resources', messages=resources_messages(prompt), response_format={"type": "json_object"})
+    return json.loads(response.choices[0].message.content)
+
 @app.route('/generate_resources', methods=['POST'])
+@login_required
 def generate_resources():
     try:
         data = request.json
         prompt = data.get('prompt', '')
 
-        response = openai.chat.completions.create(
-            model="gpt-4o", 
-            messages=[{
-                "role": "user",
-                "content": f"{prompt}\nRespond in JSON format with two arrays: 'videos' and 'worksheets'"
-            }],
-            response_format={"type": "json_object"}
-        )
-
-        resources = json.loads(response.choices[0].message.content)
-        return jsonify(resources)
+        if openai_limiter.saturated():
+            return queue_full_response("Too many requests are being processed. Please try again shortly.",
+                                       openai_limiter.retry_after())
+        job_id = submit_generation('resources', find_resources, find_resources_async, prompt)
+        return job_accepted(job_id)
+    except QueueFullError:
+        return queue_full_response("Too many requests are being processed. Please try again shortly.")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -436,7 +1317,14 @@ LESSON_TEMPLATES = {
     }
 }
 
+# template -> names of its subtemplates
+SUBTEMPLATES = {
+    template: frozenset(name for names in spec['subtemplates'].values() for name in names)
+    for template, spec in LESSON_TEMPLATES.items()
+}
+
 if __name__ == '__main__':
+    init_db()
     # Check if running in Cloudflare Pages environment
     if os.environ.get('CF_PAGES'):
         # Cloudflare Pages specific configuration
@@ -0,0 +1,138 @@
+"""ASGI entry point: generations wait on OpenAI without holding a thread.
+
+    flask --app app init-db
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 1 --timeout-keep-alive 30 \\
+        --limit-concurrency 2000 --no-access-log
+
+Generation jobs (/generate, /generate/section, /generate/batch,
+/generate_resources) run as coroutines on the app's event loop and
+POST /generate/stream is served here directly, so each open generation
+costs a coroutine rather than a thread. Everything else (pages, auth,
+Stripe, job polling) goes to the Flask app on WSGI_THREADS threads, and so
+do streams whose session is signed out or needs refreshing.
+
+One worker then holds hundreds of concurrent generations; the OpenAI limiter
+and job queue are what bound it, so raise them to match, e.g.
+
+    OPENAI_CONCURRENCY=64 OPENAI_MAX_CONCURRENCY=256 OPENAI_QUEUE_SIZE=1000 JOB_QUEUE_SIZE=1000
+
+With more than one worker set PROMETHEUS_MULTIPROC_DIR (and clear it between
+runs) as gunicorn.conf.py does. ``python bench/run.py --server uvicorn``
+benchmarks this configuration.
+"""
+import os
+
+# Read by app at import time
+os.environ.setdefault('ASYNC_JOBS', '1')
+
+import json
+import time
+import asyncio
+from a2wsgi import WSGIMiddleware
+from flask import session
+import aio
+import metrics
+from app import app as flask_app, generation_events, load_user, openai_limiter, template_error
+
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 32))
+
+STREAM_ROUTE = '/generate/stream'
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+
+async def read_body(receive):
+    """The request body, or None if the client went away first"""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def replay(body: bytes, receive):
+    """``receive`` for a request whose body has already been read"""
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive_again():
+        return pending.pop() if pending else await receive()
+
+    return receive_again
+
+
+def session_owner(scope):
+    """Id of the user signed in on the request's session cookie.
+
+    None when nobody is, or when their access token has expired: only Flask
+    can send the refreshed session back, so those requests go to Flask.
+    """
+    cookies = [value.decode('latin-1') for name, value in scope['headers'] if name == b'cookie']
+    if not cookies:
+        return None
+    with flask_app.test_request_context(STREAM_ROUTE, method='POST', headers={'Cookie': '; '.join(cookies)}):
+        user_id = session.get('_user_id')
+        user = load_user(user_id, refresh=False) if user_id else None
+        return user.id if user else None
+
+
+async def until_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_events(data, send):
+    async for event in aio.aiterate(generation_events(data)):
+        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def stream_generation(scope, receive, send):
+    """POST /generate/stream as a coroutine; requests Flask would turn away are left to Flask"""
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body or b'null')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or template_error(data) or openai_limiter.saturated():
+        return await wsgi(scope, replay(body, receive), send)
+    owner = await asyncio.to_thread(session_owner, scope)
+    if owner is None:
+        return await wsgi(scope, replay(body, receive), send)
+    data = {**data, 'owner': owner}
+
+    start = time.perf_counter()
+    metrics.http_in_flight.inc()
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        metrics.http_requests.labels('POST', STREAM_ROUTE, '200').inc()
+        metrics.http_request_duration.labels('POST', STREAM_ROUTE).observe(time.perf_counter() - start)
+
+        # A client that disconnects cancels the generation (and frees its OpenAI slot)
+        events = asyncio.ensure_future(send_events(data, send))
+        disconnect = asyncio.ensure_future(until_disconnect(receive))
+        try:
+            await asyncio.wait({events, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            events.cancel()
+            disconnect.cancel()
+            await asyncio.gather(events, disconnect, return_exceptions=True)
+        if not events.cancelled():
+            events.result()
+    finally:
+        metrics.http_in_flight.dec()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == STREAM_ROUTE:
+        return await stream_generation(scope, receive, send)
+    return await wsgi(scope, receive, send)
@@ -1,11 +1,121 @@
 import os
+import time
+import hashlib
 import logging
-from supabase import create_client, Client
+import threading
+import jwt
 from flask import session
 from flask_login import UserMixin
+from transport import transport
+import metrics
+
+try:
+    from supabase_auth import SyncGoTrueClient
+except ImportError:  # supabase < 2.14 ships the auth client as gotrue
+    from gotrue import SyncGoTrueClient
 
 logger = logging.getLogger(__name__)
 
+# Algorithms Supabase signs access tokens with: the legacy shared secret or a project signing key
+SHARED_SECRET_ALGORITHMS = ('HS256',)
+SIGNING_KEY_ALGORITHMS = ('RS256', 'ES256')
+# Clock skew tolerated on exp/iat, seconds
+JWT_LEEWAY = 30
+# How long a refresh's result is handed to other requests presenting the same refresh token
+REFRESH_REUSE_SECONDS = 60
+
+class TokenError(Exception):
+    """Raised when an access token is malformed, not signed by the project or otherwise invalid"""
+
+class TokenExpiredError(TokenError):
+    """Raised when an access token was valid but has expired; refresh the session"""
+
+class KeyUnavailableError(TokenError):
+    """Raised when there is no local key to check a token with"""
+
+def session_tokens(auth_session) -> dict:
+    """The part of a Supabase session the app keeps: its tokens and the access token's expiry"""
+    data = auth_session.model_dump() if hasattr(auth_session, 'model_dump') else (auth_session or {})
+    if not data.get('access_token') or not data.get('refresh_token'):
+        raise TokenError("Supabase returned no session")
+    return {
+        'access_token': data['access_token'],
+        'refresh_token': data['refresh_token'],
+        'expires_at': data.get('expires_at'),
+    }
+
+class TokenVerifier:
+    """Checks Supabase access tokens without calling Supabase.
+
+    HS256 tokens are checked against the project's JWT secret; tokens signed
+    with an asymmetric key against the project's JWKS, fetched over the
+    shared pool and cached for ``jwks_ttl`` seconds. An unknown key id (a
+    rotated key) refetches the JWKS early, at most every 30 seconds.
+    """
+
+    def __init__(self, auth_url: str, headers: dict = None, secret: str = None, jwks_ttl: float = 600,
+                 audience: str = 'authenticated'):
+        self.jwks_url = f"{auth_url.rstrip('/')}/.well-known/jwks.json"
+        self.headers = headers or {}
+        self.secret = secret
+        self.jwks_ttl = jwks_ttl
+        self.audience = audience
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def verify(self, token: str) -> dict:
+        """The token's claims if it is valid"""
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            raise TokenError(f"Malformed access token: {e}")
+        algorithm = header.get('alg')
+        if algorithm in SHARED_SECRET_ALGORITHMS:
+            if not self.secret:
+                raise KeyUnavailableError("SUPABASE_JWT_SECRET is not set")
+            key = self.secret
+        elif algorithm in SIGNING_KEY_ALGORITHMS:
+            key = self._signing_key(header.get('kid'))
+        else:
+            raise TokenError(f"Unsupported access token algorithm: {algorithm}")
+
+        try:
+            return jwt.decode(token, key, algorithms=[algorithm], audience=self.audience, leeway=JWT_LEEWAY,
+                              options={'require': ['exp', 'sub']})
+        except jwt.ExpiredSignatureError:
+            raise TokenExpiredError("Access token has expired")
+        except jwt.PyJWTError as e:
+            raise TokenError(f"Invalid access token: {e}")
+
+    def _signing_key(self, kid: str):
+        with self._lock:
+            age = time.monotonic() - self._fetched_at if self._fetched_at is not None else None
+            stale = age is None or age >= self.jwks_ttl
+            if stale or (kid not in self._keys and age >= 30):
+                self._fetch()
+            key = self._keys.get(kid)
+        if key is None:
+            raise TokenError(f"Access token signed with unknown key {kid}")
+        return key
+
+    def _fetch(self):
+        # Called with the lock held: one fetch at a time, the others wait for its keys
+        try:
+            with metrics.track('supabase', 'jwks'):
+                response = transport.client('supabase').get(self.jwks_url, headers=self.headers)
+                response.raise_for_status()
+                jwks = jwt.PyJWKSet.from_dict(response.json())
+        except Exception as e:
+            if not self._keys:
+                raise KeyUnavailableError(f"Could not fetch the Supabase JWKS: {e}")
+            # Keep using the keys we have rather than reject every session
+            logger.warning("Could not refresh the Supabase JWKS: %s", e)
+            self._fetched_at = time.monotonic()
+            return
+        self._keys = {key.key_id: key for key in jwks.keys if key.key_id}
+        self._fetched_at = time.monotonic()
+
 class User(UserMixin):
     def __init__(self, user_data):
         self.id = user_data.get('id')
@@ -35,7 +145,7 @@ class SupabaseAuth:
 
         # Validate URL format
         if not url.startswith(('http://', 'https://')):
-            logger.error(f"Invalid Supabase URL format: {url[:10]}...")
+            logger.error("Invalid Supabase URL format: %s...", url[:10])
             raise ValueError("Supabase URL must start with http:// or https://")
 
         # Validate key format (Supabase keys typically start with 'eyJ')
@@ -43,29 +153,50 @@ class SupabaseAuth:
             logger.error("Invalid Supabase key format")
             raise ValueError("Invalid Supabase key format. Make sure you're using the project's anon/public key")
 
-        logger.info("Initializing Supabase client")
-        try:
-            self.supabase: Client = create_client(url, key)
-            logger.info("Supabase client initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize Supabase client: {str(e)}")
-            raise Exception(f"Failed to initialize Supabase client: {str(e)}")
+        self.url = f"{url.rstrip('/')}/auth/v1"
+        self.headers = {"apiKey": key, "Authorization": f"Bearer {key}"}
+        self.verifier = TokenVerifier(self.url, headers={"apiKey": key}, secret=os.environ.get('SUPABASE_JWT_SECRET'),
+                                      jwks_ttl=float(os.environ.get('SUPABASE_JWKS_TTL', 600)))
+        if not self.verifier.secret:
+            logger.warning("SUPABASE_JWT_SECRET is not set; HS256 sessions are checked with Supabase once per token")
+
+        # Guards the maps below: a lock per refresh token being exchanged, recent
+        # exchanges by refresh token, and claims Supabase vouched for by token digest
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._refreshed = {}
+        self._remote_claims = {}
+
+    def _client(self) -> SyncGoTrueClient:
+        """A GoTrue client for one call.
+
+        The client keeps the session it last saw, so sharing one between
+        threads would mix users up; a fresh one per call is cheap because the
+        connections come from the shared pool.
+        """
+        return SyncGoTrueClient(
+            url=self.url,
+            headers=self.headers,
+            http_client=transport.client('supabase'),
+            auto_refresh_token=False,
+            persist_session=False,
+        )
 
     def sign_up(self, email: str, password: str) -> dict:
         try:
-            logger.info(f"Attempting to sign up user: {email}")
-            response = self.supabase.auth.sign_up({
-                "email": email,
-                "password": password
-            })
-            logger.info(f"Sign up response received: {type(response)}")
+            logger.debug("Attempting to sign up user: %s", email)
+            with metrics.track('supabase', 'sign_up'):
+                response = self._client().sign_up({
+                    "email": email,
+                    "password": password
+                })
 
             # Handle response as dictionary
             response_dict = response.model_dump() if hasattr(response, 'model_dump') else response
-            logger.info(f"Response structure: {list(response_dict.keys())}")
+            logger.debug("Sign up response fields: %s", response_dict.keys())
 
             if response_dict.get('error'):
-                logger.error(f"Supabase signup error: {response_dict['error']}")
+                logger.error("Supabase signup error: %s", response_dict['error'])
                 return {"success": False, "error": str(response_dict['error'])}
 
             user_data = response_dict.get('user', {})
@@ -76,25 +207,25 @@ class SupabaseAuth:
             logger.info("User signed up successfully")
             return {"success": True, "user": User(user_data)}
         except Exception as e:
-            logger.error(f"Sign up error: {str(e)}")
+            logger.error("Sign up error: %s", e)
             return {"success": False, "error": str(e)}
 
     def sign_in(self, email: str, password: str) -> dict:
         try:
-            logger.info(f"Attempting to sign in user: {email}")
-            response = self.supabase.auth.sign_in_with_password({
-                "email": email,
-                "password": password
-            })
-            logger.info(f"Sign in response received: {type(response)}")
+            logger.debug("Attempting to sign in user: %s", email)
+            with metrics.track('supabase', 'sign_in'):
+                response = self._client().sign_in_with_password({
+                    "email": email,
+                    "password": password
+                })
 
             # Handle response as dictionary
             response_dict = response.model_dump() if hasattr(response, 'model_dump') else response
-            logger.info(f"Response structure: {list(response_dict.keys())}")
+            logger.debug("Sign in response fields: %s", response_dict.keys())
 
             if response_dict.get('error'):
                 error_msg = str(response_dict['error'])
-                logger.error(f"Supabase login error: {error_msg}")
+                logger.error("Supabase login error: %s", error_msg)
                 return {"success": False, "error": error_msg}
 
             user_data = response_dict.get('user', {})
@@ -111,11 +242,11 @@ class SupabaseAuth:
             return {
                 "success": True, 
                 "user": User(user_data),
-                "session": response_dict.get('session', {})
+                "session": session_tokens(response_dict.get('session'))
             }
         except Exception as e:
             error_msg = str(e)
-            logger.error(f"Sign in error: {error_msg}")
+            logger.error("Sign in error: %s", error_msg)
             
             # Provide more user-friendly error messages
             if "invalid_credentials" in error_msg:
@@ -125,19 +256,86 @@ class SupabaseAuth:
             else:
                 return {"success": False, "error": error_msg}
 
-    def sign_out(self) -> dict:
+    def sign_out(self, access_token: str = None) -> dict:
+        """Revoke the session's refresh tokens; its access token stays valid until it expires"""
+        if not access_token:
+            return {"success": True}
         try:
-            logger.info("Attempting to sign out user")
-            self.supabase.auth.sign_out()
+            logger.debug("Attempting to sign out user")
+            with metrics.track('supabase', 'sign_out'):
+                self._client().admin.sign_out(access_token)
             logger.info("User signed out successfully")
             return {"success": True}
         except Exception as e:
-            logger.error(f"Sign out error: {str(e)}")
+            logger.error("Sign out error: %s", e)
             return {"success": False, "error": str(e)}
 
-    def get_user(self) -> dict:
+    def verify(self, access_token: str) -> dict:
+        """Claims of a valid access token, checked locally (see TokenVerifier).
+
+        Raises TokenExpiredError when the session needs refreshing and
+        TokenError when it can't be trusted.
+        """
+        try:
+            return self.verifier.verify(access_token)
+        except KeyUnavailableError:
+            return self._verify_remotely(access_token)
+
+    def _verify_remotely(self, access_token: str) -> dict:
+        # Without a local key, ask Supabase once per token and trust the answer until the token expires
+        try:
+            claims = jwt.decode(access_token, options={'verify_signature': False})
+        except jwt.PyJWTError as e:
+            raise TokenError(f"Malformed access token: {e}")
+        if claims.get('exp', 0) + JWT_LEEWAY < time.time():
+            raise TokenExpiredError("Access token has expired")
+
+        digest = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+        with self._lock:
+            known = self._remote_claims.get(digest)
+        if known is not None:
+            return known
+
         try:
-            user = self.supabase.auth.get_user()
-            return {"success": True, "user": user}
-        except Exception:
-            return {"success": False, "user": None}
\ No newline at end of file
+            with metrics.track('supabase', 'get_user'):
+                response = self._client().get_user(access_token)
+        except Exception as e:
+            raise TokenError(f"Supabase rejected the access token: {e}")
+        user = getattr(response, 'user', None)
+        if user is None or str(user.id) != claims.get('sub'):
+            raise TokenError("Supabase rejected the access token")
+
+        with self._lock:
+            now = time.time()
+            if len(self._remote_claims) >= 10000:
+                self._remote_claims = {k: c for k, c in self._remote_claims.items() if c.get('exp', 0) > now}
+            self._remote_claims[digest] = claims
+        return claims
+
+    def refresh(self, refresh_token: str) -> dict:
+        """Exchange a refresh token for new session tokens.
+
+        Refresh tokens are single use, so requests arriving together with the
+        same one (a page's parallel fetches) share the first exchange.
+        """
+        with self._lock:
+            lock = self._locks.setdefault(refresh_token, threading.Lock())
+        try:
+            with lock:
+                with self._lock:
+                    recent = self._refreshed.get(refresh_token)
+                if recent and recent[0] > time.monotonic():
+                    return recent[1]
+
+                with metrics.track('supabase', 'refresh'):
+                    response = self._client().refresh_session(refresh_token)
+                tokens = session_tokens(response.session)
+
+                with self._lock:
+                    now = time.monotonic()
+                    self._refreshed = {k: v for k, v in self._refreshed.items() if v[0] > now}
+                    self._refreshed[refresh_token] = (now + REFRESH_REUSE_SECONDS, tokens)
+                return tokens
+        finally:
+            with self._lock:
+                self._locks.pop(refresh_token, None)
@@ -0,0 +1,363 @@
+"""Local stand-ins for the OpenAI, Stripe and Supabase APIs used by the benchmark.
+
+Each fake speaks just enough of its upstream's HTTP API for app.py to run
+end to end, with a configurable latency distribution and error rate so runs
+are repeatable and free.
+"""
+import re
+import json
+import time
+import uuid
+import base64
+import hmac
+import hashlib
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FAKE_JWT_SECRET = 'bench-jwt-secret-long-enough-for-hs256'
+
+
+class Latency:
+    """Latency distribution parsed from a spec such as ``fixed:0.05``,
+    ``uniform:0.01,0.1``, ``normal:0.5,0.1`` or ``lognormal:2.0,0.4``
+    (median and sigma). All values are in seconds."""
+
+    def __init__(self, spec: str = 'fixed:0'):
+        self.spec = spec
+        kind, _, args = spec.partition(':')
+        self.kind = kind
+        self.args = [float(arg) for arg in args.split(',') if arg]
+
+    def sample(self) -> float:
+        if self.kind == 'fixed':
+            return self.args[0] if self.args else 0.0
+        if self.kind == 'uniform':
+            return random.uniform(*self.args)
+        if self.kind == 'normal':
+            return max(0.0, random.gauss(*self.args))
+        if self.kind == 'lognormal':
+            median, sigma = self.args
+            return random.lognormvariate(0, sigma) * median
+        raise ValueError(f"Unknown latency distribution: {self.spec}")
+
+
+class FakeUpstream:
+    """Base class for a fake API served from a background thread"""
+
+    name = 'upstream'
+
+    def __init__(self, latency: str = 'fixed:0', error_rate: float = 0.0, error_status: int = 500):
+        self.latency = Latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, host: str = '127.0.0.1', port: int = 0):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                upstream._dispatch(self, 'GET')
+
+            def do_POST(self):
+                upstream._dispatch(self, 'POST')
+
+            def do_DELETE(self):
+                upstream._dispatch(self, 'DELETE')
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=f'fake-{self.name}', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'errors': self.errors}
+
+    def _dispatch(self, handler, method):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw = handler.rfile.read(length) if length else b''
+        with self._lock:
+            self.requests += 1
+            inject_error = random.random() < self.error_rate
+            if inject_error:
+                self.errors += 1
+
+        time.sleep(self.latency.sample())
+        if inject_error:
+            self.send_json(handler, self.error_status, {'error': {'message': 'Injected failure'}},
+                           headers={'Retry-After': '1'})
+            return
+
+        try:
+            self.handle(handler, method, url.path, parse_qs(url.query), raw)
+        except Exception as e:
+            self.send_json(handler, 500, {'error': {'message': str(e)}})
+
+    def handle(self, handler, method, path, query, body):
+        raise NotImplementedError
+
+    @staticmethod
+    def send_json(handler, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+FAKE_PLAN = {
+    'title': 'Benchmark Lesson',
+    'overview': 'A synthetic lesson plan returned by the benchmark fake.',
+    'overview_summary': ['Synthetic overview.'],
+    'objectives': ['Objective one', 'Objective two', 'Objective three'],
+    'objectives_summary': ['Synthetic objectives.'],
+    'materials': ['Whiteboard', 'Worksheets'],
+    'materials_summary': ['Synthetic materials.'],
+    'procedure': ['Introduce the topic', 'Group activity', 'Wrap up'],
+    'procedure_summary': ['Synthetic procedure.'],
+    'assessment': 'Exit ticket with three questions.',
+    'assessment_summary': ['Synthetic assessment.'],
+    'extensions': ['Homework reading'],
+    'extensions_summary': ['Synthetic extensions.'],
+}
+
+FAKE_RESOURCES = {
+    'videos': [{'title': 'Intro video', 'url': 'https://example.com/video'}],
+    'worksheets': [{'title': 'Practice sheet', 'url': 'https://example.com/worksheet'}],
+}
+
+
+class FakeOpenAI(FakeUpstream):
+    """``POST /v1/chat/completions``, including ``stream=True``"""
+
+    name = 'openai'
+
+    def __init__(self, stream_chunks: int = 40, **kwargs):
+        super().__init__(**kwargs)
+        self.stream_chunks = stream_chunks
+
+    def _content(self, request) -> str:
+        prompt = ' '.join(str(message.get('content', '')) for message in request.get('messages', []))
+        if "'videos'" in prompt:
+            return json.dumps(FAKE_RESOURCES)
+        return json.dumps(FAKE_PLAN)
+
+    def handle(self, handler, method, path, query, body):
+        if method != 'POST' or not path.endswith('/chat/completions'):
+            self.send_json(handler, 404, {'error': {'message': 'Not found'}})
+            return
+
+        request = json.loads(body or b'{}')
+        content = self._content(request)
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        created = int(time.time())
+        model = request.get('model', 'gpt-4o')
+        usage = {
+            'prompt_tokens': 400,
+            'completion_tokens': len(content) // 4,
+            'total_tokens': 400 + len(content) // 4,
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+
+        if not request.get('stream'):
+            self.send_json(handler, 200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            })
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        size = max(1, len(content) // self.stream_chunks)
+        for start in range(0, len(content), size):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': content[start:start + size]}, 'finish_reason': None}],
+            }
+            handler.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            handler.wfile.flush()
+            time.sleep(0.005)
+        handler.wfile.write(b'data: [DONE]\n\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+
+
+class FakeStripe(FakeUpstream):
+    """Customers, subscriptions, prices and checkout sessions"""
+
+    name = 'stripe'
+
+    def __init__(self, subscribed: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.subscribed = subscribed
+
+    @staticmethod
+    def _list(url, data):
+        return {'object': 'list', 'url': url, 'has_more': False, 'data': data}
+
+    @staticmethod
+    def _customer_id(email: str) -> str:
+        return 'cus_' + hashlib.sha1(email.encode('utf-8')).hexdigest()[:14]
+
+    def handle(self, handler, method, path, query, body):
+        form = parse_qs(body.decode('utf-8')) if body else {}
+        if path == '/v1/customers' and method == 'GET':
+            email = query.get('email', [''])[0]
+            customers = [{'id': self._customer_id(email), 'object': 'customer', 'email': email}] if email else []
+            self.send_json(handler, 200, self._list(path, customers))
+        elif path == '/v1/customers' and method == 'POST':
+            email = form.get('email', [''])[0]
+            self.send_json(handler, 200, {'id': self._customer_id(email), 'object': 'customer', 'email': email})
+        elif path == '/v1/subscriptions' and method == 'GET':
+            customer = query.get('customer', ['cus_bench'])[0]
+            subscriptions = [{
+                'id': 'sub_' + customer[4:],
+                'object': 'subscription',
+                'customer': customer,
+                'status': 'active',
+                'current_period_end': int(time.time()) + 30 * 24 * 3600,
+            }] if self.subscribed else []
+            self.send_json(handler, 200, self._list(path, subscriptions))
+        elif re.match(r'^/v1/prices/[^/]+$', path):
+            self.send_json(handler, 200, {
+                'id': path.rsplit('/', 1)[1],
+                'object': 'price',
+                'unit_amount': 500,
+                'currency': 'usd',
+                'recurring': {'interval': 'month'},
+            })
+        elif path == '/v1/checkout/sessions' and method == 'POST':
+            session_id = f'cs_{uuid.uuid4().hex}'
+            self.send_json(handler, 200, {
+                'id': session_id,
+                'object': 'checkout.session',
+                'url': f'https://checkout.example.com/{session_id}',
+            })
+        else:
+            self.send_json(handler, 404, {'error': {'message': f'No such route: {path}'}})
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def fake_jwt(claims: dict, secret: str = FAKE_JWT_SECRET) -> str:
+    """HS256 token shaped like a Supabase access token"""
+    header = _b64(json.dumps({'alg': 'HS256', 'typ': 'JWT'}).encode('utf-8'))
+    payload = _b64(json.dumps(claims).encode('utf-8'))
+    signature = hmac.new(secret.encode('utf-8'), f'{header}.{payload}'.encode('ascii'), hashlib.sha256).digest()
+    return f'{header}.{payload}.{_b64(signature)}'
+
+
+class FakeSupabase(FakeUpstream):
+    """Password sign-in, sign-up, refresh, logout and user lookup under ``/auth/v1``"""
+
+    name = 'supabase'
+
+    def __init__(self, jwt_secret: str = FAKE_JWT_SECRET, **kwargs):
+        super().__init__(**kwargs)
+        self.jwt_secret = jwt_secret
+        # Refresh token -> user it was issued to. Tokens stay valid after use, as within
+        # Supabase's reuse interval, so workers refreshing the same session don't log it out
+        self._refresh_tokens = {}
+        self._refresh_lock = threading.Lock()
+
+    @staticmethod
+    def _user(email: str) -> dict:
+        return {
+            'id': str(uuid.uuid5(uuid.NAMESPACE_URL, email)),
+            'aud': 'authenticated',
+            'role': 'authenticated',
+            'email': email,
+            'app_metadata': {'provider': 'email'},
+            'user_metadata': {},
+            'created_at': '2024-01-01T00:00:00Z',
+        }
+
+    def _session(self, user: dict) -> dict:
+        now = int(time.time())
+        access_token = fake_jwt({
+            'sub': user['id'],
+            'email': user['email'],
+            'aud': 'authenticated',
+            'role': 'authenticated',
+            'iat': now,
+            'exp': now + 3600,
+        }, self.jwt_secret)
+        refresh_token = uuid.uuid4().hex
+        with self._refresh_lock:
+            self._refresh_tokens[refresh_token] = user
+        return {
+            'access_token': access_token,
+            'token_type': 'bearer',
+            'expires_in': 3600,
+            'expires_at': now + 3600,
+            'refresh_token': refresh_token,
+            'user': user,
+        }
+
+    def handle(self, handler, method, path, query, body):
+        request = json.loads(body or b'{}') if body else {}
+        if path == '/auth/v1/token' and method == 'POST':
+            grant_type = query.get('grant_type', [''])[0]
+            if grant_type == 'password':
+                user = self._user(request.get('email', ''))
+            elif grant_type == 'refresh_token':
+                with self._refresh_lock:
+                    user = self._refresh_tokens.get(request.get('refresh_token'))
+                if user is None:
+                    self.send_json(handler, 400, {'error': 'invalid_grant',
+                                                  'error_description': 'Invalid Refresh Token: Refresh Token Not Found'})
+                    return
+            else:
+                self.send_json(handler, 400, {'error': 'unsupported_grant_type'})
+                return
+            self.send_json(handler, 200, self._session(user))
+        elif path == '/auth/v1/signup' and method == 'POST':
+            self.send_json(handler, 200, self._user(request.get('email', '')))
+        elif path == '/auth/v1/logout' and method == 'POST':
+            handler.send_response(204)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+        elif path == '/auth/v1/user' and method == 'GET':
+            self.send_json(handler, 200, self._user('bench@example.com'))
+        else:
+            self.send_json(handler, 404, {'error': f'No such route: {path}'})
@@ -0,0 +1,456 @@
+"""Load-testing harness for app.py against local OpenAI, Stripe and Supabase fakes.
+
+Starts the fakes, launches the app pointed at them (or targets one already
+running), drives a weighted mix of routes from concurrent virtual users and
+writes RPS and p50/p95/p99 latency per route to a JSON file.
+
+    python -m bench.run --duration 30 --concurrency 20
+    python -m bench.run --server gunicorn --workers 2 --threads 8 \\
+        --openai-latency lognormal:2.0,0.4 --mix "/:2,/app:3,/generate:2"
+
+Concurrent generations per GB of server memory, threads vs the ASGI entry
+point (asgi.py) with one worker and the OpenAI limits raised:
+
+    python -m bench.run --server gunicorn --workers 4 --threads 8 --concurrency 300 \\
+        --openai-latency lognormal:8.0,0.3 --mix "/generate/stream:1,/generate:1"
+    OPENAI_CONCURRENCY=64 OPENAI_MAX_CONCURRENCY=256 OPENAI_QUEUE_SIZE=1000 JOB_QUEUE_SIZE=1000 \\
+        python -m bench.run --server uvicorn --workers 1 --concurrency 300 \\
+        --openai-latency lognormal:8.0,0.3 --mix "/generate/stream:1,/generate:1"
+
+``server_memory`` in the results holds the server's peak resident memory
+(all of its processes, sampled from /proc) and concurrency per GB of it.
+
+Compare runs with ``python -m bench.run --compare old.json new.json``.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import httpx
+
+from bench.fakes import FakeOpenAI, FakeStripe, FakeSupabase, FAKE_JWT_SECRET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+DEFAULT_MIX = '/:2,/app:3,/login:1,/generate:2,/generate_resources:1'
+SUBJECTS = ['Photosynthesis', 'Fractions', 'The water cycle', 'World War I', 'Poetry', 'Electric circuits']
+
+ADMIN_EMAIL = 'admin@bench.local'
+ADMIN_PASSWORD = 'bench-admin'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def parse_mix(spec: str) -> list:
+    mix = []
+    for item in spec.split(','):
+        route, _, weight = item.strip().rpartition(':')
+        mix.append((route, float(weight)))
+    return mix
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+class Recorder:
+    """Thread-safe latency samples per route"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, elapsed: float) -> dict:
+        with self._lock:
+            routes = {}
+            for route, samples in sorted(self.samples.items()):
+                routes[route] = {
+                    'count': len(samples),
+                    'errors': self.errors.get(route, 0),
+                    'rps': round(len(samples) / elapsed, 2),
+                    'p50_ms': round(percentile(samples, 0.50) * 1000, 1),
+                    'p95_ms': round(percentile(samples, 0.95) * 1000, 1),
+                    'p99_ms': round(percentile(samples, 0.99) * 1000, 1),
+                    'max_ms': round(max(samples) * 1000, 1),
+                }
+            return routes
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident bytes of ``pid`` and all its descendants, from /proc (0 where there is none)"""
+    parents, rss = {}, {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    try:
+        entries = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Fields after the parenthesised command name: state, ppid, ... rss is the 22nd
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents[int(entry)] = int(fields[1])
+        rss[int(entry)] = int(fields[21]) * page_size
+    tree, frontier = set(), {pid}
+    while frontier:
+        tree |= frontier
+        frontier = {child for child, parent in parents.items() if parent in frontier and child not in tree}
+    return sum(rss.get(member, 0) for member in tree)
+
+
+class MemorySampler:
+    """Peak resident memory of the server process tree during the run"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+
+class VirtualUser:
+    """One teacher with their own cookie session"""
+
+    def __init__(self, base_url: str, recorder: Recorder, args):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.args = args
+        self.client = httpx.Client(base_url=base_url, timeout=args.timeout, follow_redirects=False)
+        self.email = f'teacher-{uuid.uuid4().hex[:8]}@bench.local'
+
+    def timed(self, route: str, method: str, path: str, ok_statuses=(200, 202, 302, 303), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.client.request(method, path, **kwargs)
+            ok = response.status_code in ok_statuses
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+        return response
+
+    def login(self, client=None, record=True):
+        client = client or self.client
+        if self.args.admin:
+            data = {'email': ADMIN_EMAIL, 'password': ADMIN_PASSWORD}
+        else:
+            data = {'email': self.email, 'password': 'bench-password'}
+        start = time.perf_counter()
+        try:
+            response = client.post('/login', data=data)
+            ok = response.status_code in (302, 303)
+        except httpx.HTTPError:
+            ok = False
+        if record:
+            self.recorder.record('/login', time.perf_counter() - start, ok)
+
+    def generation_params(self) -> dict:
+        subject = random.choice(SUBJECTS)
+        if random.random() >= self.args.cache_hit_ratio:
+            subject = f'{subject} {uuid.uuid4().hex[:6]}'
+        return {
+            'template': 'lesson',
+            'subtemplate': "5 E's Lesson Plan",
+            'subject': subject,
+            'grade': str(random.randint(1, 12)),
+            'duration': '45',
+            'objectives': '',
+        }
+
+    def wait_for_job(self, route: str, response, started: float):
+        """Poll a 202 job to completion and record the end-to-end latency"""
+        if response is None or response.status_code != 202:
+            return
+        status_url = response.json().get('status_url')
+        ok = False
+        while time.perf_counter() - started < self.args.timeout:
+            time.sleep(self.args.poll_interval)
+            try:
+                job = self.client.get(status_url).json()
+            except (httpx.HTTPError, ValueError):
+                break
+            if job.get('status') in ('succeeded', 'failed'):
+                ok = job['status'] == 'succeeded'
+                break
+        self.recorder.record(f'{route} (job)', time.perf_counter() - started, ok)
+
+    def hit(self, route: str):
+        if route == '/login':
+            with httpx.Client(base_url=self.base_url, timeout=self.args.timeout) as client:
+                self.login(client)
+        elif route == '/generate':
+            started = time.perf_counter()
+            response = self.timed(route, 'POST', '/generate', json=self.generation_params())
+            self.wait_for_job(route, response, started)
+        elif route == '/generate/stream':
+            start = time.perf_counter()
+            ok = False
+            try:
+                with self.client.stream('POST', '/generate/stream', json=self.generation_params()) as response:
+                    for line in response.iter_lines():
+                        if line.startswith('event: done'):
+                            ok = True
+                        elif line.startswith('event: error'):
+                            break
+            except httpx.HTTPError:
+                pass
+            self.recorder.record(route, time.perf_counter() - start, ok)
+        elif route == '/generate_resources':
+            started = time.perf_counter()
+            prompt = f'Find resources about {random.choice(SUBJECTS)}'
+            response = self.timed(route, 'POST', '/generate_resources', json={'prompt': prompt})
+            self.wait_for_job(route, response, started)
+        else:
+            self.timed(route, 'GET', route)
+
+    def run(self, mix, deadline: float):
+        self.login(record=False)
+        routes, weights = zip(*mix)
+        while time.perf_counter() < deadline:
+            self.hit(random.choices(routes, weights)[0])
+            if self.args.think_time:
+                time.sleep(random.expovariate(1 / self.args.think_time))
+        self.client.close()
+
+
+def start_fakes(args):
+    openai = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate,
+                        error_status=args.openai_error_status).start()
+    stripe = FakeStripe(latency=args.stripe_latency, error_rate=args.stripe_error_rate).start()
+    supabase = FakeSupabase(latency=args.supabase_latency, error_rate=args.supabase_error_rate).start()
+    return {'openai': openai, 'stripe': stripe, 'supabase': supabase}
+
+
+def app_environment(fakes, data_dir: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'SESSION_SECRET': 'bench-session-secret',
+        'OPENAI_API_KEY': 'sk-bench',
+        'OPENAI_BASE_URL': f"{fakes['openai'].url}/v1",
+        'STRIPE_SECRET_KEY': 'sk_test_bench',
+        'STRIPE_API_BASE': fakes['stripe'].url,
+        'STRIPE_PRICE_ID': 'price_bench',
+        'STRIPE_WEBHOOK_SECRET': 'whsec_bench',
+        'SUPABASE_URL': fakes['supabase'].url,
+        'SUPABASE_KEY': 'eyJbench',
+        'SUPABASE_JWT_SECRET': FAKE_JWT_SECRET,
+        'DEMO_ADMIN_EMAIL': ADMIN_EMAIL,
+        'DEMO_ADMIN_PASSWORD': ADMIN_PASSWORD,
+        'DATA_DIR': data_dir,
+    })
+    return env
+
+
+def server_command(args, port: int) -> list:
+    if args.server == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+                '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app']
+    if args.server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(args.workers),
+                '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    return [sys.executable, '-c',
+            f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+
+
+def wait_until_ready(base_url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'{base_url}/readyz', timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'App at {base_url} did not become ready within {timeout:.0f}s')
+
+
+def run(args) -> dict:
+    fakes = start_fakes(args)
+    process = None
+    data_dir = tempfile.mkdtemp(prefix='bench-data-')
+    try:
+        if args.app_url:
+            base_url = args.app_url.rstrip('/')
+        else:
+            port = free_port()
+            base_url = f'http://127.0.0.1:{port}'
+            env = app_environment(fakes, data_dir)
+            subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=ROOT, env=env,
+                           check=True, stdout=subprocess.DEVNULL)
+            process = subprocess.Popen(server_command(args, port), cwd=ROOT, env=env)
+        wait_until_ready(base_url)
+
+        mix = parse_mix(args.mix)
+        if args.warmup:
+            warmup = Recorder()
+            deadline = time.perf_counter() + args.warmup
+            users = [VirtualUser(base_url, warmup, args) for _ in range(args.concurrency)]
+            threads = [threading.Thread(target=user.run, args=(mix, deadline)) for user in users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        memory = MemorySampler(process.pid).start() if process else None
+        recorder = Recorder()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        users = [VirtualUser(base_url, recorder, args) for _ in range(args.concurrency)]
+        threads = [threading.Thread(target=user.run, args=(mix, deadline)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        peak_rss = memory.stop() if memory else 0
+
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'config': {
+                'server': 'external' if args.app_url else args.server,
+                'workers': args.workers,
+                'threads': args.threads,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'mix': args.mix,
+                'cache_hit_ratio': args.cache_hit_ratio,
+                'openai_latency': args.openai_latency,
+                'stripe_latency': args.stripe_latency,
+                'supabase_latency': args.supabase_latency,
+                'error_rates': {
+                    'openai': args.openai_error_rate,
+                    'stripe': args.stripe_error_rate,
+                    'supabase': args.supabase_error_rate,
+                },
+            },
+            'elapsed': round(elapsed, 2),
+            'routes': recorder.summary(elapsed),
+            'upstream_requests': {name: fake.stats() for name, fake in fakes.items()},
+            'server_memory': {
+                'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+                'concurrency_per_gb': round(args.concurrency / (peak_rss / 2 ** 30), 1),
+            } if peak_rss else None,
+        }
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for fake in fakes.values():
+            fake.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'route':<28}{'rps':>18}{'p50 ms':>22}{'p99 ms':>22}")
+    for route in sorted(set(old['routes']) | set(new['routes'])):
+        before = old['routes'].get(route, {})
+        after = new['routes'].get(route, {})
+        cells = [f"{before.get(key, '-')} -> {after.get(key, '-')}" for key in ('rps', 'p50_ms', 'p99_ms')]
+        print(f'{route:<28}{cells[0]:>18}{cells[1]:>22}{cells[2]:>22}')
+    before, after = old.get('server_memory') or {}, new.get('server_memory') or {}
+    if before or after:
+        print(f"peak RSS MB {before.get('peak_rss_mb', '-')} -> {after.get('peak_rss_mb', '-')}, "
+              f"concurrency per GB {before.get('concurrency_per_gb', '-')} -> {after.get('concurrency_per_gb', '-')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit')
+    parser.add_argument('--app-url', help='Benchmark an already running app instead of starting one')
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'uvicorn'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=20, help='Number of virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='Measured seconds')
+    parser.add_argument('--warmup', type=float, default=5.0, help='Unmeasured seconds before the run')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Mean pause between requests per user')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--poll-interval', type=float, default=0.25, help='Job status poll interval')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weighted routes, e.g. "/:2,/app:3,/generate:1"')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.0,
+                        help='Fraction of generation requests that repeat earlier parameters')
+    parser.add_argument('--admin', action='store_true', help='Log in as the demo admin instead of Supabase users')
+    parser.add_argument('--openai-latency', default='lognormal:1.0,0.3')
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-error-status', type=int, default=429)
+    parser.add_argument('--stripe-latency', default='lognormal:0.15,0.3')
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+    parser.add_argument('--supabase-latency', default='lognormal:0.1,0.3')
+    parser.add_argument('--supabase-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='Result file (default: bench/results/<timestamp>-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run(args)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print(json.dumps(result['routes'], indent=2))
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,26 @@ cp -r ./static/* ./static/dist/
 cp -r ./templates ./functions/
 cp app.py ./functions/
 cp auth.py ./functions/
+cp subscriptions.py ./functions/
+cp generation_cache.py ./functions/
+cp json_stream.py ./functions/
+cp jobs.py ./functions/
+cp aio.py ./functions/
+cp transport.py ./functions/
+cp services.py ./functions/
+cp prompts.py ./functions/
+cp lesson_schemas.py ./functions/
+cp singleflight.py ./functions/
+cp suggestions.py ./functions/
+cp models.py ./functions/
+cp search.py ./functions/
+cp exporter.py ./functions/
+cp limiter.py ./functions/
+cp router.py ./functions/
+cp metrics.py ./functions/
+cp tracing.py ./functions/
+cp logging_config.py ./functions/
+cp asgi.py ./functions/
 
 # Set up environment variables
 echo "Setting up environment variables..."
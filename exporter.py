@@ -0,0 +1,285 @@
+import io
+import os
+import json
+import time
+import hashlib
+import zipfile
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+# Bump when the rendered layout changes so cached artifacts are not reused
+EXPORT_VERSION = 1
+
+FORMATS = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+
+# Keys of a plan that are bookkeeping rather than content
+SKIP_KEYS = {'title', 'plan_id', 'pending_sections'}
+
+SECTION_TITLES = {
+    'overview': 'Overview',
+    'objectives': 'Learning Objectives',
+    'materials': 'Materials Needed',
+    'procedure': 'Procedure',
+    'assessment': 'Assessment',
+    'extensions': 'Extensions',
+    'outline': 'Outline',
+    'evidence': 'Evidence Statements',
+    'prompts': 'Prompts',
+    'vocabulary': 'Vocabulary',
+    'questions': 'Questions',
+    'rubric': 'Rubric',
+}
+
+
+def section_title(key: str) -> str:
+    return SECTION_TITLES.get(key) or key.replace('_', ' ').title()
+
+
+def plan_sections(plan: dict):
+    """(heading, value) pairs in display order, summaries and bookkeeping left out"""
+    for key, value in plan.items():
+        if key in SKIP_KEYS or key.endswith('_summary') or value in (None, '', []):
+            continue
+        yield section_title(key), value
+
+
+def plan_title(plan: dict, default: str) -> str:
+    title = plan.get('title')
+    return str(title) if title not in (None, '') else default
+
+
+def item_lines(item) -> list:
+    """Readable lines for one entry of a section (a string, or a vocabulary/question/rubric object)"""
+    if not isinstance(item, dict):
+        return [str(item)]
+    if 'term' in item:
+        line = f"{item.get('term')}: {item.get('definition', '')}"
+        return [line, f"Example: {item['example']}"] if item.get('example') else [line]
+    if 'question' in item:
+        lines = [str(item['question'])]
+        lines += [f"{chr(ord('A') + index)}. {choice}" for index, choice in enumerate(item.get('choices') or [])]
+        if item.get('answer'):
+            lines.append(f"Answer: {item['answer']}")
+        if item.get('explanation'):
+            lines.append(str(item['explanation']))
+        return lines
+    if 'criterion' in item:
+        return [str(item['criterion'])] + [
+            f"{level.get('label', '')} ({level.get('score', '')}): {level.get('description', '')}"
+            for level in item.get('levels') or []
+        ]
+    return [f"{key}: {value}" for key, value in item.items()]
+
+
+# The renderers import their libraries locally: they only run in the export
+# worker processes, so web workers never load reportlab or python-docx
+
+def render_pdf(plan: dict) -> bytes:
+    from xml.sax.saxutils import escape
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
+
+    styles = getSampleStyleSheet()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, title=plan_title(plan, 'Lesson Plan'))
+    story = [Paragraph(escape(plan_title(plan, 'Untitled Plan')), styles['Title'])]
+
+    for heading, value in plan_sections(plan):
+        story.append(Paragraph(escape(heading), styles['Heading2']))
+        if isinstance(value, list):
+            items = []
+            for item in value:
+                lines = item_lines(item)
+                items.append(ListItem([Paragraph(escape(line), styles['BodyText']) for line in lines]))
+            story.append(ListFlowable(items, bulletType='bullet'))
+        else:
+            story.append(Paragraph(escape(str(value)), styles['BodyText']))
+        story.append(Spacer(1, 8))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def render_docx(plan: dict) -> bytes:
+    from docx import Document
+
+    document = Document()
+    document.core_properties.title = plan_title(plan, 'Lesson Plan')
+    document.add_heading(plan_title(plan, 'Untitled Plan'), level=0)
+
+    for heading, value in plan_sections(plan):
+        document.add_heading(heading, level=1)
+        if isinstance(value, list):
+            for item in value:
+                first, *rest = item_lines(item)
+                document.add_paragraph(first, style='List Bullet')
+                for line in rest:
+                    document.add_paragraph(line, style='List Bullet 2')
+        else:
+            document.add_paragraph(str(value))
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+RENDERERS = {'pdf': render_pdf, 'docx': render_docx}
+
+
+def render(plan: dict, fmt: str) -> bytes:
+    return RENDERERS[fmt](plan)
+
+
+def content_hash(plan: dict, fmt: str) -> str:
+    material = json.dumps({'plan': plan, 'format': fmt, 'version': EXPORT_VERSION},
+                          sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ExportService:
+    """Renders plans to PDF/DOCX in a process pool and keeps the artifacts on disk.
+
+    Artifacts are named by the hash of the plan content and format, which also
+    serves as their ETag, so a repeat download is a file read (or a 304) and
+    identical exports in flight share one render.
+    """
+
+    def __init__(self, cache_dir: str = None, workers: int = None, ttl: float = None, timeout: float = None):
+        self.cache_dir = cache_dir or os.environ.get('EXPORT_CACHE_DIR', os.path.join(DATA_DIR, 'exports'))
+        self.workers = workers or int(os.environ.get('EXPORT_WORKERS', 2))
+        self.ttl = ttl if ttl is not None else float(os.environ.get('EXPORT_CACHE_TTL', 7 * 24 * 3600))
+        self.timeout = timeout or float(os.environ.get('EXPORT_TIMEOUT', 30))
+
+        self._executor = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Started on first use; spawned (not forked) so workers don't inherit the app's threads.
+        # A spawned worker re-imports the main script, so entry scripts (main.py) import the
+        # app under their __main__ guard
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def path(self, digest: str, fmt: str) -> str:
+        return os.path.join(self.cache_dir, f'{digest}.{fmt}')
+
+    def cached(self, digest: str, fmt: str):
+        """Path of a rendered artifact, or None if it was never rendered or has been pruned"""
+        path = self.path(digest, fmt)
+        return path if os.path.exists(path) else None
+
+    def export(self, plan: dict, fmt: str) -> str:
+        """Render ``plan`` (or reuse the cached artifact) and return its content hash"""
+        if fmt not in RENDERERS:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        digest = content_hash(plan, fmt)
+        if self.cached(digest, fmt):
+            os.utime(self.path(digest, fmt))
+            return digest
+
+        key = (digest, fmt)
+        with self._lock:
+            pending = self._in_flight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._in_flight[key] = Future()
+        if not leader:
+            return pending.result(timeout=self.timeout)
+
+        try:
+            data = self._pool().submit(render, plan, fmt).result(timeout=self.timeout)
+            path = self.path(digest, fmt)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            pending.set_result(digest)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+        self._maybe_prune()
+        return digest
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune < 3600:
+            return
+        self._last_prune = now
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if os.path.getmtime(path) + self.ttl < now:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info("Pruned %s cached exports", removed)
+
+
+class _ZipSink:
+    """Write-only file object for ZipFile whose bytes are handed out as they are written"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, chunk_size: int = 64 * 1024):
+    """Yield a ZIP archive of ``(name, path)`` files chunk by chunk.
+
+    The archive is written to an unseekable sink (sizes go in data
+    descriptors), so memory stays at about one chunk however big it gets.
+    """
+    sink = _ZipSink()
+    # PDF and DOCX are compressed already, so entries are stored as-is
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for name, path in entries:
+            with open(path, 'rb') as source, archive.open(name, mode='w', force_zip64=True) as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
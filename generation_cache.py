@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+# Parameters that define a generated plan; anything else in the request is ignored
+KEY_FIELDS = ('template', 'subtemplate', 'subject', 'grade', 'duration', 'objectives')
+
+
+def normalize_value(value) -> str:
+    """Case-fold and collapse whitespace so trivially different inputs share a key"""
+    if value is None:
+        return ''
+    return re.sub(r'\s+', ' ', str(value)).strip().casefold()
+
+
+def normalize_params(data: dict) -> dict:
+    return {field: normalize_value(data.get(field)) for field in KEY_FIELDS}
+
+
+def cache_key(params: dict, model: str, prompt_version) -> str:
+    """Content address for a generation: normalized parameters + model + prompt version"""
+    material = json.dumps({
+        'params': normalize_params(params),
+        'model': model,
+        'prompt_version': str(prompt_version),
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+# Access times and hit counters are written in batches at most this often (seconds)
+FLUSH_INTERVAL = 5.0
+# Expired entries are swept at most this often (seconds); reads ignore them meanwhile
+EXPIRE_INTERVAL = 60.0
+
+
+class GenerationCache:
+    """On-disk response cache for OpenAI generations with TTL and LRU eviction.
+
+    Entries expire after ``ttl`` seconds; when the table grows past ``max_entries``
+    or ``max_bytes`` the least recently used entries are dropped first. Reads
+    don't write: access times and hit counts are buffered and flushed every
+    FLUSH_INTERVAL seconds, and triggers keep a running entry/byte total so
+    the caps are checked without scanning the table.
+    """
+
+    def __init__(self, db_path: str = None, ttl: float = None, max_entries: int = None, max_bytes: int = None):
+        self.db_path = db_path or os.environ.get(
+            'GENERATION_CACHE_PATH', os.path.join(DATA_DIR, 'generation_cache.db'))
+        self.ttl = ttl if ttl is not None else float(
+            os.environ.get('GENERATION_CACHE_TTL', 30 * 24 * 3600))
+        self.max_entries = max_entries if max_entries is not None else int(
+            os.environ.get('GENERATION_CACHE_MAX_ENTRIES', 20000))
+        self.max_bytes = max_bytes if max_bytes is not None else int(
+            os.environ.get('GENERATION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._counts = {}
+        self._flushed_at = time.monotonic()
+        self._expired_at = 0.0
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._init_db()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS generations (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_generations_last_accessed
+                ON generations (last_accessed);
+            CREATE INDEX IF NOT EXISTS idx_generations_created_at
+                ON generations (created_at);
+            CREATE TABLE IF NOT EXISTS cache_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cache_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                entries INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS generations_insert AFTER INSERT ON generations BEGIN
+                UPDATE cache_totals SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS generations_delete AFTER DELETE ON generations BEGIN
+                UPDATE cache_totals SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS generations_resize AFTER UPDATE OF size ON generations BEGIN
+                UPDATE cache_totals SET bytes = bytes - OLD.size + NEW.size WHERE id = 1;
+            END;
+        """)
+        # Seed the running totals once, from whatever the table already holds
+        conn.execute("""
+            INSERT OR IGNORE INTO cache_totals (id, entries, bytes)
+            SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM generations
+        """)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write buffered access times and hit counters"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            counts, self._counts = self._counts, {}
+            self._flushed_at = time.monotonic()
+        if not touched and not counts:
+            return
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN')
+            conn.executemany('UPDATE generations SET last_accessed = ? WHERE key = ? AND last_accessed < ?',
+                             [(at, key, at) for key, at in touched.items()])
+            conn.executemany("""
+                INSERT INTO cache_counters (name, value) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+            """, list(counts.items()))
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            logger.warning("Could not flush generation cache bookkeeping: %s", e)
+
+    def get(self, key: str, kind: str = 'plan'):
+        """Return the cached response for ``key``, or None on a miss.
+
+        ``kind`` ('plan', 'outline', 'section') picks the hit/miss counters;
+        None looks the entry up without counting it.
+        """
+        now = time.time()
+        row = self._connection().execute(
+            'SELECT value, created_at FROM generations WHERE key = ?', (key,)).fetchone()
+        hit = row is not None and row[1] + self.ttl >= now
+        if kind:
+            self._count(_counter(kind, 'hits' if hit else 'misses'))
+        if hit:
+            with self._lock:
+                self._touched[key] = now
+        self._maybe_flush()
+        return json.loads(row[0]) if hit else None
+
+    def set(self, key: str, value):
+        encoded = json.dumps(value, separators=(',', ':'))
+        now = time.time()
+        self._connection().execute("""
+            INSERT INTO generations (key, value, size, created_at, last_accessed)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value,
+                size = excluded.size,
+                created_at = excluded.created_at,
+                last_accessed = excluded.last_accessed
+        """, (key, encoded, len(encoded), now, now))
+        self.evict()
+        self._maybe_flush()
+
+    def evict(self):
+        """Drop expired entries (at most every EXPIRE_INTERVAL), then least recently used ones until under the caps"""
+        conn = self._connection()
+        if time.monotonic() - self._expired_at >= EXPIRE_INTERVAL:
+            self._expired_at = time.monotonic()
+            conn.execute('DELETE FROM generations WHERE created_at < ?', (time.time() - self.ttl,))
+
+        count, total = conn.execute('SELECT entries, bytes FROM cache_totals WHERE id = 1').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # Recent reads decide what is least recently used
+        self.flush()
+        excess_entries = max(0, count - self.max_entries)
+        excess_bytes = max(0, total - self.max_bytes)
+        doomed = []
+        freed = 0
+        for key, size in conn.execute('SELECT key, size FROM generations ORDER BY last_accessed'):
+            if len(doomed) >= excess_entries and freed >= excess_bytes:
+                break
+            doomed.append((key,))
+            freed += size
+        conn.executemany('DELETE FROM generations WHERE key = ?', doomed)
+        logger.info("Evicted %s cached generations (%s bytes)", len(doomed), freed)
+
+    def stats(self) -> dict:
+        self.flush()
+        conn = self._connection()
+        counters = dict(conn.execute('SELECT name, value FROM cache_counters').fetchall())
+        count, total = conn.execute('SELECT entries, bytes FROM cache_totals WHERE id = 1').fetchone()
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'outlines': {name: counters.get(_counter('outline', name), 0) for name in ('hits', 'misses')},
+            'sections': {name: counters.get(_counter('section', name), 0) for name in ('hits', 'misses')},
+            'entries': count,
+            'bytes': total,
+        }
+
+
+def _counter(kind: str, name: str) -> str:
+    # Plan counters keep their original names so existing totals carry on
+    return name if kind == 'plan' else f'{kind}_{name}'
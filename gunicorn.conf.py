@@ -0,0 +1,25 @@
+import os
+import sys
+import shutil
+import subprocess
+
+# Each worker writes its metrics to files here and /metrics sums them, so a
+# scrape sees the whole server whichever worker answers it. Set before the
+# workers import the app (prometheus_client reads it at import time).
+prometheus_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(os.path.abspath(os.environ.get('DATA_DIR', 'instance')), 'prometheus'))
+
+
+def on_starting(server):
+    # Files from a previous run would be added to this run's counters
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir, exist_ok=True)
+    # Schema changes once, in a separate process, rather than in every worker as it imports the
+    # app (the master must not import it: its threads wouldn't survive the fork)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], check=True)
+
+
+def child_exit(server, worker):
+    # Drop a dead worker's live gauges (in-flight counts) from the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
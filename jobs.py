@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import aio
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+# Id of the job being run; a context variable so coroutine jobs sharing the event loop keep theirs apart
+_current_job = contextvars.ContextVar('job_id', default=None)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+class JobQueue:
+    """Bounded background worker pool for long-running calls.
+
+    Jobs run on a thread pool inside this process, or as coroutines on the
+    background event loop (``submit_async``), while their status and
+    results live in a local SQLite table so any web worker can answer
+    ``GET /jobs/<id>`` for the user who submitted the job. Finished jobs
+    are kept for ``result_ttl`` seconds.
+    ``max_pending`` bounds both kinds together.
+    """
+
+    def __init__(self, db_path: str = None, workers: int = None, max_pending: int = None, result_ttl: float = None):
+        self.db_path = db_path or os.environ.get('JOB_DB_PATH', os.path.join(DATA_DIR, 'jobs.db'))
+        self.workers = workers or int(os.environ.get('JOB_WORKERS', 4))
+        self.max_pending = max_pending or int(os.environ.get('JOB_QUEUE_SIZE', 100))
+        self.result_ttl = result_ttl if result_ttl is not None else float(
+            os.environ.get('JOB_RESULT_TTL', 3600))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job-worker')
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._local = threading.local()
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._init_db()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                owner TEXT,
+                status TEXT NOT NULL,
+                progress TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_expires_at ON jobs (expires_at);
+        """)
+        columns = {name for _, name, *_ in conn.execute('PRAGMA table_info(jobs)')}
+        if 'owner' not in columns:
+            # Jobs queued before owners were recorded can't be read; they expire within result_ttl
+            conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+
+    def _update(self, job_id: str, **fields):
+        now = time.time()
+        fields['updated_at'] = now
+        fields['expires_at'] = now + self.result_ttl
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._connection().execute(
+            f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def _create(self, kind: str, owner: str) -> str:
+        """Reserve a pending slot and record the job as queued"""
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError('Too many queued jobs')
+            self._pending += 1
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute('DELETE FROM jobs WHERE expires_at < ?', (now,))
+            conn.execute("""
+                INSERT INTO jobs (id, kind, owner, status, created_at, updated_at, expires_at)
+                VALUES (?, ?, ?, 'queued', ?, ?, ?)
+            """, (job_id, kind, owner, now, now, now + self.result_ttl))
+        except Exception:
+            self._done()
+            raise
+        return job_id
+
+    def _done(self):
+        with self._pending_lock:
+            self._pending -= 1
+
+    def submit(self, fn, *args, kind: str = 'job', owner: str = None, **kwargs) -> str:
+        """Queue ``fn(*args, **kwargs)`` for ``owner`` and return its job id"""
+        job_id = self._create(kind, owner)
+        try:
+            self._executor.submit(self._run, job_id, kind, fn, args, kwargs)
+        except Exception:
+            self._done()
+            raise
+        return job_id
+
+    def submit_async(self, fn, *args, kind: str = 'job', owner: str = None, **kwargs) -> str:
+        """Run the coroutine function ``fn(*args, **kwargs)`` on the background loop and return its job id.
+
+        No worker thread is held while it waits, so many such jobs can be in
+        flight at once; they still count towards ``max_pending``.
+        """
+        job_id = self._create(kind, owner)
+        try:
+            asyncio.run_coroutine_threadsafe(self._run_async(job_id, kind, fn, args, kwargs), aio.get_loop())
+        except Exception:
+            self._done()
+            raise
+        return job_id
+
+    def _run(self, job_id: str, kind: str, fn, args, kwargs):
+        token = _current_job.set(job_id)
+        metrics.jobs_in_flight.labels(kind).inc()
+        try:
+            self._update(job_id, status='running')
+            result = fn(*args, **kwargs)
+            self._update(job_id, status='succeeded', result=json.dumps(result))
+        except Exception as e:
+            logger.error("Job %s failed: %s", job_id, e)
+            self._update(job_id, status='failed', error=str(e))
+        finally:
+            metrics.jobs_in_flight.labels(kind).dec()
+            _current_job.reset(token)
+            self._done()
+
+    async def _run_async(self, job_id: str, kind: str, fn, args, kwargs):
+        # Runs in its own task, so setting the job id here is invisible to other jobs
+        _current_job.set(job_id)
+        metrics.jobs_in_flight.labels(kind).inc()
+        # Job store writes go to a thread: SQLite would block the loop's other coroutines
+        try:
+            await asyncio.to_thread(self._update, job_id, status='running')
+            result = await fn(*args, **kwargs)
+            await asyncio.to_thread(self._update, job_id, status='succeeded', result=json.dumps(result))
+        except Exception as e:
+            logger.error("Job %s failed: %s", job_id, e)
+            await asyncio.to_thread(self._update, job_id, status='failed', error=str(e))
+        finally:
+            metrics.jobs_in_flight.labels(kind).dec()
+            self._done()
+
+    def current_job_id(self):
+        """Id of the job the caller is running in (worker thread or coroutine), if any"""
+        return _current_job.get()
+
+    def detach(self):
+        """Stop attributing progress from the current task to its job (e.g. the rows of a batch)"""
+        _current_job.set(None)
+
+    def report_progress(self, progress, job_id: str = None):
+        """Record progress for ``job_id``, or the job the caller is running in"""
+        job_id = job_id or self.current_job_id()
+        if job_id:
+            self._update(job_id, progress=json.dumps(progress))
+
+    def get(self, job_id: str, owner: str):
+        """Return ``owner``'s job as a dict, or None if it is unknown, has expired or isn't theirs"""
+        row = self._connection().execute("""
+            SELECT id, kind, status, progress, result, error, created_at, updated_at
+            FROM jobs WHERE id = ? AND owner = ? AND expires_at >= ?
+        """, (job_id, owner, time.time())).fetchone()
+        if row is None:
+            return None
+
+        job = {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'created_at': row[6],
+            'updated_at': row[7],
+        }
+        if row[3] is not None:
+            job['progress'] = json.loads(row[3])
+        if row[4] is not None:
+            job['result'] = json.loads(row[4])
+        if row[5] is not None:
+            job['error'] = row[5]
+        return job
+
+    def stats(self) -> dict:
+        with self._pending_lock:
+            pending = self._pending
+        return {'workers': self.workers, 'pending': pending, 'max_pending': self.max_pending}
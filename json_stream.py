@@ -0,0 +1,83 @@
+import json
+
+
+class TopLevelJSONStream:
+    """Incremental parser that yields top-level members of a streamed JSON object.
+
+    Feed it text chunks as they arrive; each call returns the ``(key, value)``
+    pairs that were completed by that chunk, in document order. Nested values
+    are only decoded once their closing bracket has been seen.
+    """
+
+    def __init__(self):
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._state = 'start'  # start -> key -> colon -> value -> (key | done)
+        self._token_start = None
+        self._key = None
+        self.done = False
+
+    def feed(self, chunk: str) -> list:
+        self._text += chunk
+        completed = []
+        text = self._text
+
+        while self._pos < len(text) and not self.done:
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._state == 'key' and self._depth == 1:
+                        self._key = json.loads(text[self._token_start:i + 1])
+                        self._state = 'colon'
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._state == 'key' and self._depth == 1:
+                    self._token_start = i
+            elif ch in '{[':
+                self._depth += 1
+                if self._state == 'start' and ch == '{':
+                    self._state = 'key'
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._state == 'value':
+                        completed.append(self._complete_member(text, i))
+                    self._state = 'done'
+                    self.done = True
+            elif ch == ':' and self._depth == 1 and self._state == 'colon':
+                self._state = 'value'
+                self._token_start = i + 1
+            elif ch == ',' and self._depth == 1 and self._state == 'value':
+                completed.append(self._complete_member(text, i))
+                self._state = 'key'
+
+        # Drop text that can no longer be referenced to keep memory flat
+        keep_from = self._token_start if self._token_start is not None else self._pos
+        keep_from = min(keep_from, self._pos)
+        if keep_from > 0:
+            self._text = text[keep_from:]
+            self._pos -= keep_from
+            if self._token_start is not None:
+                self._token_start -= keep_from
+
+        return completed
+
+    def _complete_member(self, text: str, end: int):
+        value = json.loads(text[self._token_start:end])
+        member = (self._key, value)
+        self._key = None
+        self._token_start = None
+        return member
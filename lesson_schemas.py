@@ -0,0 +1,147 @@
+import re
+
+# Building blocks for the strict JSON schemas sent as the OpenAI response format.
+# Every subtemplate lists only the sections it needs, so lighter formats
+# (a vocabulary list, a rubric, a quiz) don't pay for a full lesson plan.
+
+
+def _text(description):
+    return {"type": "string", "description": description}
+
+
+def _list(description, max_items, items=None):
+    return {
+        "type": "array",
+        "description": description,
+        "items": items or {"type": "string"},
+        "maxItems": max_items,
+    }
+
+
+def _object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+SECTIONS = {
+    "title": _text("Short, descriptive title"),
+    "overview": _text("Overview of the plan in two to four sentences"),
+    "objectives": _list("Measurable learning objectives, one sentence each", 6),
+    "materials": _list("Materials and resources needed", 12),
+    "procedure": _list("Ordered steps with approximate timing, one or two sentences each", 12),
+    "assessment": _text("How learning will be assessed, at most five sentences"),
+    "extensions": _list("Extension or differentiation ideas, one sentence each", 5),
+    "outline": _list("Outline headings and points in order, one line each", 20),
+    "evidence": _list("Evidence statements: what students will say, do or produce", 10),
+    "prompts": _list("Prompts for students to respond to, one sentence each", 10),
+    "vocabulary": _list("Key terms", 25, _object({
+        "term": _text("The word or phrase"),
+        "definition": _text("Student-friendly definition in one sentence"),
+        "example": _text("Example sentence using the term"),
+    })),
+    "questions": _list("Questions in the order students should see them", 20, _object({
+        "question": _text("The question or problem"),
+        "choices": _list("Answer choices; empty if the question is open-ended", 5),
+        "answer": _text("The correct answer"),
+        "explanation": _text("One-sentence explanation of the answer"),
+    })),
+    "rubric": _list("Rubric criteria", 8, _object({
+        "criterion": _text("What is being evaluated"),
+        "levels": _list("Performance levels from highest to lowest", 5, _object({
+            "label": _text("Level name, e.g. Exemplary"),
+            "score": _text("Points or score range"),
+            "description": _text("What performance at this level looks like"),
+        })),
+    })),
+}
+
+SUMMARY = _list("One or two sentences summarizing the section", 2)
+
+FULL_PLAN = ("title", "overview", "objectives", "materials", "procedure", "assessment", "extensions")
+
+# subtemplate -> (sections in display order, whether each section gets a *_summary)
+LAYOUTS = {
+    "Lesson Seed": (("title", "overview", "objectives", "procedure"), False),
+    "Book Summary": (("title", "overview", "vocabulary", "questions"), False),
+    "Vocabulary List": (("title", "overview", "vocabulary"), False),
+    "Notes Outline": (("title", "overview", "outline"), False),
+    "Lab + Material List": (("title", "overview", "objectives", "materials", "procedure", "assessment"), True),
+    "Multiple Choice Questions": (("title", "overview", "questions"), False),
+    "Word Problems": (("title", "overview", "questions"), False),
+    "Fill In The Blank": (("title", "overview", "questions"), False),
+    "True/False Questions": (("title", "overview", "questions"), False),
+    "Analytic Rubric": (("title", "overview", "rubric"), False),
+    "Holistic Rubric": (("title", "overview", "rubric"), False),
+    "Assessment Outline": (("title", "overview", "objectives", "outline", "assessment"), False),
+    "Evidence Statements": (("title", "overview", "objectives", "evidence"), False),
+    "Think-Pair-Share": (("title", "overview", "objectives", "materials", "procedure"), False),
+    "Jigsaw Activity": (("title", "overview", "objectives", "materials", "procedure"), False),
+    "Round Robin": (("title", "overview", "objectives", "materials", "procedure"), False),
+    "4 Corners": (("title", "overview", "objectives", "materials", "procedure"), False),
+    "Bingo Style": (("title", "overview", "materials", "procedure", "questions"), False),
+    "Jeopardy Style": (("title", "overview", "materials", "procedure", "questions"), False),
+    "Quiz Quiz Trade": (("title", "overview", "materials", "procedure", "questions"), False),
+    "Escape Room": (("title", "overview", "materials", "procedure", "questions"), False),
+    "Class Poll": (("title", "overview", "questions"), False),
+    "Self-Assessment": (("title", "overview", "questions"), False),
+    "Reflective Journaling": (("title", "overview", "prompts"), False),
+    "Mad Lib": (("title", "overview", "procedure", "prompts"), False),
+}
+
+DEFAULT_LAYOUT = (FULL_PLAN, True)
+
+
+def layout_for(subtemplate: str):
+    return LAYOUTS.get(subtemplate or '', DEFAULT_LAYOUT)
+
+
+def plan_schema(subtemplate: str) -> dict:
+    """JSON schema listing only the sections ``subtemplate`` needs"""
+    sections, with_summaries = layout_for(subtemplate)
+    properties = {}
+    for section in sections:
+        properties[section] = SECTIONS[section]
+        if with_summaries and section != "title":
+            properties[f"{section}_summary"] = SUMMARY
+    return _object(properties)
+
+
+def _strict_format(name: str, schema: dict) -> dict:
+    name = re.sub(r'[^a-zA-Z0-9_-]+', '_', name).strip('_').lower()
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name[:64], "strict": True, "schema": schema},
+    }
+
+
+def response_format(subtemplate: str) -> dict:
+    """Strict ``json_schema`` response format for the OpenAI chat completions API"""
+    return _strict_format(f"plan_{subtemplate or 'lesson_plan'}", plan_schema(subtemplate))
+
+
+def outline_schema(subtemplate: str) -> dict:
+    """Title, overview and a summary per section, for two-phase generation"""
+    sections, _ = layout_for(subtemplate)
+    properties = {"title": SECTIONS["title"], "overview": SECTIONS["overview"]}
+    for section in sections:
+        if section not in properties:
+            properties[f"{section}_summary"] = SUMMARY
+    return _object(properties)
+
+
+def pending_sections(subtemplate: str) -> list:
+    """Sections an outline leaves to be generated on demand"""
+    sections, _ = layout_for(subtemplate)
+    return [section for section in sections if section not in ("title", "overview")]
+
+
+def outline_response_format(subtemplate: str) -> dict:
+    return _strict_format(f"outline_{subtemplate or 'lesson_plan'}", outline_schema(subtemplate))
+
+
+def section_response_format(section: str) -> dict:
+    return _strict_format(f"section_{section}", _object({section: SECTIONS[section]}))
@@ -0,0 +1,245 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from typing import Optional
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LimiterBusyError(Exception):
+    """Raised when a call is shed: the queue is full, the wait ran out, or the upstream throttled us"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(error) -> Optional[float]:
+    """Seconds from a 429 response's Retry-After (or retry-after-ms) header, if present"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _is_throttled(error) -> bool:
+    return getattr(error, 'status_code', None) == 429
+
+
+def _is_timeout(error) -> bool:
+    return isinstance(error, TimeoutError) or 'Timeout' in type(error).__name__
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for calls to one upstream.
+
+    Each success at the current limit raises it by about one per limit's
+    worth of calls. A 429 or a timeout halves it (at most once per round of
+    in-flight calls) and a Retry-After pauses new calls until it passes.
+    Calls over the limit queue for up to ``max_wait`` seconds; once
+    ``max_queue`` callers are waiting, new ones are shed immediately with
+    :class:`LimiterBusyError`.
+    """
+
+    def __init__(self, name: str, initial_limit: int = None, min_limit: int = None, max_limit: int = None,
+                 max_queue: int = None, max_wait: float = None, backoff: float = 0.5):
+        prefix = name.upper()
+        self.name = name
+        self.min_limit = min_limit or int(os.environ.get(f'{prefix}_MIN_CONCURRENCY', 2))
+        self.max_limit = max_limit or int(os.environ.get(f'{prefix}_MAX_CONCURRENCY', 64))
+        self.limit = float(initial_limit or int(os.environ.get(f'{prefix}_CONCURRENCY', 16)))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get(f'{prefix}_QUEUE_SIZE', 64))
+        self.max_wait = max_wait if max_wait is not None else float(os.environ.get(f'{prefix}_QUEUE_WAIT', 20))
+        self.backoff = backoff
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self.latency = None
+        self._last_decrease = 0.0
+        self._counts = {'succeeded': 0, 'throttled': 0, 'timeouts': 0, 'failed': 0, 'cancelled': 0, 'shed': 0}
+        self._cond = threading.Condition()
+        # (loop, future) per coroutine waiting in acquire_async, oldest first
+        self._async_waiters = deque()
+
+    def saturated(self) -> bool:
+        """True when a new call would be shed straight away"""
+        with self._cond:
+            return self.waiting >= self.max_queue
+
+    def has_headroom(self) -> bool:
+        """True when a call could start now without queueing (used to decide on hedged requests)"""
+        with self._cond:
+            return self.waiting == 0 and self._available(time.monotonic())
+
+    def _available(self, now: float) -> bool:
+        # Called with the condition lock held
+        return self.in_flight < int(self.limit) and now >= self.blocked_until
+
+    def retry_after(self) -> int:
+        """Seconds a shed caller should wait before trying again"""
+        now = time.monotonic()
+        with self._cond:
+            blocked = self.blocked_until - now
+            drain = (self.latency or 1.0) * (self.waiting + 1) / max(self.limit, 1)
+        return max(1, min(60, math.ceil(max(blocked, drain))))
+
+    def _shed(self, message: str):
+        # Called with the (reentrant) condition lock held
+        self._counts['shed'] += 1
+        return LimiterBusyError(message, self.retry_after())
+
+    def acquire(self, timeout: float = None) -> float:
+        """Wait for a slot and return the time it was granted"""
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                raise self._shed(f"Too many requests waiting for {self.name}")
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._available(now):
+                        self.in_flight += 1
+                        return now
+                    if now >= deadline:
+                        raise self._shed(f"Timed out waiting for {self.name}")
+                    wake = deadline if now >= self.blocked_until else min(deadline, self.blocked_until)
+                    self._cond.wait(wake - now)
+            finally:
+                self.waiting -= 1
+
+    def release(self, started: float, error=None):
+        """Return a slot and adjust the limit from how the call went"""
+        now = time.monotonic()
+        with self._cond:
+            at_limit = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if error is None:
+                self._counts['succeeded'] += 1
+                elapsed = now - started
+                self.latency = elapsed if self.latency is None else 0.9 * self.latency + 0.1 * elapsed
+                if at_limit:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif _is_throttled(error) or _is_timeout(error):
+                self._counts['throttled' if _is_throttled(error) else 'timeouts'] += 1
+                # Calls already in flight when we last backed off saw the old limit; don't punish twice
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+                    logger.warning("%s concurrency limit lowered to %.1f", self.name, self.limit)
+                retry_after = _retry_after(error) if _is_throttled(error) else None
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+                # Abandoned (a lost hedge, a closed stream): says nothing about the upstream
+                self._counts['cancelled'] += 1
+            else:
+                self._counts['failed'] += 1
+            self._cond.notify_all()
+            self._notify_async()
+
+    def _notify_async(self):
+        # Called with the condition lock held: wake as many waiting coroutines as there are free slots
+        free = int(self.limit) - self.in_flight if time.monotonic() >= self.blocked_until else 0
+        while free > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_wake, waiter)
+            free -= 1
+
+    def _finish(self, started: float, error):
+        self.release(started, error)
+        if _is_throttled(error):
+            raise LimiterBusyError(f"{self.name} is rate limiting requests", self.retry_after()) from error
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for the duration of the block (e.g. while a response streams)"""
+        started = self.acquire()
+        try:
+            yield
+        except Exception as e:
+            self._finish(started, e)
+            raise
+        except BaseException as e:
+            # A closed stream (GeneratorExit) must still give its slot back
+            self.release(started, e)
+            raise
+        self.release(started)
+
+    def call(self, fn, *args, **kwargs):
+        with self.slot():
+            return fn(*args, **kwargs)
+
+    async def acquire_async(self, timeout: float = None) -> float:
+        """``acquire`` for coroutines: waits on the event loop instead of holding a thread"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                raise self._shed(f"Too many requests waiting for {self.name}")
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    if self._available(now):
+                        self.in_flight += 1
+                        return now
+                    if now >= deadline:
+                        raise self._shed(f"Timed out waiting for {self.name}")
+                    wake = deadline if now >= self.blocked_until else min(deadline, self.blocked_until)
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait([waiter], timeout=wake - now)
+                finally:
+                    with self._cond:
+                        if (loop, waiter) in self._async_waiters:
+                            self._async_waiters.remove((loop, waiter))
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                # A coroutine woken but cancelled before taking its slot passes the wake-up on
+                self._notify_async()
+
+    async def call_async(self, fn, *args, **kwargs):
+        """``call`` for coroutines"""
+        started = await self.acquire_async()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            self._finish(started, e)
+            raise
+        except BaseException as e:
+            self.release(started, e)
+            raise
+        self.release(started)
+        return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_queue': self.max_queue,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+                'blocked_for': max(0.0, round(self.blocked_until - time.monotonic(), 2)),
+                **self._counts,
+            }
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
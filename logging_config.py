@@ -0,0 +1,168 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else was passed with extra= and is logged as a field
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Chatty third-party loggers, quiet unless LOG_LEVELS says otherwise
+DEFAULT_LEVELS = {'httpx': 'WARNING', 'httpcore': 'WARNING', 'hpack': 'WARNING', 'urllib3': 'WARNING',
+                  'stripe': 'WARNING'}
+
+_listener = None
+_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra fields and any traceback"""
+
+    def format(self, record) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most ``burst`` records per message template per ``interval`` seconds.
+
+    Keyed on the unformatted message, so ``logger.info("Job %s failed", id)``
+    is one stream however many ids there are. The first record after a
+    suppressed run carries ``suppressed=<count>``.
+    """
+
+    def __init__(self, burst: int, interval: float):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if self.burst <= 0:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > 10000:
+                    # Forget stale windows rather than grow without bound
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the writer thread without formatting them or ever waiting.
+
+    The stock QueueHandler formats each record on the logging thread; here
+    the record is only copied (so later changes to it can't leak into the
+    log) and formatting happens in the listener. When the queue is full the
+    record is dropped and counted instead of blocking the request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        line = super().format(record)
+        if getattr(record, 'suppressed', None):
+            line += f' (suppressed {record.suppressed} similar)'
+        return line
+
+
+def parse_levels(spec: str) -> dict:
+    """``"auth=WARNING,jobs=DEBUG"`` -> {logger name: level}"""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Route all logging through a bounded queue to a background writer.
+
+    LOG_LEVEL sets the root level and LOG_LEVELS per-logger levels
+    (``module=LEVEL,...``). LOG_FORMAT is ``json`` (default) or ``text``.
+    LOG_RATE_LIMIT records per message per LOG_RATE_INTERVAL seconds are
+    kept (0 disables the limit) and at most LOG_QUEUE_SIZE records wait
+    for the writer.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+
+        if os.environ.get('LOG_FORMAT', 'json') == 'text':
+            formatter = _TextFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        else:
+            formatter = JSONFormatter()
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(RateLimitFilter(int(os.environ.get('LOG_RATE_LIMIT', 20)),
+                                          float(os.environ.get('LOG_RATE_INTERVAL', 60))))
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        for name, level in {**DEFAULT_LEVELS, **parse_levels(os.environ.get('LOG_LEVELS'))}.items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+        _listener.start()
+        # Flush what is still queued when the process exits
+        atexit.register(_listener.stop)
+
+
+def dropped_records() -> int:
+    """Records dropped because the writer fell behind"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            return handler.dropped
+    return 0
@@ -1,4 +1,6 @@
-from app import app
-
 if __name__ == '__main__':
+    # Imported under the guard: export workers are spawned and re-import this
+    # script, and must not start a copy of the app
+    from app import app, init_db
+    init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
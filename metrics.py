@@ -0,0 +1,108 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import Response, g, request
+import tracing
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess,
+)
+
+# Set (by gunicorn.conf.py) when several worker processes serve the app; each
+# worker then writes its samples to files there and a scrape sums them
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UPSTREAM_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 120.0)
+
+http_requests = Counter(
+    'http_requests_total', 'HTTP requests handled', ['method', 'route', 'status'])
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Time until the response was returned (headers only for streamed bodies)',
+    ['method', 'route'], buckets=REQUEST_BUCKETS)
+http_in_flight = Gauge(
+    'http_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+
+upstream_http_duration = Histogram(
+    'upstream_http_request_duration_seconds', 'Latency of each HTTP request to an upstream',
+    ['upstream'], buckets=UPSTREAM_BUCKETS)
+upstream_http_errors = Counter(
+    'upstream_http_errors_total', 'HTTP requests to an upstream that failed or returned 429/5xx',
+    ['upstream', 'kind'])
+upstream_in_flight = Gauge(
+    'upstream_requests_in_flight', 'HTTP requests waiting on an upstream', ['upstream'],
+    multiprocess_mode='livesum')
+
+upstream_call_duration = Histogram(
+    'upstream_call_duration_seconds', 'Latency of one client call (e.g. a Stripe lookup), retries included',
+    ['upstream', 'operation'], buckets=UPSTREAM_BUCKETS)
+upstream_call_errors = Counter(
+    'upstream_call_errors_total', 'Client calls that raised', ['upstream', 'operation', 'error'])
+
+openai_tokens = Counter(
+    'openai_tokens_total', 'OpenAI tokens used; cached counts prompt tokens served from the prefix cache',
+    ['kind', 'model', 'template', 'subtemplate'])
+
+jobs_in_flight = Gauge(
+    'jobs_in_flight', 'Background jobs running', ['kind'], multiprocess_mode='livesum')
+
+
+@contextmanager
+def track(upstream: str, operation: str):
+    """Time a call to ``upstream`` and count it as an error if it raises; also a trace span"""
+    start = time.perf_counter()
+    try:
+        with tracing.span(f'{upstream}.{operation}'):
+            yield
+    except BaseException as e:
+        upstream_call_errors.labels(upstream, operation, type(e).__name__).inc()
+        raise
+    finally:
+        upstream_call_duration.labels(upstream, operation).observe(time.perf_counter() - start)
+
+
+def record_tokens(usage: dict, model: str, template: str, subtemplate: str):
+    for kind in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+        if usage.get(kind):
+            openai_tokens.labels(kind.replace('_tokens', ''), model or 'unknown', template, subtemplate).inc(usage[kind])
+
+
+def _route() -> str:
+    # The URL rule, not the path, so /history/<int:plan_id> is one series
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    http_in_flight.inc()
+
+
+def _after_request(response):
+    start = g.get('metrics_start')
+    if start is not None:
+        http_requests.labels(request.method, _route(), str(response.status_code)).inc()
+        http_request_duration.labels(request.method, _route()).observe(time.perf_counter() - start)
+    return response
+
+
+def _teardown_request(error=None):
+    if g.pop('metrics_start', None) is not None:
+        http_in_flight.dec()
+
+
+def metrics_view():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Record per-route request metrics and serve them all at /metrics"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,96 @@
+import os
+import base64
+from datetime import datetime, timezone
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import deferred, undefer
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+db = SQLAlchemy()
+
+
+def database_url() -> str:
+    """DATABASE_URL (Postgres in production), or a SQLite file in DATA_DIR"""
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        return 'sqlite:///' + os.path.abspath(os.path.join(DATA_DIR, 'app.db'))
+    # SQLAlchemy only accepts the postgresql:// spelling
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def utcnow() -> datetime:
+    # Stored naive in UTC so SQLite and Postgres compare the same way
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class LessonPlan(db.Model):
+    """A plan saved to a teacher's history"""
+
+    __tablename__ = 'lesson_plans'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(64), nullable=False)
+    title = db.Column(db.String(200), nullable=False, default='')
+    subject = db.Column(db.String(500), nullable=False, default='')
+    template = db.Column(db.String(100), nullable=False, default='')
+    subtemplate = db.Column(db.String(100), nullable=False, default='')
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    # Only loaded when a single plan is opened, never for the sidebar list
+    plan = deferred(db.Column(db.JSON, nullable=False))
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+
+    __table_args__ = (
+        # Serves the newest-first keyset scan of one teacher's history; id breaks ties
+        db.Index('ix_lesson_plans_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+    def summary(self) -> dict:
+        """Compact row for the history list"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'subject': self.subject[:120],
+            'template': self.template,
+            'subtemplate': self.subtemplate,
+            'created_at': self.created_at.isoformat() + 'Z',
+        }
+
+    def to_dict(self) -> dict:
+        return {**self.summary(), 'subject': self.subject, 'params': self.params, 'plan': self.plan}
+
+
+def encode_cursor(plan: LessonPlan) -> str:
+    raw = f'{plan.created_at.isoformat()}|{plan.id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    """(created_at, id) of the last row on the previous page; ValueError if malformed"""
+    try:
+        created_at, plan_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return datetime.fromisoformat(created_at), int(plan_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+
+def history_page(user_id: str, limit: int, cursor: str = None, with_plan: bool = False):
+    """One page of a teacher's plans, newest first, and the cursor for the next page.
+
+    The plan body is deferred unless ``with_plan`` is set, which loads it in the same query.
+    """
+    query = LessonPlan.query.filter(LessonPlan.user_id == user_id)
+    if with_plan:
+        query = query.options(undefer(LessonPlan.plan))
+    if cursor:
+        created_at, plan_id = decode_cursor(cursor)
+        query = query.filter(db.or_(
+            LessonPlan.created_at < created_at,
+            db.and_(LessonPlan.created_at == created_at, LessonPlan.id < plan_id),
+        ))
+    rows = query.order_by(LessonPlan.created_at.desc(), LessonPlan.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,89 @@
+import json
+from functools import lru_cache
+from lesson_schemas import SECTIONS, layout_for
+
+# The system message starts with text that is byte for byte the same for every
+# lesson call (the rules and the reference for every section), long enough for
+# OpenAI's automatic prefix caching (1024 tokens) to apply. The template and
+# subtemplate come after it and the teacher's parameters go in the user message.
+
+LESSON_RULES = """Rules:
+- Respond with a single JSON object matching the response schema.
+- Write for the teacher: concrete, classroom-ready and age-appropriate for the grade level.
+- Keep every section within the limits given in its description below.
+- If a grade level, duration or objectives are given, the plan must fit them.
+- Procedure steps are in teaching order and their timings add up to the duration, if one is given.
+- Objectives are measurable: start each with a verb such as identify, explain, compare or solve.
+- Materials are things a teacher can gather or print; name any handout the procedure refers to.
+- Questions, prompts and vocabulary use language the students can read on their own.
+- Multiple-choice questions have one correct answer among their choices; the answer repeats it exactly.
+- Rubric levels run from highest to lowest and every criterion uses the same levels.
+- Do not invent citations, links or product names; describe generic materials instead.
+- Each *_summary array holds one or two short sentences summarizing its section."""
+
+SECTION_REFERENCE = json.dumps(SECTIONS, indent=2)
+
+LESSON_PREAMBLE = (
+    "You are an expert instructional designer who creates detailed educational plans.\n\n"
+    f"{LESSON_RULES}\n\n"
+    "Every section a plan can have, as JSON schema; the response schema picks the ones this plan needs:\n"
+    f"{SECTION_REFERENCE}"
+)
+
+
+@lru_cache(maxsize=128)
+def lesson_system_prompt(template_description: str, subtemplate: str = '') -> str:
+    """The shared preamble, then the instructions for one template and subtemplate"""
+    sections, with_summaries = layout_for(subtemplate)
+    parts = [LESSON_PREAMBLE, f"Template Type: {template_description}"]
+    if subtemplate:
+        parts.append(f"Format: {subtemplate}")
+    parts.append("Sections: " + ", ".join(sections) + (", each with a summary" if with_summaries else ""))
+    return "\n\n".join(parts)
+
+
+def lesson_user_prompt(data: dict) -> str:
+    """The teacher's parameters for one plan"""
+    lines = [
+        "Create a detailed educational plan using the following parameters:",
+        f"Subject: {data.get('subject')}",
+    ]
+    if data.get('grade'):
+        lines.append(f"Grade Level: {data['grade']}")
+    if data.get('duration'):
+        lines.append(f"Duration: {data['duration']}")
+    if data.get('objectives'):
+        lines.append(f"Objectives: {data['objectives']}")
+    return '\n'.join(lines)
+
+
+def lesson_messages(data: dict, template_description: str) -> list:
+    return [
+        {"role": "system", "content": lesson_system_prompt(template_description, data.get('subtemplate') or '')},
+        {"role": "user", "content": lesson_user_prompt(data)},
+    ]
+
+
+def outline_messages(data: dict, template_description: str) -> list:
+    """First phase of two-phase generation: title, overview and section summaries"""
+    user_prompt = lesson_user_prompt(data) + (
+        "\n\nFor now write only the title, the overview and a short summary of each section. "
+        "The sections themselves will be written separately."
+    )
+    return [
+        {"role": "system", "content": lesson_system_prompt(template_description, data.get('subtemplate') or '')},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def section_messages(data: dict, template_description: str, outline: dict, section: str) -> list:
+    """Second phase: one section, written in the context of the plan's outline"""
+    user_prompt = (
+        f"{lesson_user_prompt(data)}\n\n"
+        f"Plan so far:\n{json.dumps(outline, indent=2)}\n\n"
+        f"Write the complete '{section}' section of this plan, consistent with the plan so far."
+    )
+    return [
+        {"role": "system", "content": lesson_system_prompt(template_description, data.get('subtemplate') or '')},
+        {"role": "user", "content": user_prompt},
+    ]
@@ -0,0 +1,275 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import deque
+import aio
+import metrics
+from limiter import LimiterBusyError
+
+logger = logging.getLogger(__name__)
+
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.9))
+# Below this many samples the hedge deadline falls back to a share of the budget
+MIN_SAMPLES = 20
+
+
+class Route:
+    """Latency budget and model ladder (best first) for one kind of generation.
+
+    ``ROUTE_<NAME>_MODELS`` (comma separated) and ``ROUTE_<NAME>_BUDGET``
+    (seconds) override the defaults.
+    """
+
+    def __init__(self, name: str, models: tuple, budget: float):
+        prefix = f'ROUTE_{name.upper()}'
+        override = os.environ.get(f'{prefix}_MODELS')
+        self.name = name
+        self.models = tuple(model.strip() for model in override.split(',') if model.strip()) if override else models
+        self.budget = float(os.environ.get(f'{prefix}_BUDGET', budget))
+
+
+class LatencyWindow:
+    """Recent latencies of one model on one route"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class ModelRouter:
+    """Runs OpenAI calls within a per-route latency budget.
+
+    The route's first model is asked first. If it hasn't answered by the
+    ``HEDGE_PERCENTILE`` latency it has shown on that route, a hedged request
+    goes to the next model on the ladder; the first answer wins and the
+    other request is cancelled. A failed attempt falls through to the next
+    model straight away. Hedges are skipped when the limiter has no headroom,
+    so they never add to a backlog.
+    """
+
+    def __init__(self, client_getter, limiter, routes):
+        self.client_getter = client_getter
+        self.limiter = limiter
+        self.routes = {route.name: route for route in routes}
+        self._latency = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _window(self, route: str, model: str) -> LatencyWindow:
+        with self._lock:
+            return self._latency.setdefault((route, model), LatencyWindow())
+
+    def _count(self, route: str, name: str):
+        with self._lock:
+            counts = self._counts.setdefault(route, {})
+            counts[name] = counts.get(name, 0) + 1
+
+    def hedge_delay(self, route: Route, metric: str = 'complete') -> float:
+        observed = self._window(f'{route.name}:{metric}', route.models[0]).percentile(HEDGE_PERCENTILE)
+        delay = observed if observed is not None else route.budget * 0.6
+        return min(max(delay, 1.0), route.budget * 0.9)
+
+    async def _race(self, route_name: str, attempt, metric: str, discard=None):
+        """Run ``attempt(model)`` down the route's ladder, hedging slow calls.
+
+        Returns ``(result, model)``. Losing attempts still running are
+        cancelled; a loser that finished anyway (even in the same tick as the
+        winner, or as this call was cancelled) is handed to ``discard``.
+        ``metric`` names what the attempts' latency measures (whole responses
+        or first chunks), which is tracked separately.
+        """
+        route = self.routes[route_name]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + route.budget
+        hedge_at = start + self.hedge_delay(route, metric)
+        ladder = list(route.models)
+        pending = {}
+        errors = []
+        hedged = False
+        launched = 0
+
+        def launch(model):
+            nonlocal launched
+            pending[asyncio.ensure_future(attempt(model))] = (model, loop.time(), launched)
+            launched += 1
+
+        self._count(route_name, 'requests')
+        launch(ladder.pop(0))
+        try:
+            while pending:
+                now = loop.time()
+                if now >= deadline:
+                    self._count(route_name, 'budget_exceeded')
+                    raise TimeoutError(f"No response within the {route.budget:.0f}s budget for {route_name}")
+                wake = deadline if hedged else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(pending, timeout=max(wake - now, 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                winner = shed = None
+                for task in done:
+                    model, started, order = pending.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                        if isinstance(error, LimiterBusyError) and error.__cause__ is None:
+                            # Shed by our own queue, not the model: another rung would only queue too
+                            shed = error
+                            continue
+                        errors.append(error)
+                        logger.warning("%s attempt on %s failed: %s", route_name, model, error)
+                        continue
+                    if winner is None:
+                        winner = (task.result(), model, loop.time() - started, order)
+                    elif discard:
+                        await discard(task.result())
+                if winner:
+                    result, model, elapsed, order = winner
+                    self._window(f'{route_name}:{metric}', model).add(elapsed)
+                    for loser, loser_started, _ in pending.values():
+                        # A lower bound, but leaving slow losers out would drag the percentile down
+                        self._window(f'{route_name}:{metric}', loser).add(loop.time() - loser_started)
+                    self._count(route_name, f'served:{model}')
+                    if launched > 1:
+                        self._count(route_name, 'primary_won' if order == 0 else 'backup_won')
+                    return result, model
+                if shed:
+                    raise shed
+
+                if not pending and ladder:
+                    # Everything so far failed: fall through to the next model now
+                    self._count(route_name, 'fallbacks')
+                    launch(ladder.pop(0))
+                    hedged = True
+                elif not hedged and loop.time() >= hedge_at:
+                    hedged = True
+                    if self.limiter.has_headroom():
+                        self._count(route_name, 'hedged')
+                        launch(ladder.pop(0) if ladder else route.models[0])
+            raise errors[-1] if errors else RuntimeError(f"No model available for {route_name}")
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None and discard:
+                    try:
+                        await discard(task.result())
+                    except Exception as e:
+                        logger.warning("Could not discard a losing %s attempt: %s", route_name, e)
+
+    async def complete_async(self, route: str, **kwargs):
+        """Routed ``chat.completions.create``; returns ``(response, model)``"""
+        client = self.client_getter()
+
+        async def attempt(model):
+            with metrics.track('openai', route):
+                return await self.limiter.call_async(client.chat.completions.create, model=model, **kwargs)
+
+        return await self._race(route, attempt, 'complete')
+
+    def complete(self, route: str, **kwargs):
+        """Blocking ``complete_async``, run on the shared event loop"""
+        return aio.run(self.complete_async(route, **kwargs), timeout=self.routes[route].budget + 5)
+
+    async def stream_async(self, route: str, **kwargs):
+        """Routed streaming completion, hedged on time to first chunk.
+
+        Returns ``(model, chunks)`` once a model has started answering;
+        ``chunks`` is a :class:`RoutedStream` over the whole response. Runs
+        on the background loop (drive it with ``aio.iterate`` from threads).
+        """
+        client = self.client_getter()
+        limiter = self.limiter
+
+        async def attempt(model):
+            started = await limiter.acquire_async()
+            try:
+                with metrics.track('openai', f'{route}_first_chunk'):
+                    stream = await client.chat.completions.create(model=model, stream=True, **kwargs)
+                    iterator = stream.__aiter__()
+                    first = await iterator.__anext__()
+            except BaseException as e:
+                limiter.release(started, e)
+                raise
+            return stream, iterator, first, started
+
+        async def discard(opened):
+            stream, _, _, started = opened
+            limiter.release(started)
+            await stream.close()
+
+        (stream, iterator, first, started), model = await self._race(route, attempt, 'stream', discard)
+        return model, RoutedStream(limiter, stream, iterator, first, started)
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, route in self.routes.items():
+            with self._lock:
+                counts = dict(self._counts.get(name, {}))
+            stats[name] = {
+                'models': list(route.models),
+                'budget': route.budget,
+                'hedge_delay': round(self.hedge_delay(route), 3),
+                'stream_hedge_delay': round(self.hedge_delay(route, 'stream'), 3),
+                **counts,
+            }
+        return stats
+
+
+class RoutedStream:
+    """Chunks of a streaming completion; holds its limiter slot until exhausted or closed.
+
+    Closing it early (``aclose()``) cancels the upstream request.
+    """
+
+    _unread = object()
+
+    def __init__(self, limiter, stream, iterator, first, started: float):
+        self._limiter = limiter
+        self._stream = stream
+        self._iterator = iterator
+        self._first = first
+        self._started = started
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        if self._first is not self._unread:
+            chunk, self._first = self._first, self._unread
+            return chunk
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            await self._close(None)
+            raise
+        except BaseException as e:
+            await self._close(e)
+            raise
+
+    async def aclose(self):
+        # Abandoned before the end: counted as cancelled, not as a finished call
+        await self._close(asyncio.CancelledError())
+
+    async def _close(self, error):
+        if self._closed:
+            return
+        self._closed = True
+        self._limiter.release(self._started, error)
+        await self._stream.close()
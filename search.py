@@ -0,0 +1,163 @@
+import re
+import html
+import hashlib
+import logging
+from sqlalchemy import text
+from models import db, LessonPlan
+
+logger = logging.getLogger(__name__)
+
+# Plan sections worth searching besides the title and subject
+BODY_FIELDS = ('overview', 'objectives', 'procedure')
+
+# Marks matches in a snippet until the plan text around them has been escaped; neither
+# character occurs in plan text
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+
+def _flatten(value) -> str:
+    if isinstance(value, list):
+        return ' '.join(_flatten(item) for item in value)
+    if isinstance(value, dict):
+        return ' '.join(_flatten(item) for item in value.values())
+    return str(value) if value is not None else ''
+
+
+def _body(plan: dict) -> str:
+    return '\n'.join(_flatten(plan.get(field)) for field in BODY_FIELDS if plan.get(field))
+
+
+def _user_token(user_id: str) -> str:
+    # One opaque token per teacher, so FTS5 can restrict a match to their plans
+    return 'u' + hashlib.sha1(str(user_id).encode('utf-8')).hexdigest()[:20]
+
+
+def _highlight(snippet: str) -> str:
+    """``snippet`` as HTML: the plan text escaped and each match wrapped in <mark>"""
+    return html.escape(snippet or '').replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+def _terms(query: str) -> list:
+    return re.findall(r'\w+', query.lower())[:12]
+
+
+def _is_postgres() -> bool:
+    return db.engine.dialect.name == 'postgresql'
+
+
+def init_search():
+    """Create the full-text index (FTS5 on SQLite, tsvector + GIN on Postgres) and fill any gaps"""
+    if _is_postgres():
+        statements = [
+            """CREATE TABLE IF NOT EXISTS lesson_plan_search (
+                plan_id INTEGER PRIMARY KEY REFERENCES lesson_plans (id) ON DELETE CASCADE,
+                user_id VARCHAR(64) NOT NULL,
+                body TEXT NOT NULL,
+                document TSVECTOR NOT NULL
+            )""",
+            'CREATE INDEX IF NOT EXISTS ix_lesson_plan_search_document ON lesson_plan_search USING GIN (document)',
+            'CREATE INDEX IF NOT EXISTS ix_lesson_plan_search_user ON lesson_plan_search (user_id)',
+        ]
+        missing = 'SELECT id FROM lesson_plans WHERE id NOT IN (SELECT plan_id FROM lesson_plan_search)'
+    else:
+        statements = [
+            """CREATE VIRTUAL TABLE IF NOT EXISTS lesson_plan_search USING fts5 (
+                title, subject, body, owner,
+                tokenize = 'porter unicode61', prefix = '2 3'
+            )""",
+        ]
+        missing = 'SELECT id FROM lesson_plans WHERE id NOT IN (SELECT rowid FROM lesson_plan_search)'
+
+    for statement in statements:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+    ids = [row[0] for row in db.session.execute(text(missing))]
+    for start in range(0, len(ids), 500):
+        for entry in LessonPlan.query.filter(LessonPlan.id.in_(ids[start:start + 500])):
+            index_plan(entry)
+        db.session.commit()
+    if ids:
+        logger.info("Indexed %s saved plans for search", len(ids))
+
+
+def index_plan(entry: LessonPlan):
+    """Add or refresh ``entry`` in the search index; commits with the caller's session"""
+    db.session.flush()
+    params = {
+        'id': entry.id,
+        'title': entry.title or '',
+        'subject': entry.subject or '',
+        'body': _body(entry.plan or {}),
+    }
+    if _is_postgres():
+        db.session.execute(text("""
+            INSERT INTO lesson_plan_search (plan_id, user_id, body, document)
+            VALUES (:id, :user_id, :body,
+                    setweight(to_tsvector('english', :title), 'A') ||
+                    setweight(to_tsvector('english', :subject), 'B') ||
+                    setweight(to_tsvector('english', :body), 'C'))
+            ON CONFLICT (plan_id) DO UPDATE SET body = excluded.body, document = excluded.document
+        """), {**params, 'user_id': entry.user_id})
+    else:
+        db.session.execute(text('DELETE FROM lesson_plan_search WHERE rowid = :id'), params)
+        db.session.execute(text("""
+            INSERT INTO lesson_plan_search (rowid, title, subject, body, owner)
+            VALUES (:id, :title, :subject, :body, :owner)
+        """), {**params, 'owner': _user_token(entry.user_id)})
+
+
+def search_plans(user_id: str, query: str, limit: int = 20) -> list:
+    """Best-ranked saved plans matching every word of ``query`` (as a prefix), with snippets"""
+    terms = _terms(query)
+    if not terms:
+        return []
+
+    if _is_postgres():
+        rows = db.session.execute(text("""
+            SELECT hit.plan_id,
+                   ts_headline('english', hit.body, q, :options),
+                   hit.rank
+            FROM (
+                SELECT plan_id, body, ts_rank_cd(document, q) AS rank
+                FROM lesson_plan_search, to_tsquery('english', :query) q
+                WHERE user_id = :user_id AND document @@ q
+                ORDER BY rank DESC
+                LIMIT :limit
+            ) hit, to_tsquery('english', :query) q
+            ORDER BY hit.rank DESC
+        """), {
+            'query': ' & '.join(f'{term}:*' for term in terms),
+            'options': f'StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords=24, MinWords=8',
+            'user_id': user_id,
+            'limit': limit,
+        }).fetchall()
+    else:
+        match = ' AND '.join(f'"{term}"*' for term in terms)
+        rows = db.session.execute(text("""
+            SELECT rowid,
+                   snippet(lesson_plan_search, 2, :start, :end, '…', 16),
+                   -bm25(lesson_plan_search, 10.0, 5.0, 1.0, 0.0)
+            FROM lesson_plan_search
+            WHERE lesson_plan_search MATCH :match
+            ORDER BY bm25(lesson_plan_search, 10.0, 5.0, 1.0, 0.0)
+            LIMIT :limit
+        """), {
+            # The words match the plan's text only, never the owner token
+            'match': f'owner:{_user_token(user_id)} AND {{title subject body}}: ({match})',
+            'start': SNIPPET_START,
+            'end': SNIPPET_END,
+            'limit': limit,
+        }).fetchall()
+
+    if not rows:
+        return []
+    plans = {
+        plan.id: plan
+        for plan in LessonPlan.query.filter(LessonPlan.id.in_([row[0] for row in rows]),
+                                            LessonPlan.user_id == user_id)
+    }
+    return [
+        {**plans[plan_id].summary(), 'snippet': _highlight(snippet), 'score': round(float(score), 4)}
+        for plan_id, snippet, score in rows if plan_id in plans
+    ]
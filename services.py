@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import threading
+import stripe
+from openai import AsyncOpenAI
+from auth import SupabaseAuth
+from transport import transport
+
+logger = logging.getLogger(__name__)
+
+
+class LazyService:
+    """A dependency that is built on first use instead of at import time.
+
+    With ``ttl`` set the value is rebuilt once it is older than ``ttl`` seconds;
+    if the rebuild fails the previous value keeps being served and the next
+    attempt waits ``retry_interval`` seconds.
+    """
+
+    def __init__(self, name: str, factory, ttl: float = None, retry_interval: float = 60.0):
+        self.name = name
+        self.factory = factory
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.error = None
+        self._value = None
+        self._loaded_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded_at is not None
+
+    def _fresh(self) -> bool:
+        if self._loaded_at is None:
+            return False
+        now = time.monotonic()
+        if self.ttl is None or now - self._loaded_at < self.ttl:
+            return True
+        # A failed refresh: keep serving the stale value until it is time to try again
+        return self._failed_at is not None and now - self._failed_at < self.retry_interval
+
+    def get(self):
+        if self._fresh():
+            return self._value
+        with self._lock:
+            if self._fresh():
+                return self._value
+            try:
+                self._value = self.factory()
+                self._loaded_at = time.monotonic()
+                self._failed_at = None
+                self.error = None
+                logger.info("Initialized %s", self.name)
+            except Exception as e:
+                self.error = str(e)
+                self._failed_at = time.monotonic()
+                if self._loaded_at is None:
+                    logger.error("Failed to initialize %s: %s", self.name, e)
+                    raise
+                logger.warning("Failed to refresh %s, serving cached value: %s", self.name, e)
+            return self._value
+
+
+def _create_async_openai():
+    # Only used on the background event loop. No SDK retries: a 429 has to reach the
+    # limiter (to lower the limit and honour Retry-After) and the router falls
+    # through to the next model, instead of the SDK retrying inside a held slot.
+    return AsyncOpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        http_client=transport.async_client('openai'),
+        timeout=transport.timeout('openai'),
+        max_retries=0,
+    )
+
+
+def _retrieve_price():
+    price_id = os.environ.get("STRIPE_PRICE_ID")
+    try:
+        return stripe.Price.retrieve(price_id)
+    except stripe.error.InvalidRequestError as e:
+        logger.error("Invalid Stripe Price ID: %s", price_id)
+        raise ValueError(f"Invalid Stripe Price ID: {str(e)}")
+
+
+async_openai_client = LazyService('async_openai', _create_async_openai)
+supabase_auth = LazyService('supabase_auth', SupabaseAuth)
+stripe_price = LazyService('stripe_price', _retrieve_price,
+                           ttl=float(os.environ.get('STRIPE_PRICE_TTL', 3600)))
+
+SERVICES = (async_openai_client, supabase_auth, stripe_price)
+
+_warm_up_thread = None
+
+
+def warm_up(retry_interval: float = 5.0, max_interval: float = 60.0):
+    """Initialize every service, retrying the ones that fail with backoff"""
+    interval = retry_interval
+    while True:
+        pending = [service for service in SERVICES if not service.ready]
+        if not pending:
+            logger.info("All services warmed up")
+            return
+        for service in pending:
+            try:
+                service.get()
+            except Exception:
+                pass
+        if all(service.ready for service in SERVICES):
+            continue
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def start_warm_up():
+    global _warm_up_thread
+    if _warm_up_thread is None:
+        _warm_up_thread = threading.Thread(target=warm_up, name='service-warm-up', daemon=True)
+        _warm_up_thread.start()
+
+
+def readiness() -> dict:
+    return {
+        service.name: {'ready': service.ready, **({'error': service.error} if service.error else {})}
+        for service in SERVICES
+    }
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+
+class FlightError(Exception):
+    """Raised to followers when the call they were waiting on failed"""
+
+
+class Flight:
+    """One caller's part in a coalesced call.
+
+    The leader runs the call and must end it with ``finish()`` or ``fail()``;
+    ``close()`` fails it if neither happened (e.g. the client went away).
+    Only the first of these takes effect. Followers ``wait()`` (or
+    ``wait_async()``) for the leader's result.
+    """
+
+    def __init__(self, group, key: str, leader: bool, call):
+        self.group = group
+        self.key = key
+        self.leader = leader
+        self.owner = None
+        # Set by begin(wait=False) when another worker leads: the caller collects its result
+        self.remote = False
+        self._call = call
+        self._done = False
+
+    def _end(self) -> bool:
+        with self.group._lock:
+            ended, self._done = self._done, True
+        return not ended
+
+    def finish(self, result):
+        if self._end():
+            self.group._complete(self, result=result)
+
+    def fail(self, error):
+        if self._end():
+            self.group._complete(self, error=str(error))
+
+    def close(self):
+        if self.leader:
+            self.fail('Generation was abandoned')
+
+    def wait(self, timeout: float = None):
+        return self.group._wait(self, timeout)
+
+    async def wait_async(self, timeout: float = None):
+        return await self.group._wait_async(self, timeout)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        # (loop, future) per follower awaiting the call on an event loop
+        self.futures = []
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls so only one reaches the upstream.
+
+    Within a process followers wait on the leader's thread. Across worker
+    processes a local SQLite table acts as the lock and result slot: the
+    first worker to insert a key leads, the others poll it until the result
+    is published. Followers only join a call that is still running: a
+    finished call's row is kept ``result_ttl`` seconds for the followers
+    already polling it, but the next caller takes it over and leads a new
+    call; this is not a cache. A lock older than ``lock_ttl`` seconds is
+    treated as abandoned and can be taken over.
+    """
+
+    def __init__(self, db_path: str = None, lock_ttl: float = None, result_ttl: float = None,
+                 poll_interval: float = 0.25):
+        self.db_path = db_path or os.environ.get(
+            'SINGLEFLIGHT_DB_PATH', os.path.join(DATA_DIR, 'singleflight.db'))
+        self.lock_ttl = lock_ttl if lock_ttl is not None else float(
+            os.environ.get('SINGLEFLIGHT_LOCK_TTL', 120))
+        self.result_ttl = result_ttl if result_ttl is not None else float(
+            os.environ.get('SINGLEFLIGHT_RESULT_TTL', 30))
+        self.poll_interval = poll_interval
+
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counts = {'leaders': 0, 'coalesced_local': 0, 'coalesced_remote': 0, 'failed': 0}
+        self._local = threading.local()
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._init_db()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS flights (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS flight_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+        try:
+            self._connection().execute("""
+                INSERT INTO flight_counters (name, value) VALUES (?, 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1
+            """, (name,))
+        except sqlite3.Error as e:
+            logger.warning("Could not record single-flight counter %s: %s", name, e)
+
+    def _claim(self, key: str, owner: str) -> bool:
+        """Take the cross-worker lock for ``key`` unless a running flight holds it"""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('DELETE FROM flights WHERE expires_at < ?', (now,))
+        cursor = conn.execute("""
+            INSERT INTO flights (key, owner, status, expires_at) VALUES (?, ?, 'running', ?)
+            ON CONFLICT(key) DO UPDATE SET
+                owner = excluded.owner,
+                status = excluded.status,
+                result = NULL,
+                error = NULL,
+                expires_at = excluded.expires_at
+            WHERE flights.status != 'running'
+        """, (key, owner, now + self.lock_ttl))
+        return cursor.rowcount > 0
+
+    def begin(self, key: str, wait: bool = True) -> Flight:
+        """Join the call for ``key``, leading it if nobody else is.
+
+        When another worker leads, this waits for its result on behalf of
+        every caller in this process; with ``wait`` false it returns a
+        ``remote`` flight instead, and the caller must collect the result
+        (see ``begin_async``).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            following = call is not None
+            if not following:
+                call = self._calls[key] = _Call()
+        if following:
+            self._count('coalesced_local')
+            return Flight(self, key, False, call)
+
+        owner = uuid.uuid4().hex
+        try:
+            leader = self._claim(key, owner)
+        except sqlite3.Error as e:
+            # The lock table is an optimization; without it this worker just leads
+            logger.warning("Single-flight lock unavailable for %s: %s", key, e)
+            leader = True
+
+        if leader:
+            self._count('leaders')
+            flight = Flight(self, key, True, call)
+            flight.owner = owner
+            return flight
+
+        # Another worker holds the call: wait for its result once on behalf of
+        # every caller in this process
+        self._count('coalesced_remote')
+        flight = Flight(self, key, False, call)
+        if not wait:
+            flight.remote = True
+            return flight
+        try:
+            self._settle(key, call, result=self._wait_remote(key))
+        except Exception as e:
+            self._settle(key, call, error=str(e))
+        return flight
+
+    async def begin_async(self, key: str) -> Flight:
+        """``begin`` for a coroutine: waiting on another worker polls without holding a thread"""
+        joining = asyncio.ensure_future(asyncio.to_thread(self.begin, key, False))
+        try:
+            flight = await asyncio.shield(joining)
+        except asyncio.CancelledError:
+            # The join still completes on its thread; let go of whatever it took on
+            joining.add_done_callback(self._abandon)
+            raise
+        if flight.remote:
+            try:
+                self._settle(key, flight._call, result=await self._wait_remote_async(key))
+            except Exception as e:
+                self._settle(key, flight._call, error=str(e))
+            except BaseException:
+                self._settle(key, flight._call, error='Generation was abandoned')
+                raise
+        return flight
+
+    def _abandon(self, joining: asyncio.Future):
+        if joining.cancelled() or joining.exception() is not None:
+            return
+        flight = joining.result()
+        if flight.leader:
+            asyncio.get_running_loop().run_in_executor(None, flight.close)
+        elif flight.remote:
+            self._settle(flight.key, flight._call, error='Generation was abandoned')
+
+    def _settle(self, key: str, call: _Call, result=None, error=None):
+        call.result, call.error = result, error
+        with self._lock:
+            self._calls.pop(key, None)
+            call.event.set()
+            futures, call.futures = call.futures, []
+        for loop, future in futures:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                pass  # The follower's loop has closed
+
+    def _complete(self, flight: Flight, result=None, error=None):
+        if not flight.leader:
+            return
+        self._settle(flight.key, flight._call, result, error)
+        if error is not None:
+            self._count('failed')
+        try:
+            self._connection().execute("""
+                UPDATE flights SET status = ?, result = ?, error = ?, expires_at = ?
+                WHERE key = ? AND owner = ?
+            """, ('failed' if error is not None else 'done',
+                  json.dumps(result) if error is None else None, error,
+                  time.time() + self.result_ttl, flight.key, flight.owner))
+        except sqlite3.Error as e:
+            logger.warning("Could not publish single-flight result for %s: %s", flight.key, e)
+
+    def _poll(self, key: str):
+        """(finished, result) of another worker's flight; raises FlightError if it failed or vanished"""
+        row = self._connection().execute(
+            'SELECT status, result, error FROM flights WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise FlightError('Timed out waiting for an identical generation')
+        status, result, error = row
+        if status == 'done':
+            return True, json.loads(result)
+        if status == 'failed':
+            raise FlightError(error or 'Generation failed')
+        return False, None
+
+    def _wait_remote(self, key: str):
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            finished, result = self._poll(key)
+            if finished:
+                return result
+            time.sleep(self.poll_interval)
+        raise FlightError('Timed out waiting for an identical generation')
+
+    async def _wait_remote_async(self, key: str):
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            finished, result = await asyncio.to_thread(self._poll, key)
+            if finished:
+                return result
+            await asyncio.sleep(self.poll_interval)
+        raise FlightError('Timed out waiting for an identical generation')
+
+    def _wait(self, flight: Flight, timeout: float = None):
+        call = flight._call
+        if not call.event.wait(timeout if timeout is not None else self.lock_ttl):
+            raise FlightError('Timed out waiting for an identical generation')
+        return self._outcome(call)
+
+    async def _wait_async(self, flight: Flight, timeout: float = None):
+        call = flight._call
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if not call.event.is_set():
+                call.futures.append((loop, future))
+            else:
+                future.set_result(None)
+        try:
+            await asyncio.wait_for(future, timeout if timeout is not None else self.lock_ttl)
+        except asyncio.TimeoutError:
+            raise FlightError('Timed out waiting for an identical generation')
+        return self._outcome(call)
+
+    @staticmethod
+    def _outcome(call: _Call):
+        if call.error is not None:
+            raise FlightError(call.error)
+        return call.result
+
+    def do(self, key: str, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` once for all concurrent callers with ``key``.
+
+        Returns ``(result, coalesced)``.
+        """
+        flight = self.begin(key)
+        if not flight.leader:
+            return flight.wait(), True
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.fail(e)
+            raise
+        flight.finish(result)
+        return result, False
+
+    async def do_async(self, key: str, fn, *args, **kwargs):
+        """``do`` for a coroutine function.
+
+        Followers await the leader without holding a thread; only the short
+        SQLite steps (claiming, publishing, polling another worker's flight)
+        run on the default executor.
+        """
+        flight = await self.begin_async(key)
+        if not flight.leader:
+            return await flight.wait_async(), True
+        try:
+            result = await fn(*args, **kwargs)
+            await asyncio.to_thread(flight.finish, result)
+        except Exception as e:
+            await asyncio.to_thread(flight.fail, e)
+            raise
+        finally:
+            if not flight._done:
+                # Cancelled: let followers know now rather than at the lock TTL
+                await asyncio.to_thread(flight.close)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counts, in_flight=len(self._calls))
+        try:
+            totals = dict(self._connection().execute(
+                'SELECT name, value FROM flight_counters').fetchall())
+            stats['totals'] = {name: totals.get(name, 0) for name in self._counts}
+        except sqlite3.Error:
+            pass
+        return stats
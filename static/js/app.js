@@ -20,6 +20,13 @@ document.addEventListener('DOMContentLoaded', function() {
     // Template variables
     let selectedTemplate = '';
     let currentSubtemplate = '';
+    let lastFormData = null;
+    let currentPlan = null;
+
+    // For text from plans and requests interpolated into innerHTML templates
+    const escapeHtml = (value) => String(value ?? '').replace(/[&<>"']/g, char => ({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+    })[char]);
 
     // DOM elements
     const templateCards = document.querySelectorAll('.template-card');
@@ -28,6 +35,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const lessonOutput = document.getElementById('lessonPlanOutput');
     const sidebar = document.getElementById('historySidebar');
     const closeSidebar = document.getElementById('closeSidebar');
+    const regenerateBtn = document.getElementById('regeneratePlan');
 
     // Show template modal on page load for /app route
     if (window.location.pathname === '/app') {
@@ -67,6 +75,135 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    const listItems = items => (items || []).map(item => `<li>${escapeHtml(item)}</li>`).join('');
+
+    // How to title and render each section the server can return; sections
+    // appear in the order they arrive, and unknown keys fall back to renderGeneric
+    const SECTION_RENDERERS = {
+        overview: { title: 'Overview',
+            render: value => `<p>${escapeHtml(value || 'No overview provided')}</p>` },
+        objectives: { title: 'Objectives',
+            render: value => `<ul>${listItems(Array.isArray(value) ? value : ['No objectives specified'])}</ul>` },
+        materials: { title: 'Materials', render: value => `<ul>${listItems(value)}</ul>` },
+        procedure: { title: 'Procedure', render: value => `<ol>${listItems(value)}</ol>` },
+        assessment: { title: 'Assessment',
+            render: value => `<p>${escapeHtml(value || 'No assessment provided')}</p>` },
+        extensions: { title: 'Extensions', render: value => `<ul>${listItems(value)}</ul>` },
+        outline: { title: 'Outline', render: value => `<ul>${listItems(value)}</ul>` },
+        evidence: { title: 'Evidence Statements', render: value => `<ul>${listItems(value)}</ul>` },
+        prompts: { title: 'Prompts', render: value => `<ol>${listItems(value)}</ol>` },
+        vocabulary: { title: 'Vocabulary',
+            render: value => `<dl>${(value || []).map(entry => `
+                <dt>${escapeHtml(entry.term)}</dt>
+                <dd>${escapeHtml(entry.definition)}${entry.example ? `<br><em>${escapeHtml(entry.example)}</em>` : ''}</dd>
+            `).join('')}</dl>` },
+        questions: { title: 'Questions',
+            render: value => `<ol>${(value || []).map(q => `
+                <li class="mb-2">
+                    ${escapeHtml(q.question)}
+                    ${q.choices && q.choices.length ? `<ol type="A">${listItems(q.choices)}</ol>` : ''}
+                    <div class="text-muted small">Answer: ${escapeHtml(q.answer)}${q.explanation ? ` &mdash; ${escapeHtml(q.explanation)}` : ''}</div>
+                </li>
+            `).join('')}</ol>` },
+        rubric: { title: 'Rubric',
+            render: value => `<div class="table-responsive"><table class="table table-sm">
+                ${(value || []).map(row => `
+                    <tr>
+                        <th>${escapeHtml(row.criterion)}</th>
+                        ${(row.levels || []).map(level => `
+                            <td><strong>${escapeHtml(level.label)}</strong> (${escapeHtml(level.score)})<br>${escapeHtml(level.description)}</td>
+                        `).join('')}
+                    </tr>
+                `).join('')}
+            </table></div>` }
+    };
+
+    // Request fields that older history entries stored alongside the plan
+    const HISTORY_FIELDS = ['template', 'subtemplate', 'subject', 'grade', 'duration', 'timestamp'];
+    // Outline bookkeeping returned by the server, not rendered as sections
+    const OUTLINE_FIELDS = ['plan_id', 'pending_sections'];
+
+    function renderGeneric(value) {
+        if (Array.isArray(value)) {
+            return `<ul>${listItems(value.map(item => typeof item === 'object' ? JSON.stringify(item) : item))}</ul>`;
+        }
+        return `<p>${escapeHtml(typeof value === 'object' ? JSON.stringify(value) : value)}</p>`;
+    }
+
+    function sectionTitle(key) {
+        return SECTION_RENDERERS[key]?.title ||
+            key.replace(/_/g, ' ').replace(/\b\w/g, letter => letter.toUpperCase());
+    }
+
+    const createSection = (key) => `
+        <div class="content-section mb-4" data-section="${escapeHtml(key)}">
+            <div class="section-header d-flex justify-content-between align-items-center" 
+                 onclick="this.closest('.content-section').querySelector('.section-content').classList.toggle('show')">
+                <h4 class="mb-0">${escapeHtml(sectionTitle(key))}</h4>
+                <i class="fas fa-chevron-down"></i>
+            </div>
+            <div class="section-content collapse">
+                <div class="section-summary text-muted mb-2"></div>
+                <div class="section-details"></div>
+            </div>
+        </div>
+    `;
+
+    // Render the plan title and an empty container for its sections
+    function renderPlanShell(title) {
+        lessonOutput.innerHTML = `
+            <h3 class="mb-4 plan-title">${escapeHtml(title)}</h3>
+            <div class="plan-sections"></div>
+        `;
+    }
+
+    // Find a section's element, appending it (open if it is the first) when missing
+    function sectionElement(key) {
+        const container = lessonOutput.querySelector('.plan-sections');
+        if (!container) {
+            return null;
+        }
+        let sectionEl = container.querySelector(`[data-section="${CSS.escape(key)}"]`);
+        if (!sectionEl) {
+            container.insertAdjacentHTML('beforeend', createSection(key));
+            sectionEl = container.lastElementChild;
+            // Show first section by default
+            if (container.children.length === 1) {
+                sectionEl.querySelector('.section-content').classList.add('show');
+            }
+        }
+        return sectionEl;
+    }
+
+    // Fill in one top-level key of the plan (title, a section or a section summary)
+    function fillPlanSection(key, value) {
+        if (key === 'title') {
+            const titleEl = lessonOutput.querySelector('.plan-title');
+            if (titleEl) {
+                titleEl.textContent = value || 'Untitled Plan';
+            }
+            return;
+        }
+        if (value === undefined || value === null) {
+            return;
+        }
+
+        const isSummary = key.endsWith('_summary');
+        const sectionKey = isSummary ? key.slice(0, -'_summary'.length) : key;
+        const sectionEl = sectionElement(sectionKey);
+        if (!sectionEl) {
+            return;
+        }
+
+        if (isSummary) {
+            sectionEl.querySelector('.section-summary').textContent =
+                Array.isArray(value) ? value[0] || '' : '';
+        } else {
+            const render = SECTION_RENDERERS[sectionKey]?.render || renderGeneric;
+            sectionEl.querySelector('.section-details').innerHTML = render(value);
+        }
+    }
+
     // Display lesson plan with expandable sections
     function displayLessonPlan(data) {
         if (!data || typeof data !== 'object') {
@@ -74,58 +211,183 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
-        if (!data.objectives || !Array.isArray(data.objectives)) {
-            console.warn('Invalid objectives data:', data.objectives);
-            data.objectives = ['No objectives specified'];
+        currentPlan = data;
+        renderPlanShell(data.title || 'Untitled Plan');
+        Object.entries(data)
+            .filter(([key]) => !HISTORY_FIELDS.includes(key) && !OUTLINE_FIELDS.includes(key))
+            .forEach(([key, value]) => fillPlanSection(key, value));
+        markPendingSections(data);
+    }
+
+    // Sections of an outline that are written only once the user opens them
+    function markPendingSections(plan) {
+        (plan.pending_sections || [])
+            .filter(key => plan[key] === undefined)
+            .forEach(key => {
+                const sectionEl = sectionElement(key);
+                if (!sectionEl) {
+                    return;
+                }
+                sectionEl.dataset.pending = 'true';
+                if (sectionEl.querySelector('.section-content').classList.contains('show')) {
+                    loadSection(sectionEl);
+                }
+            });
+    }
+
+    // Generate a pending section of the current plan and fill it in
+    async function loadSection(sectionEl) {
+        const key = sectionEl.dataset.section;
+        if (sectionEl.dataset.pending !== 'true' || !currentPlan?.plan_id) {
+            return;
         }
+        const plan = currentPlan;
+        const details = sectionEl.querySelector('.section-details');
+        sectionEl.dataset.pending = 'loading';
+        details.innerHTML = '<span class="spinner-border spinner-border-sm" role="status"></span> Writing this section...';
 
-        const createSection = (title, content, summary) => `
-            <div class="content-section mb-4">
-                <div class="section-header d-flex justify-content-between align-items-center" 
-                     onclick="this.closest('.content-section').querySelector('.section-content').classList.toggle('show')">
-                    <h4 class="mb-0">${title}</h4>
-                    <i class="fas fa-chevron-down"></i>
-                </div>
-                <div class="section-content collapse">
-                    <div class="section-summary text-muted mb-2">
-                        ${Array.isArray(summary) ? summary[0] || '' : ''}
-                    </div>
-                    <div class="section-details">
-                        ${content}
-                    </div>
+        try {
+            const response = await fetch('/generate/section', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ plan_id: plan.plan_id, section: key })
+            });
+
+            let data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || `HTTP error! status: ${response.status}`);
+            }
+            if (response.status === 202) {
+                data = await waitForJob(data.status_url);
+            }
+
+            plan[key] = data.value;
+            updateHistoryPlan(plan);
+            if (currentPlan === plan) {
+                delete sectionEl.dataset.pending;
+                fillPlanSection(key, data.value);
+            }
+        } catch (error) {
+            console.error('Error loading section:', error);
+            sectionEl.dataset.pending = 'true';
+            details.innerHTML = `
+                <div class="alert alert-danger">
+                    <i class="fas fa-exclamation-circle"></i>
+                    Error: ${escapeHtml(error.message)}
                 </div>
-            </div>
-        `;
+            `;
+        }
+    }
 
-        const html = `
-            <h3 class="mb-4">${data.title || 'Untitled Plan'}</h3>
-            ${createSection('Overview',
-                `<p>${data.overview || 'No overview provided'}</p>`,
-                data.overview_summary)}
-            ${createSection('Objectives',
-                `<ul>${(data.objectives || []).map(obj => `<li>${obj}</li>`).join('')}</ul>`,
-                data.objectives_summary)}
-            ${createSection('Materials',
-                `<ul>${(data.materials || []).map(mat => `<li>${mat}</li>`).join('')}</ul>`,
-                data.materials_summary)}
-            ${createSection('Procedure',
-                `<ol>${(data.procedure || []).map(step => `<li>${step}</li>`).join('')}</ol>`,
-                data.procedure_summary)}
-            ${createSection('Assessment',
-                `<p>${data.assessment || 'No assessment provided'}</p>`,
-                data.assessment_summary)}
-            ${createSection('Extensions',
-                `<ul>${(data.extensions || []).map(ext => `<li>${ext}</li>`).join('')}</ul>`,
-                data.extensions_summary)}
-        `;
+    // Load pending sections as they are expanded
+    lessonOutput?.addEventListener('click', (e) => {
+        const header = e.target.closest('.section-header');
+        const sectionEl = header?.closest('.content-section');
+        if (sectionEl?.dataset.pending === 'true' &&
+            sectionEl.querySelector('.section-content').classList.contains('show')) {
+            loadSection(sectionEl);
+        }
+    });
+
+    // Read a Server-Sent Events response body, calling onEvent(name, data) per event
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let name = 'message';
+                let dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        name = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).trim());
+                    }
+                });
+                if (dataLines.length) {
+                    onEvent(name, JSON.parse(dataLines.join('\n')));
+                }
+            }
+        }
+    }
+
+    // Poll a background job until it finishes, resolving with its result
+    async function waitForJob(statusUrl, interval = 1000) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, interval));
+            const response = await fetch(statusUrl);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+
+            const job = await response.json();
+            if (job.status === 'succeeded') {
+                return job.result;
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error || 'Generation failed');
+            }
+        }
+    }
 
-        lessonOutput.innerHTML = html;
+    // Error for a failed response, using the server's message (and retry hint when it is busy)
+    async function responseError(response) {
+        const body = await response.json().catch(() => ({}));
+        if (response.status === 503 && body.retry_after) {
+            return new Error(`${body.error} Try again in ${body.retry_after} seconds.`);
+        }
+        return new Error(body.error || `HTTP error! status: ${response.status}`);
+    }
+
+    // Stream a plan section by section, resolving with the complete plan
+    async function streamPlan(formData) {
+        const response = await fetch('/generate/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(formData)
+        });
 
-        // Show first section by default
-        const firstSection = lessonOutput.querySelector('.section-content');
-        if (firstSection) {
-            firstSection.classList.add('show');
+        if (!response.ok) {
+            throw await responseError(response);
         }
+
+        const plan = {};
+        let finished = false;
+        renderPlanShell('Generating...');
+        await readEventStream(response, (name, data) => {
+            if (name === 'section') {
+                plan[data.key] = data.value;
+                fillPlanSection(data.key, data.value);
+            } else if (name === 'error') {
+                throw new Error(data.error);
+            } else if (name === 'done') {
+                OUTLINE_FIELDS
+                    .filter(key => data[key] !== undefined)
+                    .forEach(key => { plan[key] = data[key]; });
+                finished = true;
+            }
+        });
+
+        if (!finished) {
+            throw new Error('The plan stream ended unexpectedly');
+        }
+        return plan;
     }
 
     // Form submission
@@ -151,94 +413,351 @@ document.addEventListener('DOMContentLoaded', function() {
         `;
 
         const formData = {
+            ...currentFormParams(),
+            // Sections are generated when they are first expanded
+            mode: 'outline'
+        };
+
+        try {
+            await requestPlan(formData);
+        } finally {
+            // Reset button state
+            submitBtn.disabled = false;
+            submitBtn.textContent = 'Generate Plan';
+        }
+    });
+
+    // Exports are rendered on the server; the browser just downloads the file
+    async function exportPlan(format, button) {
+        if (!currentPlan) {
+            alert('Generate or open a plan first');
+            return;
+        }
+        button.disabled = true;
+        try {
+            const response = await fetch('/export', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ plan: currentPlan, format })
+            });
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || `HTTP error! status: ${response.status}`);
+            }
+            window.location.href = data.url;
+        } catch (error) {
+            console.error('Error exporting plan:', error);
+            alert(`Export failed: ${error.message}`);
+        } finally {
+            button.disabled = false;
+        }
+    }
+
+    const exportPdfBtn = document.getElementById('exportPDF');
+    const exportWordBtn = document.getElementById('exportWord');
+    exportPdfBtn?.addEventListener('click', () => exportPlan('pdf', exportPdfBtn));
+    exportWordBtn?.addEventListener('click', () => exportPlan('docx', exportWordBtn));
+
+    // Offer existing plans similar to what is being typed, before anything is generated
+    const suggestionsEl = document.getElementById('planSuggestions');
+    let suggestTimer = null;
+    let suggestController = null;
+
+    function currentFormParams() {
+        return {
             template: selectedTemplate,
             subtemplate: currentSubtemplate,
-            subject: this.elements.subject.value,
-            grade: this.elements.grade?.value || '',
-            duration: this.elements.duration?.value || '',
-            objectives: this.elements.requirements?.value || ''
+            subject: lessonForm.elements.subject.value,
+            grade: lessonForm.elements.grade?.value || '',
+            duration: lessonForm.elements.duration?.value || '',
+            objectives: lessonForm.elements.requirements?.value || ''
         };
+    }
 
+    async function fetchSuggestions() {
+        const params = currentFormParams();
+        if (!suggestionsEl || !params.subject.trim()) {
+            if (suggestionsEl) {
+                suggestionsEl.innerHTML = '';
+            }
+            return;
+        }
+
+        suggestController?.abort();
+        suggestController = new AbortController();
         try {
-            // Generate lesson plan
-            const response = await fetch('/generate', {
+            const response = await fetch('/suggest', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify(formData)
+                body: JSON.stringify({ ...params, k: 3 }),
+                signal: suggestController.signal
             });
-
             if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+                return;
+            }
+            const { suggestions } = await response.json();
+            suggestionsEl.innerHTML = suggestions.length ? `
+                <small class="text-muted mb-1">Similar plans ready now:</small>
+                ${suggestions.map((item, index) => `
+                    <button type="button" class="list-group-item list-group-item-action" data-suggestion="${index}">
+                        <div class="d-flex justify-content-between align-items-center">
+                            <strong>${escapeHtml(item.title || 'Untitled Plan')}</strong>
+                            <small>${item.params.grade ? `Grade ${escapeHtml(item.params.grade)}` : ''}</small>
+                        </div>
+                        <small class="text-muted">${escapeHtml(item.params.subtemplate || item.params.template)}</small>
+                    </button>
+                `).join('')}` : '';
+            suggestionsEl.querySelectorAll('[data-suggestion]').forEach(button => {
+                button.addEventListener('click', () => {
+                    suggestionsEl.innerHTML = '';
+                    requestPlan(suggestions[button.dataset.suggestion].params);
+                });
+            });
+        } catch (error) {
+            if (error.name !== 'AbortError') {
+                console.error('Error fetching suggestions:', error);
             }
+        }
+    }
 
-            const data = await response.json();
+    lessonForm?.addEventListener('input', () => {
+        clearTimeout(suggestTimer);
+        suggestTimer = setTimeout(fetchSuggestions, 300);
+    });
+
+    // Request a plan from the server; identical requests are served from its cache
+    // unless formData.regenerate is set
+    async function requestPlan(formData) {
+        try {
+            let data;
+            if (window.ReadableStream && window.TextDecoder) {
+                data = await streamPlan(formData);
+            } else {
+                const response = await fetch('/generate', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify(formData)
+                });
+
+                if (!response.ok) {
+                    throw await responseError(response);
+                }
+
+                data = await response.json();
+                if (response.status === 202) {
+                    data = await waitForJob(data.status_url);
+                }
+            }
             displayLessonPlan(data);
-            saveToHistory(data, formData);
+            const { regenerate, ...params } = formData;
+            saveToHistory(data, params);
+            lastFormData = params;
+            if (regenerateBtn) {
+                regenerateBtn.disabled = false;
+            }
 
         } catch (error) {
             console.error('Error:', error);
             lessonOutput.innerHTML = `
                 <div class="alert alert-danger">
                     <i class="fas fa-exclamation-circle"></i>
-                    Error: ${error.message}
+                    Error: ${escapeHtml(error.message)}
                 </div>
             `;
+        }
+    }
+
+    // Regenerate the last plan, bypassing the server cache
+    regenerateBtn?.addEventListener('click', async () => {
+        if (!lastFormData) {
+            return;
+        }
+        regenerateBtn.disabled = true;
+        try {
+            await requestPlan({ ...lastFormData, regenerate: true });
         } finally {
-            // Reset button state
-            submitBtn.disabled = false;
-            submitBtn.textContent = 'Generate Plan';
+            regenerateBtn.disabled = false;
         }
     });
 
-    // Load history from localStorage
-    const loadHistory = () => {
-        const history = JSON.parse(localStorage.getItem('lessonHistory') || '[]');
-        const historyContainer = document.getElementById('lessonHistory');
-        if (historyContainer) {
-            historyContainer.innerHTML = history.map((item, index) => `
-                <div class="list-group-item list-group-item-action" role="button" onclick="loadLessonPlan(${index})">
+    // Plan history is kept on the server and listed a page at a time
+    const historyContainer = document.getElementById('lessonHistory');
+    // Saved history id (as a promise, the save may still be in flight) per displayed plan
+    const savedPlans = new WeakMap();
+    let historyCursor = null;
+
+    const historyRow = (item) => `
+        <div class="list-group-item list-group-item-action" role="button" onclick="loadLessonPlan(${item.id})">
+            <div class="d-flex justify-content-between align-items-center">
+                <h5 class="mb-1">${escapeHtml(item.title || 'Untitled Plan')}</h5>
+                <small>${new Date(item.created_at).toLocaleDateString()}</small>
+            </div>
+            <p class="mb-1">${escapeHtml(item.subject || 'No subject')}</p>
+        </div>
+    `;
+
+    // Load the first page of history, or the next one when more is set
+    const loadHistory = async (more = false) => {
+        if (!historyContainer) {
+            return;
+        }
+        try {
+            const query = more && historyCursor ? `?cursor=${encodeURIComponent(historyCursor)}` : '';
+            const response = await fetch(`/history${query}`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const page = await response.json();
+            historyCursor = page.next_cursor;
+
+            historyContainer.querySelector('.history-more')?.remove();
+            const rows = page.items.map(historyRow).join('');
+            if (more) {
+                historyContainer.insertAdjacentHTML('beforeend', rows);
+            } else {
+                historyContainer.innerHTML = rows || '<p class="text-muted p-3 history-empty">No plans yet</p>';
+            }
+            if (historyCursor) {
+                historyContainer.insertAdjacentHTML('beforeend',
+                    '<button type="button" class="btn btn-link w-100 history-more">Load more</button>');
+                historyContainer.querySelector('.history-more')
+                    .addEventListener('click', () => loadHistory(true));
+            }
+        } catch (error) {
+            console.error('Error loading history:', error);
+        }
+    };
+
+    // Search saved plans from the sidebar; clearing the box brings the list back
+    const historySearch = document.getElementById('historySearch');
+    let searchTimer = null;
+
+    const searchHistory = async (query) => {
+        try {
+            const response = await fetch(`/search?q=${encodeURIComponent(query)}`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const { results } = await response.json();
+            if (historySearch.value.trim() !== query) {
+                return;
+            }
+            historyContainer.innerHTML = results.map(item => `
+                <div class="list-group-item list-group-item-action" role="button" onclick="loadLessonPlan(${item.id})">
                     <div class="d-flex justify-content-between align-items-center">
-                        <h5 class="mb-1">${item.title || 'Untitled Plan'}</h5>
-                        <small>${new Date(item.timestamp).toLocaleDateString()}</small>
+                        <h5 class="mb-1">${escapeHtml(item.title || 'Untitled Plan')}</h5>
+                        <small>${new Date(item.created_at).toLocaleDateString()}</small>
                     </div>
-                    <p class="mb-1">${item.subject || 'No subject'}</p>
+                    <p class="mb-1 small">${item.snippet || escapeHtml(item.subject)}</p>
                 </div>
-            `).join('') || '<p class="text-muted p-3">No plans yet</p>';
+            `).join('') || '<p class="text-muted p-3">No matching plans</p>';
+        } catch (error) {
+            console.error('Error searching history:', error);
         }
     };
 
+    historySearch?.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => {
+            const query = historySearch.value.trim();
+            if (query) {
+                searchHistory(query);
+            } else {
+                loadHistory();
+            }
+        }, 250);
+    });
+
     // Save to history
     const saveToHistory = (lessonPlan, formData) => {
+        const saved = fetch('/history', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ plan: lessonPlan, params: formData })
+        }).then(async response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const item = await response.json();
+            historyContainer?.querySelector('.history-empty')?.remove();
+            historyContainer?.insertAdjacentHTML('afterbegin', historyRow(item));
+            return item.id;
+        }).catch(error => {
+            console.error('Error saving to history:', error);
+            return null;
+        });
+        savedPlans.set(lessonPlan, saved);
+    };
+
+    // Keep the saved copy of a plan in step as its sections are generated
+    const updateHistoryPlan = async (lessonPlan) => {
+        const id = await savedPlans.get(lessonPlan);
+        if (!id) {
+            return;
+        }
         try {
-            const history = JSON.parse(localStorage.getItem('lessonHistory') || '[]');
-            history.unshift({
-                ...lessonPlan,
-                ...formData,
-                timestamp: new Date().toISOString()
+            await fetch(`/history/${id}`, {
+                method: 'PATCH',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ plan: lessonPlan })
             });
-            localStorage.setItem('lessonHistory', JSON.stringify(history.slice(0, 10)));
-            loadHistory();
         } catch (error) {
-            console.error('Error saving to history:', error);
+            console.error('Error updating history:', error);
         }
     };
 
     // Load lesson plan from history
-    window.loadLessonPlan = (index) => {
+    window.loadLessonPlan = async (id) => {
         try {
-            const history = JSON.parse(localStorage.getItem('lessonHistory') || '[]');
-            if (index >= 0 && index < history.length) {
-                displayLessonPlan(history[index]);
-            } else {
-                console.error("Invalid lesson plan index");
+            const response = await fetch(`/history/${id}`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
             }
+            const item = await response.json();
+            savedPlans.set(item.plan, Promise.resolve(item.id));
+            displayLessonPlan(item.plan);
         } catch (error) {
             console.error('Error loading lesson plan:', error);
         }
     };
 
+    // Move plans saved in this browser before history lived on the server
+    const migrateLocalHistory = async () => {
+        const history = JSON.parse(localStorage.getItem('lessonHistory') || '[]');
+        if (!history.length) {
+            return;
+        }
+        // Oldest first so the newest keeps its place at the top
+        for (const item of history.reverse()) {
+            // Entries saved before plans were nested kept plan and form fields side by side
+            const plan = item.plan || item;
+            const params = item.params || { subject: item.subject, template: item.template };
+            const response = await fetch('/history', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ plan, params })
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+        }
+        localStorage.removeItem('lessonHistory');
+    };
+
     // Initial history load
-    loadHistory();
+    migrateLocalHistory()
+        .catch(error => console.error('Error migrating history:', error))
+        .finally(() => loadHistory());
 });
\ No newline at end of file
@@ -0,0 +1,352 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import stripe
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+# Stripe subscription statuses that grant access to the app
+ACTIVE_STATUSES = ('active',)
+
+# Subscription fields recording when Stripe changed its state
+STATE_TIMESTAMPS = ('created', 'start_date', 'current_period_start', 'trial_start', 'trial_end',
+                    'canceled_at', 'ended_at')
+
+
+def normalize_email(email: str) -> str:
+    return (email or '').strip().lower()
+
+
+def state_changed_at(subscription) -> int:
+    """The latest state change a subscription object records; future dates (a trial end) don't count yet"""
+    now = time.time()
+    stamps = [subscription.get(field) for field in STATE_TIMESTAMPS]
+    return int(max((stamp for stamp in stamps if stamp and stamp <= now), default=0))
+
+
+class EntitlementStore:
+    """Local copy of Stripe subscription state with an in-memory TTL cache in front.
+
+    Webhooks keep the table current, a periodic reconciliation pass repairs any
+    missed events, and Stripe is only queried when a customer has never been seen.
+    It also indexes Stripe customers by user id and email, so finding a
+    teacher's customer doesn't need Stripe's slow, rate-limited email search.
+    """
+
+    def __init__(self, db_path: str = None, cache_ttl: float = None, reconcile_interval: float = None,
+                 miss_ttl: float = None):
+        self.db_path = db_path or os.environ.get(
+            'ENTITLEMENT_DB_PATH', os.path.join(DATA_DIR, 'entitlements.db'))
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(
+            os.environ.get('ENTITLEMENT_CACHE_TTL', 60))
+        self.reconcile_interval = reconcile_interval if reconcile_interval is not None else float(
+            os.environ.get('ENTITLEMENT_RECONCILE_INTERVAL', 3600))
+        # How long "Stripe has no customer with this email" is trusted before searching again
+        self.miss_ttl = miss_ttl if miss_ttl is not None else float(
+            os.environ.get('CUSTOMER_MISS_TTL', 3600))
+
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+        self._reconciler = None
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._init_db()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                subscription_id TEXT PRIMARY KEY,
+                customer_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                current_period_end INTEGER,
+                event_created INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_subscriptions_customer
+                ON subscriptions (customer_id, status);
+            CREATE TABLE IF NOT EXISTS synced_customers (
+                customer_id TEXT PRIMARY KEY,
+                synced_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                user_id TEXT,
+                created INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_customers_email ON customers (email, created);
+            CREATE INDEX IF NOT EXISTS idx_customers_user ON customers (user_id, created);
+            CREATE TABLE IF NOT EXISTS customer_misses (
+                email TEXT PRIMARY KEY,
+                checked_at REAL NOT NULL
+            );
+        """)
+
+    # Cache -----------------------------------------------------------------
+
+    def _cache_get(self, customer_id: str):
+        with self._cache_lock:
+            entry = self._cache.get(customer_id)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            return None
+
+    def _cache_set(self, customer_id: str, active: bool):
+        with self._cache_lock:
+            self._cache[customer_id] = (active, time.monotonic() + self.cache_ttl)
+
+    def invalidate(self, customer_id: str):
+        with self._cache_lock:
+            self._cache.pop(customer_id, None)
+
+    # Lookups ---------------------------------------------------------------
+
+    def is_active(self, customer_id: str) -> bool:
+        """Answer from memory, then the local table, then Stripe on a cold miss"""
+        cached = self._cache_get(customer_id)
+        if cached is not None:
+            return cached
+
+        active = self._lookup_local(customer_id)
+        if active is None:
+            active = self.sync_customer(customer_id)
+        self._cache_set(customer_id, active)
+        return active
+
+    def _lookup_local(self, customer_id: str):
+        conn = self._connection()
+        synced = conn.execute(
+            'SELECT 1 FROM synced_customers WHERE customer_id = ?', (customer_id,)).fetchone()
+        row = conn.execute(
+            f'SELECT 1 FROM subscriptions WHERE customer_id = ? AND status IN ({",".join("?" * len(ACTIVE_STATUSES))}) LIMIT 1',
+            (customer_id, *ACTIVE_STATUSES)).fetchone()
+        if row:
+            return True
+        return False if synced else None
+
+    # Customers -------------------------------------------------------------
+
+    def customer_id_for(self, user_id: str, email: str, trust_misses: bool = True):
+        """The user's Stripe customer id: from the index, else one Stripe email search.
+
+        The newest customer with the email wins, as with Stripe's own list.
+        A search that finds nothing is remembered for ``miss_ttl`` seconds
+        unless ``trust_misses`` is off (before creating a customer, say).
+        """
+        key = normalize_email(email)
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT customer_id FROM customers WHERE user_id = ? ORDER BY created DESC LIMIT 1',
+            (user_id,)).fetchone()
+        if row is None and key:
+            row = conn.execute(
+                'SELECT customer_id FROM customers WHERE email = ? ORDER BY created DESC LIMIT 1',
+                (key,)).fetchone()
+            if row is not None and user_id:
+                conn.execute('UPDATE customers SET user_id = ? WHERE customer_id = ?', (user_id, row[0]))
+        if row is not None:
+            return row[0]
+        if not key:
+            return None
+
+        if trust_misses:
+            missed = conn.execute(
+                'SELECT 1 FROM customer_misses WHERE email = ? AND checked_at > ?',
+                (key, time.time() - self.miss_ttl)).fetchone()
+            if missed:
+                return None
+        with metrics.track('stripe', 'customer_lookup'):
+            customers = stripe.Customer.list(email=email, limit=1)
+        if not customers.data:
+            conn.execute("""
+                INSERT INTO customer_misses (email, checked_at) VALUES (?, ?)
+                ON CONFLICT(email) DO UPDATE SET checked_at = excluded.checked_at
+            """, (key, time.time()))
+            return None
+        self.remember_customer(customers.data[0], user_id=user_id)
+        return customers.data[0]['id']
+
+    def remember_customer(self, customer, user_id: str = None):
+        """Index a Stripe customer object by email, and by user id when known"""
+        email = normalize_email(customer.get('email'))
+        if not email:
+            return
+        conn = self._connection()
+        conn.execute("""
+            INSERT INTO customers (customer_id, email, user_id, created, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(customer_id) DO UPDATE SET
+                email = excluded.email,
+                user_id = COALESCE(excluded.user_id, customers.user_id),
+                created = excluded.created,
+                updated_at = excluded.updated_at
+        """, (customer['id'], email, user_id, customer.get('created') or 0, time.time()))
+        conn.execute('DELETE FROM customer_misses WHERE email = ?', (email,))
+
+    def forget_customer(self, customer_id: str):
+        self._connection().execute('DELETE FROM customers WHERE customer_id = ?', (customer_id,))
+
+    def import_customers(self, since: int = None) -> int:
+        """Page through Stripe customers (all, or created after ``since``) into the index"""
+        params = {'limit': 100}
+        if since:
+            params['created'] = {'gt': since}
+        conn = self._connection()
+        count = 0
+        newest = since or 0
+        for customer in stripe.Customer.list(**params).auto_paging_iter():
+            # Commit in batches rather than once per customer
+            if not conn.in_transaction:
+                conn.execute('BEGIN')
+            self.remember_customer(customer)
+            newest = max(newest, customer.get('created') or 0)
+            count += 1
+            if count % 500 == 0:
+                conn.execute('COMMIT')
+        if conn.in_transaction:
+            conn.execute('COMMIT')
+        conn.execute("""
+            INSERT INTO store_meta (key, value) VALUES ('customers_imported_through', ?)
+            ON CONFLICT(key) DO UPDATE SET value = MAX(store_meta.value, excluded.value)
+        """, (newest,))
+        return count
+
+    def _customers_imported_through(self):
+        row = self._connection().execute(
+            "SELECT value FROM store_meta WHERE key = 'customers_imported_through'").fetchone()
+        return int(row[0]) if row else None
+
+    # Writes ----------------------------------------------------------------
+
+    def upsert_subscription(self, subscription, event_created: int = None):
+        """Record a Stripe subscription object, ignoring events older than what we hold.
+
+        A subscription pulled from the API rather than from an event is dated by
+        its own timestamps (see ``state_changed_at``), not by when it was pulled,
+        so a webhook for a later change still applies when it arrives after the pull.
+        """
+        if event_created is None:
+            event_created = state_changed_at(subscription)
+        customer_id = subscription['customer']
+        if not isinstance(customer_id, str):
+            customer_id = customer_id['id']
+
+        conn = self._connection()
+        conn.execute("""
+            INSERT INTO subscriptions
+                (subscription_id, customer_id, status, current_period_end, event_created, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(subscription_id) DO UPDATE SET
+                customer_id = excluded.customer_id,
+                status = excluded.status,
+                current_period_end = excluded.current_period_end,
+                event_created = excluded.event_created,
+                updated_at = excluded.updated_at
+            WHERE excluded.event_created >= subscriptions.event_created
+        """, (
+            subscription['id'],
+            customer_id,
+            subscription['status'],
+            subscription.get('current_period_end'),
+            event_created,
+            time.time(),
+        ))
+        self._mark_synced(customer_id)
+        self.invalidate(customer_id)
+
+    def _mark_synced(self, customer_id: str):
+        self._connection().execute("""
+            INSERT INTO synced_customers (customer_id, synced_at) VALUES (?, ?)
+            ON CONFLICT(customer_id) DO UPDATE SET synced_at = excluded.synced_at
+        """, (customer_id, time.time()))
+
+    def apply_event(self, event) -> bool:
+        """Apply a Stripe webhook event; returns True if the event was relevant"""
+        if event['type'] in ('customer.created', 'customer.updated'):
+            self.remember_customer(event['data']['object'])
+            return True
+        if event['type'] == 'customer.deleted':
+            self.forget_customer(event['data']['object']['id'])
+            return True
+        if not event['type'].startswith('customer.subscription.'):
+            return False
+        subscription = event['data']['object']
+        self.upsert_subscription(subscription, event_created=event.get('created', 0))
+        logger.info("Applied %s for subscription %s", event['type'], subscription['id'])
+        return True
+
+    def sync_customer(self, customer_id: str) -> bool:
+        """Pull one customer's subscriptions from Stripe into the local table"""
+        subscriptions = stripe.Subscription.list(customer=customer_id, status='all', limit=100)
+        for subscription in subscriptions.auto_paging_iter():
+            self.upsert_subscription(subscription)
+        self._mark_synced(customer_id)
+        self.invalidate(customer_id)
+        return bool(self._lookup_local(customer_id))
+
+    # Reconciliation --------------------------------------------------------
+
+    def _claim_reconcile(self) -> bool:
+        """Only one process per reconcile interval does the full Stripe pass"""
+        now = time.time()
+        cursor = self._connection().execute("""
+            INSERT INTO store_meta (key, value) VALUES ('last_reconciled_at', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            WHERE store_meta.value <= ?
+        """, (now, now - self.reconcile_interval))
+        return cursor.rowcount > 0
+
+    def reconcile(self) -> int:
+        """Page through every Stripe subscription and refresh the local table"""
+        count = 0
+        for subscription in stripe.Subscription.list(status='all', limit=100).auto_paging_iter():
+            self.upsert_subscription(subscription)
+            count += 1
+        with self._cache_lock:
+            self._cache.clear()
+        logger.info("Reconciled %s subscriptions from Stripe", count)
+        # Pick up customers whose webhooks were missed; the first full import is `flask backfill-customers`
+        since = self._customers_imported_through()
+        if since is not None:
+            added = self.import_customers(since=since)
+            if added:
+                logger.info("Indexed %s new Stripe customers", added)
+        return count
+
+    def _reconcile_loop(self):
+        while True:
+            try:
+                if self._claim_reconcile():
+                    self.reconcile()
+            except Exception as e:
+                logger.error("Subscription reconciliation failed: %s", e)
+            time.sleep(min(self.reconcile_interval, 300))
+
+    def start_reconciler(self):
+        if self._reconciler or self.reconcile_interval <= 0:
+            return
+        self._reconciler = threading.Thread(
+            target=self._reconcile_loop, name='entitlement-reconciler', daemon=True)
+        self._reconciler.start()
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+import numpy as np
+from generation_cache import KEY_FIELDS, normalize_value
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+# Feature weights: a different template or subtemplate matters more than
+# different wording in the description
+FIELD_WEIGHTS = {
+    'template': 2.0,
+    'subtemplate': 2.0,
+    'subject': 1.5,
+    'objectives': 0.75,
+    'duration': 0.5,
+    'title': 0.5,
+}
+
+GRADE_NAMES = {'k': 0, 'kindergarten': 0, 'pre-k': -1, 'prek': -1}
+
+
+def _grade_number(grade: str):
+    grade = normalize_value(grade)
+    if grade in GRADE_NAMES:
+        return GRADE_NAMES[grade]
+    match = re.search(r'\d+', grade)
+    return int(match.group()) if match else None
+
+
+def _features(params: dict, title: str = ''):
+    """(token, weight) pairs for a plan's inputs"""
+    for field in ('template', 'subtemplate', 'duration'):
+        value = normalize_value(params.get(field))
+        if value:
+            yield f'{field}:{value}', FIELD_WEIGHTS[field]
+
+    for field, text in (('subject', params.get('subject')), ('objectives', params.get('objectives')),
+                        ('title', title)):
+        text = normalize_value(text)
+        words = re.findall(r'\w+', text)
+        for word in words:
+            yield f'w:{word}', FIELD_WEIGHTS[field]
+        for first, second in zip(words, words[1:]):
+            yield f'b:{first} {second}', FIELD_WEIGHTS[field]
+        # Character trigrams catch plurals and typos ("fraction" vs "fractions")
+        for word in words:
+            padded = f' {word} '
+            for start in range(len(padded) - 2):
+                yield f'c:{padded[start:start + 3]}', FIELD_WEIGHTS[field] * 0.3
+
+    # Neighbouring grades share part of their signal
+    grade = _grade_number(params.get('grade'))
+    if grade is not None:
+        yield f'grade:{grade}', 1.5
+        yield f'grade:{grade - 1}', 0.75
+        yield f'grade:{grade + 1}', 0.75
+
+
+def vectorize(params: dict, title: str = '', dim: int = 512) -> np.ndarray:
+    """L2-normalized hashed n-gram vector for a plan's parameters"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token, weight in _features(params, title):
+        # crc32 is stable across processes, unlike hash()
+        hashed = zlib.crc32(token.encode('utf-8'))
+        sign = 1.0 if hashed & 0x80000000 else -1.0
+        vector[hashed % dim] += sign * weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SuggestionIndex:
+    """Similarity index over previously generated plans.
+
+    Vectors are appended to a flat float32 file that every worker memory-maps;
+    plan metadata lives in SQLite next to it, whose write lock also serializes
+    appends across workers. A worker picks up rows written by others by
+    re-mapping the file when it has grown or been replaced. Workers keep only
+    each row's key and owner in memory and read the rest for the rows they
+    return. Plans are only ever suggested to the user who generated them.
+
+    The index holds at most ``max_rows`` plans: the append that reaches it
+    compacts the index down to the newest half, writing a new vector file.
+    """
+
+    def __init__(self, path: str = None, dim: int = None, max_rows: int = None):
+        self.path = path or os.environ.get('SUGGEST_INDEX_PATH', os.path.join(DATA_DIR, 'suggestions'))
+        self.dim = dim or int(os.environ.get('SUGGEST_DIM', 512))
+        self.max_rows = max(2, max_rows or int(os.environ.get('SUGGEST_MAX_ROWS', 20000)))
+        self.vectors_path = f'{self.path}.f32'
+        self.row_bytes = self.dim * 4
+
+        # (matrix, row keys, row owners), swapped as one so readers never see them out of step
+        self._snapshot = (np.zeros((0, self.dim), dtype=np.float32), [], np.array([], dtype=object))
+        self._size = 0
+        self._inode = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._init_db()
+        self._refresh()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'{self.path}.db', timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS suggestion_rows (
+                row INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                owner TEXT,
+                params TEXT NOT NULL,
+                title TEXT,
+                overview TEXT,
+                created_at REAL NOT NULL
+            );
+        """)
+        columns = {name for _, name, *_ in conn.execute('PRAGMA table_info(suggestion_rows)')}
+        if 'owner' not in columns:
+            # Rows indexed before suggestions were scoped have no owner and are never suggested
+            conn.execute('ALTER TABLE suggestion_rows ADD COLUMN owner TEXT')
+
+    def _refresh(self):
+        """Re-map the vector file if another worker (or this one) appended to or compacted it"""
+        try:
+            st = os.stat(self.vectors_path)
+            size, inode = st.st_size, st.st_ino
+        except OSError:
+            size, inode = 0, None
+        if size == self._size and inode == self._inode:
+            return
+
+        with self._lock:
+            if size == self._size and inode == self._inode:
+                return
+            _, known, known_owners = self._snapshot
+            # A compacted index is a new file with renumbered rows: start over
+            replaced = inode != self._inode
+            if replaced:
+                known, known_owners = [], known_owners[:0]
+            # Only expose rows whose metadata has been committed
+            added = self._connection().execute(
+                'SELECT key, owner FROM suggestion_rows WHERE row >= ? AND row < ? ORDER BY row',
+                (len(known), size // self.row_bytes)).fetchall()
+            if not added and not replaced:
+                return
+            keys = known + [key for key, _ in added]
+            owners = np.concatenate([known_owners, np.array([owner for _, owner in added], dtype=object)])
+            if keys:
+                matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(keys), self.dim))
+            else:
+                matrix = np.zeros((0, self.dim), dtype=np.float32)
+            self._snapshot = (matrix, keys, owners)
+            # A row still being written is picked up on a later call
+            self._size = len(keys) * self.row_bytes
+            self._inode = inode
+
+    def _compact(self, conn: sqlite3.Connection, count: int):
+        """Keep the newest half of the rows, renumbered from 0, in a new vector file.
+
+        Runs inside ``add``'s transaction; returns the new row count and the
+        path of the new file, which replaces the old one once committed.
+        """
+        first = count - self.max_rows // 2
+        compacted_path = f'{self.vectors_path}.compact'
+        with open(self.vectors_path, 'rb') as old, open(compacted_path, 'wb') as new:
+            old.seek(first * self.row_bytes)
+            new.write(old.read((count - first) * self.row_bytes))
+        conn.execute('DELETE FROM suggestion_rows WHERE row < ?', (first,))
+        # The kept rows move below the first one, into numbers just freed
+        conn.execute('UPDATE suggestion_rows SET row = row - ?', (first,))
+        logger.info("Compacted the suggestion index from %s to %s rows", count, count - first)
+        return count - first, compacted_path
+
+    def add(self, key: str, params: dict, plan: dict, owner: str):
+        """Index a freshly generated plan for the user who asked for it"""
+        stored = {field: params.get(field) or '' for field in KEY_FIELDS}
+        if params.get('mode'):
+            stored['mode'] = params['mode']
+        title = plan.get('title') or ''
+        vector = vectorize(stored, title, self.dim)
+
+        conn = self._connection()
+        compacted_path = None
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            (row,) = conn.execute('SELECT COUNT(*) FROM suggestion_rows').fetchone()
+            if row >= self.max_rows:
+                row, compacted_path = self._compact(conn, row)
+            path = compacted_path or self.vectors_path
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                # Overwrite any partial row left by a crash before its metadata was committed
+                f.seek(row * self.row_bytes)
+                f.write(vector.tobytes())
+                f.truncate()
+            conn.execute("""
+                INSERT INTO suggestion_rows (row, key, owner, params, title, overview, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (row, key, owner, json.dumps(stored), title, plan.get('overview') or '', time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            if compacted_path:
+                os.remove(compacted_path)
+            raise
+        if compacted_path:
+            # After the commit, so no worker maps the new file against the old row numbers. An
+            # append slipping in first lands in the old file and leaves a zero row here; it
+            # matches nothing.
+            os.replace(compacted_path, self.vectors_path)
+
+    def suggest(self, params: dict, owner: str, k: int = 5, min_score: float = 0.0) -> list:
+        """Top-``k`` plans ``owner`` generated before that are most similar to ``params``"""
+        self._refresh()
+        matrix, keys, owners = self._snapshot
+        if not keys:
+            return []
+
+        query = vectorize(params, dim=self.dim)
+        # Other users' plans can never make the cut
+        scores = np.where(owners == owner, matrix @ query, -np.inf)
+        # Over-fetch so regenerated duplicates of one plan don't crowd out the rest
+        fetch = min(len(keys), k * 4)
+        top = np.argpartition(-scores, fetch - 1)[:fetch]
+        top = [int(index) for index in top[np.argsort(-scores[top])] if scores[index] >= min_score]
+        if not top:
+            return []
+
+        placeholders = ','.join('?' * len(top))
+        found = {
+            row: (key, stored, title, overview, created_at)
+            for row, key, stored, title, overview, created_at in self._connection().execute(
+                f'SELECT row, key, params, title, overview, created_at FROM suggestion_rows '
+                f'WHERE row IN ({placeholders}) AND owner = ?', top + [owner])
+        }
+
+        suggestions = []
+        seen = set()
+        for index in top:
+            # Skip rows renumbered by a compaction since this snapshot was taken
+            if index not in found or found[index][0] != keys[index] or keys[index] in seen:
+                continue
+            key, stored, title, overview, created_at = found[index]
+            seen.add(key)
+            suggestions.append({
+                'score': round(float(scores[index]), 4),
+                'title': title,
+                'overview': overview,
+                'params': json.loads(stored),
+                'created_at': created_at,
+            })
+            if len(suggestions) >= k:
+                break
+        return suggestions
+
+    def stats(self) -> dict:
+        self._refresh()
+        return {'rows': len(self._snapshot[1]), 'dim': self.dim, 'max_rows': self.max_rows}
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import pytest
+
+# app reads its configuration at import time; nothing here reaches a real upstream
+for name, value in {
+    'DATA_DIR': tempfile.mkdtemp(prefix='lesson-planner-tests-'),
+    'SESSION_SECRET': 'test-secret',
+    'OPENAI_API_KEY': 'sk-test',
+    'STRIPE_SECRET_KEY': 'sk_test_x',
+    'STRIPE_PRICE_ID': 'price_test',
+    'STRIPE_WEBHOOK_SECRET': 'whsec_test',
+    'SUPABASE_URL': 'http://127.0.0.1:9',
+    'SUPABASE_KEY': 'eyJtest',
+    'DEMO_ADMIN_EMAIL': 'admin@example.com',
+    'DEMO_ADMIN_PASSWORD': 'admin-password',
+}.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def client():
+    from app import app, init_db
+    init_db()
+    return app.test_client()
+
+
+@pytest.fixture
+def signed_in(client):
+    client.post('/login', data={'email': os.environ['DEMO_ADMIN_EMAIL'],
+                                'password': os.environ['DEMO_ADMIN_PASSWORD']})
+    return client
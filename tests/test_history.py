@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize('plan, params', [
+    ({'title': ['Fractions']}, {}),
+    ({'title': 'Fractions'}, {'subject': {'name': 'Math'}}),
+    ({'title': 'Fractions'}, {'subtemplate': ['Quiz']}),
+])
+def test_save_rejects_non_text_title_or_subject(signed_in, plan, params):
+    response = signed_in.post('/history', json={'plan': plan, 'params': params})
+    assert response.status_code == 400
+
+
+def test_save_coerces_numbers_to_text(signed_in):
+    response = signed_in.post('/history', json={'plan': {'title': 42}, 'params': {'subject': 7}})
+    assert response.status_code == 201
+    assert response.json['title'] == '42'
+    assert response.json['subject'] == '7'
+
+
+def test_update_rejects_non_text_title(signed_in):
+    saved = signed_in.post('/history', json={'plan': {'title': 'Fractions'}, 'params': {}}).json
+    response = signed_in.patch(f"/history/{saved['id']}", json={'plan': {'title': {'text': 'x'}}})
+    assert response.status_code == 400
+    assert signed_in.get(f"/history/{saved['id']}").json['title'] == 'Fractions'
@@ -0,0 +1,69 @@
+import asyncio
+from router import ModelRouter, Route
+
+
+class Limiter:
+    def has_headroom(self):
+        return True
+
+
+def hedging_router():
+    router = ModelRouter(lambda: None, Limiter(), [Route('test', ('primary', 'backup'), 30)])
+    # Hedge straight away so both attempts are in flight
+    router.hedge_delay = lambda route, metric='complete': 0.0
+    return router
+
+
+def test_losers_finishing_with_the_cancelled_race_are_discarded():
+    async def scenario():
+        router = hedging_router()
+        gate = asyncio.Event()
+        launched, discarded = [], []
+
+        async def attempt(model):
+            launched.append(model)
+            await gate.wait()
+            return model
+
+        async def discard(opened):
+            discarded.append(opened)
+
+        race = asyncio.ensure_future(router._race('test', attempt, 'stream', discard))
+        while len(launched) < 2:
+            await asyncio.sleep(0)
+        # Both attempts finish in the tick the race is cancelled in
+        gate.set()
+        race.cancel()
+        try:
+            await race
+        except asyncio.CancelledError:
+            pass
+        return discarded
+
+    assert sorted(asyncio.run(scenario())) == ['backup', 'primary']
+
+
+def test_loser_finishing_with_the_winner_is_discarded():
+    async def scenario():
+        router = hedging_router()
+        gate = asyncio.Event()
+        launched, discarded = [], []
+
+        async def attempt(model):
+            launched.append(model)
+            if model == 'primary':
+                await gate.wait()
+                return model
+            while len(launched) < 2:
+                await asyncio.sleep(0)
+            gate.set()
+            return model
+
+        async def discard(opened):
+            discarded.append(opened)
+
+        result, _ = await router._race('test', attempt, 'stream', discard)
+        return result, discarded
+
+    result, discarded = asyncio.run(scenario())
+    assert discarded == [model for model in ('primary', 'backup') if model != result]
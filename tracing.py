@@ -0,0 +1,339 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from flask import request, before_render_template, template_rendered
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('DATA_DIR', 'instance')
+
+TRACE_FILE = os.environ.get('TRACE_FILE', os.path.join(DATA_DIR, 'traces.jsonl'))
+# Share of requests written to TRACE_FILE; slower ones than TRACE_SLOW_MS are always written
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', 1000))
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 50 * 1024 * 1024))
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+# Bounds a trace's memory when a request makes many calls (e.g. a batch)
+MAX_SPANS = 256
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """Timeline of the spans opened while one request was handled"""
+
+    def __init__(self, method: str, route: str, path: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.route = route
+        self.path = path
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+        self.status = None
+        self.spans = []  # [name, start, end, parent], seconds from the start of the trace
+        self._open = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def open(self, name: str):
+        if len(self.spans) >= MAX_SPANS:
+            return None
+        self.spans.append([name, self.elapsed(), None, self._open[-1] if self._open else None])
+        self._open.append(len(self.spans) - 1)
+        return len(self.spans) - 1
+
+    def close(self, index):
+        if index is None or index not in self._open:
+            return
+        # Spans left open inside this one (a failed render, say) end with it
+        while self._open:
+            inner = self._open.pop()
+            self.spans[inner][2] = self.elapsed()
+            if inner == index:
+                break
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: total time per span name so far, and the total"""
+        totals = {}
+        for name, start, end, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + ((end if end is not None else self.elapsed()) - start)
+        metrics = [f'{_token(name)};dur={seconds * 1000:.1f}' for name, seconds in totals.items()]
+        metrics.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'time': self.wall_start,
+            'method': self.method,
+            'route': self.route,
+            'path': self.path,
+            'status': self.status,
+            'duration_ms': round(self.elapsed() * 1000, 2),
+            'spans': [
+                {
+                    'name': name,
+                    'start_ms': round(start * 1000, 2),
+                    'duration_ms': round(((end if end is not None else self.elapsed()) - start) * 1000, 2),
+                    'parent': parent,
+                }
+                for name, start, end, parent in self.spans
+            ],
+        }
+
+
+def _token(name: str) -> str:
+    # Server-Timing metric names must be HTTP tokens
+    return re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", '_', name)
+
+
+@contextmanager
+def span(name: str):
+    """Time a block as a span of the current request's trace (a no-op outside requests)"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    index = trace.open(name)
+    try:
+        yield
+    finally:
+        trace.close(index)
+
+
+class TraceWriter:
+    """Appends sampled traces to a JSONL file shared by every worker process"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, record: dict):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, f'{self.path}.1')
+            except OSError:
+                pass
+            # One O_APPEND write per line keeps lines from different workers whole
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving one route and writes collapsed stacks.
+
+    Switched on for a limited time through a small control file, so every
+    worker process picks the change up within a second. While on, a thread
+    in each worker reads ``sys._current_frames()`` every ``interval``
+    seconds, only for threads handling the chosen route, and keeps counts
+    per stack. These are flushed to ``<route>-<session>-<pid>.folded`` in
+    PROFILE_DIR, ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.control_path = os.path.join(output_dir, 'profiler.json')
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._counts = Counter()
+        self._session = None
+        self._route = None
+        self._sampler = None
+        self._config = None
+        self._config_mtime = None
+        self._checked_at = 0.0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def enable(self, route: str, seconds: float, interval: float) -> dict:
+        config = {
+            'route': route,
+            'until': time.time() + seconds,
+            'interval': interval,
+            'session': time.strftime('%Y%m%d-%H%M%S'),
+        }
+        tmp_path = f'{self.control_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(config, f)
+        os.replace(tmp_path, self.control_path)
+        self._checked_at = 0.0
+        logger.info("Profiling %s for %.0fs", route, seconds)
+        return config
+
+    def disable(self):
+        try:
+            os.remove(self.control_path)
+        except FileNotFoundError:
+            pass
+        self._checked_at = 0.0
+
+    def config(self):
+        """The active profiling session, or None; the control file is re-read at most once a second"""
+        now = time.time()
+        if now - self._checked_at >= 1.0:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.control_path)
+                if mtime != self._config_mtime:
+                    with open(self.control_path) as f:
+                        self._config = json.load(f)
+                    self._config_mtime = mtime
+            except (OSError, ValueError):
+                self._config, self._config_mtime = None, None
+        if self._config and self._config['until'] > now:
+            return self._config
+        return None
+
+    def enter(self, route: str):
+        config = self.config()
+        if not config or config['route'] != route:
+            return
+        with self._lock:
+            self._threads[threading.get_ident()] = True
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._sampler.start()
+
+    def leave(self):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            config = self.config()
+            if config is None:
+                break
+            if config['session'] != self._session:
+                self._flush()
+                self._counts = Counter()
+                self._session, self._route = config['session'], config['route']
+            with self._lock:
+                idents = list(self._threads)
+            if idents:
+                frames = sys._current_frames()
+                for ident in idents:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._counts[_collapse(frame)] += 1
+            if time.monotonic() - last_flush >= 5:
+                self._flush()
+                last_flush = time.monotonic()
+            time.sleep(config['interval'])
+        self._flush()
+        self._counts = Counter()
+        self._session = None
+        with self._lock:
+            self._sampler = None
+
+    def _flush(self):
+        if not self._counts or not self._session:
+            return
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', self._route).strip('_') or 'root'
+        path = os.path.join(self.output_dir, f'{slug}-{self._session}-{os.getpid()}.folded')
+        # Counts accumulate for the whole session, so each flush rewrites the file
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for stack, count in self._counts.most_common():
+                f.write(f'{stack} {count}\n')
+        os.replace(tmp_path, path)
+
+    def files(self) -> list:
+        return sorted(name for name in os.listdir(self.output_dir) if name.endswith('.folded'))
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+writer = TraceWriter(TRACE_FILE, TRACE_MAX_BYTES)
+profiler = SamplingProfiler(PROFILE_DIR)
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before_request():
+    trace = Trace(request.method, _route(), request.path)
+    request.environ['tracing.token'] = _current.set(trace)
+    request.environ['tracing.trace'] = trace
+    profiler.enter(trace.route)
+
+
+def _after_request(response):
+    trace = request.environ.get('tracing.trace')
+    if trace is None:
+        return response
+    trace.status = response.status_code
+    if SERVER_TIMING:
+        # Streamed bodies report what happened before the first byte
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers['X-Trace-Id'] = trace.id
+    return response
+
+
+def _teardown_request(error=None):
+    trace = request.environ.pop('tracing.trace', None)
+    if trace is None:
+        return
+    profiler.leave()
+    token = request.environ.pop('tracing.token', None)
+    if token is not None:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Reset from a different context (a streamed body); just detach
+            _current.set(None)
+    if trace.sampled or trace.elapsed() * 1000 >= TRACE_SLOW_MS:
+        try:
+            writer.write(trace.to_dict())
+        except Exception as e:
+            logger.warning("Failed to write trace: %s", e)
+
+
+def _template_started(sender, template, context, **extra):
+    trace = _current.get()
+    if trace is not None:
+        request.environ.setdefault('tracing.templates', []).append(trace.open(f'render.{template.name or "inline"}'))
+
+
+def _template_finished(sender, template, context, **extra):
+    trace = _current.get()
+    spans = request.environ.get('tracing.templates')
+    if trace is not None and spans:
+        trace.close(spans.pop())
+
+
+def init_app(app):
+    """Trace every request: spans in Server-Timing, samples in TRACE_FILE"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
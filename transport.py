@@ -0,0 +1,223 @@
+import os
+import logging
+import threading
+import importlib.util
+import time
+import httpx
+import stripe
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Per-upstream defaults: (pool size, read timeout in seconds)
+UPSTREAM_DEFAULTS = {
+    'openai': (
+        int(os.environ.get('JOB_WORKERS', 4)) + int(os.environ.get('BATCH_CONCURRENCY', 8)) + 4,
+        120.0,
+    ),
+    'stripe': (10, 30.0),
+    'supabase': (10, 15.0),
+}
+
+
+class UpstreamStats:
+    """Request counters for one upstream, shared by its sync and async transports"""
+
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self) -> float:
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        metrics.upstream_in_flight.labels(self.upstream).inc()
+        return time.perf_counter()
+
+    def finish(self, started: float, error_kind: str = None):
+        with self.lock:
+            self.in_flight -= 1
+            if error_kind:
+                self.errors += 1
+        metrics.upstream_in_flight.labels(self.upstream).dec()
+        metrics.upstream_http_duration.labels(self.upstream).observe(time.perf_counter() - started)
+        if error_kind:
+            metrics.upstream_http_errors.labels(self.upstream, error_kind).inc()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+            }
+
+
+def _error_kind(response=None, error=None):
+    """Metrics label for a failed request, or None if it succeeded"""
+    if error is not None:
+        return type(error).__name__
+    if response.status_code == 429:
+        return 'throttled'
+    if response.status_code >= 500:
+        return f'status_{response.status_code}'
+    return None
+
+
+def _pool_snapshot(pool) -> dict:
+    connections = list(getattr(pool, 'connections', []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {'connections': len(connections), 'idle': idle, 'active': len(connections) - idle}
+
+
+class CountingTransport(httpx.HTTPTransport):
+    def __init__(self, stats: UpstreamStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request):
+        started = self.stats.start()
+        try:
+            with tracing.span(f'http.{self.stats.upstream}'):
+                response = super().handle_request(request)
+        except BaseException as e:
+            self.stats.finish(started, _error_kind(error=e))
+            raise
+        self.stats.finish(started, _error_kind(response))
+        return response
+
+    def pool_stats(self) -> dict:
+        return _pool_snapshot(self._pool)
+
+
+class AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats: UpstreamStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        started = self.stats.start()
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException as e:
+            self.stats.finish(started, _error_kind(error=e))
+            raise
+        self.stats.finish(started, _error_kind(response))
+        return response
+
+    def pool_stats(self) -> dict:
+        return _pool_snapshot(self._pool)
+
+
+class Transport:
+    """Pooled HTTP clients for every upstream the app talks to.
+
+    Each upstream gets its own keep-alive connection pool (HTTP/2 when
+    available), explicit connect/read timeouts, and request counters.
+    Pool sizes and timeouts can be overridden with ``<UPSTREAM>_POOL_SIZE``,
+    ``<UPSTREAM>_CONNECT_TIMEOUT`` and ``<UPSTREAM>_READ_TIMEOUT``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = {}
+        self._transports = {}
+        self._async_transports = {}
+        self._stats = {}
+
+    def limits(self, upstream: str) -> httpx.Limits:
+        pool_size = int(os.environ.get(
+            f'{upstream.upper()}_POOL_SIZE', UPSTREAM_DEFAULTS[upstream][0]))
+        return httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 60)),
+        )
+
+    def timeout(self, upstream: str) -> httpx.Timeout:
+        prefix = upstream.upper()
+        read = float(os.environ.get(f'{prefix}_READ_TIMEOUT', UPSTREAM_DEFAULTS[upstream][1]))
+        return httpx.Timeout(
+            read,
+            connect=float(os.environ.get(f'{prefix}_CONNECT_TIMEOUT', 5.0)),
+            pool=float(os.environ.get('HTTP_POOL_TIMEOUT', 10.0)),
+        )
+
+    def _upstream_stats(self, upstream: str) -> UpstreamStats:
+        if upstream not in self._stats:
+            self._stats[upstream] = UpstreamStats(upstream)
+        return self._stats[upstream]
+
+    def client(self, upstream: str) -> httpx.Client:
+        """The shared synchronous client for ``upstream``"""
+        with self._lock:
+            if upstream not in self._clients:
+                transport = CountingTransport(
+                    self._upstream_stats(upstream),
+                    limits=self.limits(upstream),
+                    http2=HTTP2_AVAILABLE,
+                    retries=1,
+                )
+                self._transports[upstream] = transport
+                self._clients[upstream] = httpx.Client(
+                    transport=transport,
+                    timeout=self.timeout(upstream),
+                    follow_redirects=True,
+                )
+                logger.info("Created HTTP pool for %s (http2=%s)", upstream, HTTP2_AVAILABLE)
+            return self._clients[upstream]
+
+    def async_client(self, upstream: str) -> httpx.AsyncClient:
+        """The shared async client for ``upstream``; only use it from one event loop"""
+        with self._lock:
+            if upstream not in self._async_clients:
+                transport = AsyncCountingTransport(
+                    self._upstream_stats(upstream),
+                    limits=self.limits(upstream),
+                    http2=HTTP2_AVAILABLE,
+                    retries=1,
+                )
+                self._async_transports[upstream] = transport
+                self._async_clients[upstream] = httpx.AsyncClient(
+                    transport=transport,
+                    timeout=self.timeout(upstream),
+                    follow_redirects=True,
+                )
+            return self._async_clients[upstream]
+
+    def stats(self) -> dict:
+        """Request counters and pool utilization per upstream"""
+        with self._lock:
+            result = {}
+            for upstream, stats in self._stats.items():
+                entry = stats.snapshot()
+                entry['max_connections'] = self.limits(upstream).max_connections
+                if upstream in self._transports:
+                    entry['pool'] = self._transports[upstream].pool_stats()
+                if upstream in self._async_transports:
+                    entry['async_pool'] = self._async_transports[upstream].pool_stats()
+                result[upstream] = entry
+            return result
+
+
+transport = Transport()
+
+
+def stripe_http_client():
+    """A Stripe HTTP client that sends requests through the shared stripe pool"""
+    http_client = stripe.HTTPXClient(timeout=transport.timeout('stripe'), allow_sync_methods=True)
+    # HTTPXClient always builds its own httpx.Client; swap in the pooled one
+    http_client._client.close()
+    http_client._client = transport.client('stripe')
+    return http_client